@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+import importlib.metadata
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+import timeit
+
+from yams.scrobble import make_scrobble
+
+# Roughly what MPD hands us for a track in its database
+STATUS = {
+    "state": "play",
+    "elapsed": "12.402",
+    "duration": "215.342",
+    "songid": "1",
+}
+
+
+def make_song(index):
+    """
+    :param index: Which track this is, makes every track (and most artists and albums) unique
+    :type index: int
+
+    :return: A track's info, as taken from client.currentsong()
+    :rtype: dict
+    """
+
+    return {
+        "file": "Artist {0}/Album {1}/{2:02d} - Track {3}.flac".format(
+            index % 97, index % 389, index % 12 + 1, index
+        ),
+        "title": "Track {}".format(index),
+        "artist": "Artist {}".format(index % 97),
+        "album": "Album {}".format(index % 389),
+        "albumartist": "Artist {}".format(index % 97),
+        "track": str(index % 12 + 1),
+        "id": str(index),
+    }
+
+
+def make_backlog(size, start_time=1600000000):
+    """
+    :param size: The amount of scrobbles to make
+    :param start_time: The timestamp of the first scrobble
+
+    :type size: int
+    :type start_time: float
+
+    :return: A list of scrobbles, in the form of the scrobbles cache
+    :rtype: list
+    """
+
+    return [
+        make_scrobble(make_song(index), STATUS, timestamp=start_time + index * 200)
+        for index in range(size)
+    ]
+
+
+def quiet_logging(level=logging.INFO):
+    """
+    Keep the YAMS logger at the level the daemon runs at (so log calls cost what they normally do), without
+    printing anything
+    """
+
+    yams_logger = logging.getLogger("yams")
+    yams_logger.handlers = [logging.NullHandler()]
+    yams_logger.propagate = False
+    yams_logger.setLevel(level)
+
+
+def measure(function, repeat=5, budget=2.0):
+    """
+    Time function, timeit style: every run calls it enough times to take at least 0.2s, and we do up to
+    'repeat' runs, stopping early once 'budget' seconds have been spent (so huge inputs only run once).
+
+    :param function: The function to time, called without arguments
+    :param repeat: The maximum amount of runs
+    :param budget: Seconds after which no more runs are started
+
+    :type function: function
+    :type repeat: int
+    :type budget: float
+
+    :return: The best and median seconds per call, and the amount of runs and calls per run made
+    :rtype: dict
+    """
+
+    timer = timeit.Timer(function)
+    number, elapsed = timer.autorange()
+    runs = [elapsed / number]
+    spent = elapsed
+
+    while len(runs) < repeat and spent < budget:
+        elapsed = timer.timeit(number)
+        runs.append(elapsed / number)
+        spent += elapsed
+
+    return {
+        "best": min(runs),
+        "median": statistics.median(runs),
+        "runs": len(runs),
+        "number": number,
+    }
+
+
+def environment():
+    return {
+        "yams": importlib.metadata.version("YAMScrobbler"),
+        "python": sys.version.split()[0],
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "time": time.time(),
+    }
+
+
+def write_results(path, results, extra=None):
+    """
+    Write results out as JSON, along with a description of where they were measured
+
+    :param path: The file to write to, "-" for stdout
+    :param results: A dictionary of benchmark name to its measurements
+    :param extra: (Optional) Anything else worth recording, e.g. the options used
+
+    :type path: str
+    :type results: dict
+    :type extra: dict
+    """
+
+    document = {"environment": environment(), "results": results}
+    if extra is not None:
+        document.update(extra)
+
+    if path == "-":
+        json.dump(document, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return
+
+    with open(path, "w") as results_stream:
+        json.dump(document, results_stream, indent=2, sort_keys=True)
+        results_stream.write("\n")
+
+
+def read_results(path):
+    with open(path) as results_stream:
+        return json.load(results_stream)
+
+
+def compare(results, baseline, key="best", threshold=1.5, lower_is_better=True):
+    """
+    Print results next to a baseline, flagging everything that got worse by more than threshold times
+
+    :param results: A dictionary of benchmark name to its measurements
+    :param baseline: A results document, as written by write_results
+    :param key: The measurement to compare
+    :param threshold: How many times worse a result may be before it counts as a regression
+    :param lower_is_better: Is a lower measurement better (e.g. for times) or worse (e.g. for throughput)?
+
+    :type results: dict
+    :type baseline: dict
+    :type key: str
+    :type threshold: float
+    :type lower_is_better: bool
+
+    :return: The names of the benchmarks that regressed
+    :rtype: list
+    """
+
+    regressions = []
+    width = max([len(name) for name in results] + [9])
+
+    print(
+        "{:<{width}}  {:>12}  {:>12}  {:>7}".format(
+            "benchmark", "baseline", "current", "ratio", width=width
+        )
+    )
+    for name, result in results.items():
+        if name not in baseline["results"]:
+            print(
+                "{:<{width}}  {:>12}  {:>12.6g}  {:>7}".format(
+                    name, "-", result[key], "new", width=width
+                )
+            )
+            continue
+
+        before = baseline["results"][name][key]
+        ratio = result[key] / before if before else float("inf")
+        worse = ratio > threshold if lower_is_better else ratio < 1 / threshold
+        if worse:
+            regressions.append(name)
+
+        print(
+            "{:<{width}}  {:>12.6g}  {:>12.6g}  {:>6.2f}x{}".format(
+                name,
+                before,
+                result[key],
+                ratio,
+                "  <-- regression" if worse else "",
+                width=width,
+            )
+        )
+
+    return regressions
@@ -0,0 +1,673 @@
+#!/usr/bin/env python3
+"""
+In-process fakes of MPD and the Last.FM 2.0 API, for running YAMS without a real player or network.
+"""
+
+import heapq
+import http.server
+import itertools
+import json
+import queue
+import random
+import socketserver
+import threading
+import time
+from urllib.parse import parse_qsl
+import xml.sax.saxutils
+
+# HTTP statuses the real API sends along with its error codes
+ERROR_STATUSES = {4: 403, 9: 403, 11: 503, 16: 503, 26: 403, 29: 429}
+
+
+class SimulationOver(Exception):
+    pass
+
+
+class VirtualClock:
+    """
+    A clock that only moves when something sleeps on it. Actions scheduled with 'at' run as the clock
+    passes their time, in order, so the whole simulation runs on the one thread that's sleeping.
+
+    :param now: The time to start at, in seconds since the Epoch
+    :type now: float
+    """
+
+    def __init__(self, now):
+        self.now = now
+        self.actions = []
+        self.counter = itertools.count()
+
+    def time(self):
+        return self.now
+
+    def at(self, when, action):
+        heapq.heappush(self.actions, (when, next(self.counter), action))
+
+    def advance_to(self, when):
+        while len(self.actions) > 0 and self.actions[0][0] <= when:
+            due, count, action = heapq.heappop(self.actions)
+            self.now = max(self.now, due)
+            action()
+        self.now = max(self.now, when)
+
+    def sleep(self, seconds):
+        self.advance_to(self.now + seconds)
+
+    def wait_for_next(self):
+        """Skip ahead to the next scheduled action, ending the simulation if there are none left"""
+
+        if len(self.actions) < 1:
+            raise SimulationOver()
+        self.advance_to(self.actions[0][0])
+
+
+class FakePlayer:
+    """
+    The state of a fake MPD server: a playlist, played in real time. Drive it from a script by calling
+    play, pause, resume, seek, next and stop; every change wakes up clients waiting in idle, just like
+    MPD's "player" subsystem. The playlist advances to the next track by itself when one finishes.
+
+    With a virtual clock, pass background=False: tracks then only advance when the player is looked at,
+    instead of on a thread waiting for them to end in real time.
+
+    :param playlist: A list of tracks, each a dictionary of tags (as MPD would send them, e.g. Title, Artist) plus a duration
+    :param clock: (Optional) The function used to tell the time, in seconds
+    :param background: (Optional) Advance through the playlist from a thread, waking up idle clients as tracks change
+
+    :type playlist: list
+    :type clock: function
+    :type background: bool
+    """
+
+    def __init__(self, playlist, clock=time.time, background=True):
+        self.playlist = playlist
+        self.clock = clock
+
+        self.condition = threading.Condition()
+        self.state = "stop"
+        self.index = None
+        # Where in the track we were when we last started (or stopped) playing, and when that was
+        self.offset = 0.0
+        self.resumed_at = 0.0
+        # Incremented on every change to the player
+        self.changes = 0
+
+        # (time, index) every time a track started playing from its beginning
+        self.track_starts = []
+        # Command name -> times called
+        self.commands = {}
+
+        self.closed = False
+        if background:
+            threading.Thread(
+                target=self.advance, name="fake-mpd-player", daemon=True
+            ).start()
+
+    def changed(self):
+        self.changes += 1
+        self.condition.notify_all()
+
+    def elapsed(self):
+        if self.state == "play":
+            return self.offset + (self.clock() - self.resumed_at)
+        return self.offset
+
+    def play(self, index=0, at=None):
+        with self.condition:
+            self.index = index
+            self.offset = 0.0
+            self.resumed_at = self.clock() if at is None else at
+            self.state = "play"
+            self.track_starts.append((self.resumed_at, index))
+            self.changed()
+
+    def pause(self):
+        with self.condition:
+            if self.state == "play":
+                self.offset = self.elapsed()
+                self.state = "pause"
+                self.changed()
+
+    def resume(self):
+        with self.condition:
+            if self.state == "pause":
+                self.resumed_at = self.clock()
+                self.state = "play"
+                self.changed()
+
+    def seek(self, position):
+        with self.condition:
+            self.offset = position
+            self.resumed_at = self.clock()
+            self.changed()
+
+    def next(self, at=None):
+        with self.condition:
+            if self.index is not None and self.index + 1 < len(self.playlist):
+                self.play(self.index + 1, at)
+            else:
+                self.stop()
+
+    def stop(self):
+        with self.condition:
+            self.state = "stop"
+            self.offset = 0.0
+            self.changed()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.changed()
+
+    def advance(self):
+        """Thread: moves on to the next track whenever the current one finishes"""
+
+        with self.condition:
+            while not self.closed:
+                self.catch_up()
+                if self.state != "play":
+                    self.condition.wait()
+                else:
+                    self.condition.wait(
+                        self.playlist[self.index]["duration"] - self.elapsed()
+                    )
+
+    def catch_up(self):
+        """Move past every track that has finished playing since we last looked"""
+
+        with self.condition:
+            while self.state == "play":
+                remaining = self.playlist[self.index]["duration"] - self.elapsed()
+                if remaining > 0:
+                    break
+                # The next track started the moment this one ended, not whenever we noticed
+                self.next(self.clock() + remaining)
+
+    def status(self):
+        with self.condition:
+            self.catch_up()
+            status = {"volume": "100", "repeat": "0", "random": "0", "single": "0"}
+            status["state"] = self.state
+            if self.index is not None and self.state != "stop":
+                duration = self.playlist[self.index]["duration"]
+                elapsed = self.elapsed()
+                status["song"] = str(self.index)
+                status["songid"] = str(self.index + 1)
+                status["time"] = "{}:{}".format(int(elapsed), int(duration))
+                status["elapsed"] = "{:.3f}".format(elapsed)
+                status["duration"] = "{:.3f}".format(duration)
+                if self.index + 1 < len(self.playlist):
+                    status["nextsong"] = str(self.index + 1)
+                    status["nextsongid"] = str(self.index + 2)
+            return status
+
+    def currentsong(self):
+        with self.condition:
+            self.catch_up()
+            if self.index is None or self.state == "stop":
+                return {}
+            return self.song(self.index)
+
+    def playlistid(self, song_id):
+        """The track in the playlist with song_id (its position plus one), {} if there's no such track"""
+
+        index = int(song_id) - 1
+        if index < 0 or index >= len(self.playlist):
+            return {}
+        return self.song(index)
+
+    def song(self, index):
+        song = {
+            key: value
+            for key, value in self.playlist[index].items()
+            if key != "duration"
+        }
+        song["Pos"] = str(index)
+        song["Id"] = str(index + 1)
+        return song
+
+
+class FakeMPDClient:
+    """
+    Stands in for mpd.MPDClient, talking to a FakePlayer directly instead of over a socket. Handy with a
+    virtual clock, where nothing can block for real: idle calls wait() instead, which should return once
+    the player changed (e.g. by fast-forwarding the clock to the next scripted change).
+
+    :param player: The player to talk to
+    :param wait: (Optional) Called by idle, by default waits on the player for up to a second
+
+    :type player: benchmarks.fakes.FakePlayer
+    :type wait: function
+    """
+
+    def __init__(self, player, wait=None):
+        self.player = player
+        self.wait = wait
+
+    def count(self, command):
+        self.player.commands[command] = self.player.commands.get(command, 0) + 1
+
+    def status(self):
+        self.count("status")
+        return {key.lower(): value for key, value in self.player.status().items()}
+
+    def currentsong(self):
+        self.count("currentsong")
+        return {key.lower(): value for key, value in self.player.currentsong().items()}
+
+    def playlistid(self, song_id):
+        self.count("playlistid")
+        song = self.player.playlistid(song_id)
+        if len(song) < 1:
+            return []
+        return [{key.lower(): value for key, value in song.items()}]
+
+    def idle(self, *subsystems):
+        self.count("idle")
+        if self.wait is not None:
+            self.wait()
+        else:
+            with self.player.condition:
+                self.player.condition.wait(1)
+        return ["player"]
+
+
+class FakeMPDHandler(socketserver.StreamRequestHandler):
+    """Speaks just enough of the MPD protocol for python-mpd2: status, currentsong, playlistid, idle and noidle"""
+
+    def handle(self):
+        player = self.server.player
+        self.wfile.write(b"OK MPD 0.23.5\n")
+        self.wfile.flush()
+
+        # Lines are read on a thread of their own, so a noidle can interrupt an idle
+        lines = queue.Queue()
+
+        def read():
+            for line in self.rfile:
+                lines.put(line.decode("utf-8").strip())
+            lines.put(None)
+
+        threading.Thread(target=read, name="fake-mpd-reader", daemon=True).start()
+
+        while True:
+            line = lines.get()
+            if line is None:
+                return
+
+            command = line.split(" ")[0]
+            with player.condition:
+                player.commands[command] = player.commands.get(command, 0) + 1
+
+            if command == "close":
+                return
+            elif command == "status":
+                response = player.status()
+            elif command == "currentsong":
+                response = player.currentsong()
+            elif command == "playlistid":
+                response = player.playlistid(line.split(" ")[-1].strip('"'))
+            elif command == "idle":
+                response = self.idle(player, lines)
+                if response is None:
+                    return
+            elif command == "noidle":
+                # Only meaningful while idling, which is handled in idle()
+                continue
+            else:
+                response = {}
+
+            for key, value in response.items():
+                # Multi-valued tags are sent as one line per value
+                for single in value if isinstance(value, list) else [value]:
+                    self.wfile.write("{}: {}\n".format(key, single).encode("utf-8"))
+            self.wfile.write(b"OK\n")
+            self.wfile.flush()
+
+    def idle(self, player, lines):
+        """Wait for the player to change, or for the client to send noidle. None if the client went away"""
+
+        with player.condition:
+            changes = player.changes
+
+        while True:
+            with player.condition:
+                if player.changes != changes:
+                    return {"changed": "player"}
+                player.condition.wait(0.05)
+                if player.changes != changes:
+                    return {"changed": "player"}
+
+            try:
+                line = lines.get_nowait()
+            except queue.Empty:
+                continue
+            if line is None:
+                return None
+            # Anything sent while idling (it should only ever be noidle) ends the idle without any changes
+            return {}
+
+
+class FakeMPD(socketserver.ThreadingTCPServer):
+    """
+    A fake MPD server on localhost, playing player. Runs on a thread of its own once started.
+
+    :param player: The player to serve
+    :type player: benchmarks.fakes.FakePlayer
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, player):
+        super().__init__(("127.0.0.1", 0), FakeMPDHandler)
+        self.player = player
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(
+            target=self.serve_forever, name="fake-mpd", daemon=True
+        ).start()
+        return self
+
+    def close(self):
+        self.player.close()
+        self.shutdown()
+        self.server_close()
+
+
+class FakeLastFMHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, which Nagle + delayed ACKs would hold up by ~40ms
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        parameters = dict(parse_qsl(self.rfile.read(length).decode("utf-8")))
+        self.respond(parameters)
+
+    def do_GET(self):
+        query = self.path.split("?", 1)[1] if "?" in self.path else ""
+        self.respond(dict(parse_qsl(query)))
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def respond(self, parameters):
+        status, body = self.server.handle_call(parameters)
+        content_type = "application/json" if body.startswith("{") else "text/xml"
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "{}; charset=utf-8".format(content_type))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeLastFM(http.server.ThreadingHTTPServer):
+    """
+    A fake Last.FM 2.0 API on localhost, handling track.scrobble and track.updateNowPlaying, answering
+    in JSON when asked to (format=json) and XML otherwise. Every call is recorded in 'calls', as (time
+    received, method, tracks scrobbled), and the ones failed on purpose are counted in 'failures'. Only
+    the scrobbled tracks are kept of every call's parameters, so long runs don't weigh down the process
+    they're measuring.
+
+    :param latency: (Optional) Seconds to wait before answering every call
+    :param error_code: (Optional) The Last.FM error code to fail calls with, e.g. 11 (service offline) or 29 (rate limited)
+    :param error_rate: (Optional) The fraction of calls to fail with error_code, between 0 and 1
+    :param ignored: (Optional) How many of the scrobbles in every track.scrobble call to report as ignored
+    :param seed: (Optional) Seeds the choice of which calls fail
+    :param xml_only: (Optional) Always answer in XML, like services without JSON
+
+    :type latency: float
+    :type error_code: int
+    :type error_rate: float
+    :type ignored: int
+    :type seed: int
+    :type xml_only: bool
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        latency=0,
+        error_code=None,
+        error_rate=0,
+        ignored=0,
+        seed=0,
+        xml_only=False,
+    ):
+        super().__init__(("127.0.0.1", 0), FakeLastFMHandler)
+        self.latency = latency
+        self.error_code = error_code
+        self.error_rate = error_rate
+        self.ignored = ignored
+        self.random = random.Random(seed)
+        self.xml_only = xml_only
+
+        self.lock = threading.Lock()
+        self.calls = []
+        self.failures = 0
+        self.failed_calls = set()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/2.0/".format(self.server_address[1])
+
+    def start(self):
+        threading.Thread(
+            target=self.serve_forever, name="fake-lastfm", daemon=True
+        ).start()
+        return self
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_call(self, parameters):
+        """
+        :return: The HTTP status and XML (or JSON) body to answer the call with
+        :rtype: (int,str)
+        """
+
+        received = time.time()
+        method = parameters.get("method", "")
+        as_json = parameters.get("format") == "json" and not self.xml_only
+        with self.lock:
+            tracks = scrobbled_tracks(parameters) if method == "track.scrobble" else []
+            self.calls.append((received, method, tracks))
+            failing = (
+                self.error_code is not None and self.random.random() < self.error_rate
+            )
+            if failing:
+                self.failures += 1
+                self.failed_calls.add(len(self.calls) - 1)
+
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        if failing and as_json:
+            return ERROR_STATUSES.get(self.error_code, 400), json.dumps(
+                {"error": self.error_code, "message": "Fake failure"}
+            )
+        if failing:
+            return ERROR_STATUSES.get(self.error_code, 400), (
+                '<?xml version="1.0" encoding="utf-8"?>\n'
+                '<lfm status="failed"><error code="{}">Fake failure</error></lfm>'
+            ).format(self.error_code)
+
+        if method == "track.scrobble":
+            tracks = scrobbled_tracks(parameters)
+            respond = scrobble_response_json if as_json else scrobble_response_xml
+            return 200, respond(tracks, min(self.ignored, len(tracks)))
+        if method == "track.updateNowPlaying" and as_json:
+            return 200, json.dumps(
+                {
+                    "nowplaying": {
+                        "track": {"corrected": "0", "#text": parameters.get("track")},
+                        "artist": {
+                            "corrected": "0",
+                            "#text": parameters.get("artist"),
+                        },
+                    }
+                }
+            )
+        if method == "track.updateNowPlaying":
+            return 200, (
+                '<?xml version="1.0" encoding="utf-8"?>\n'
+                '<lfm status="ok"><nowplaying><track corrected="0">{}</track>'
+                '<artist corrected="0">{}</artist></nowplaying></lfm>'
+            ).format(
+                xml.sax.saxutils.escape(parameters.get("track", "")),
+                xml.sax.saxutils.escape(parameters.get("artist", "")),
+            )
+        if as_json:
+            return 400, json.dumps({"error": 3, "message": "Invalid Method"})
+        return 400, (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<lfm status="failed"><error code="3">Invalid Method</error></lfm>'
+        )
+
+    def scrobbles(self):
+        """
+        :return: Every scrobble accepted, as (time received, track, artist, timestamp), in the order received
+        :rtype: list
+        """
+
+        with self.lock:
+            calls = [
+                call
+                for index, call in enumerate(self.calls)
+                if index not in self.failed_calls
+            ]
+        return [
+            (received, track, artist, timestamp)
+            for received, method, tracks in calls
+            if method == "track.scrobble"
+            for track, artist, timestamp in tracks
+        ]
+
+
+def scrobbled_tracks(parameters):
+    """
+    :return: The (track, artist, timestamp) of every track in a track.scrobble call's parameters, single or batched
+    :rtype: list
+    """
+
+    if "track" in parameters:
+        return [(parameters["track"], parameters["artist"], parameters["timestamp"])]
+
+    tracks = []
+    index = 0
+    while "track[{}]".format(index) in parameters:
+        tracks.append(
+            (
+                parameters["track[{}]".format(index)],
+                parameters["artist[{}]".format(index)],
+                parameters["timestamp[{}]".format(index)],
+            )
+        )
+        index += 1
+    return tracks
+
+
+def scrobble_response_xml(tracks, ignored=0):
+    """
+    :param tracks: The (track, artist, timestamp) of every track scrobbled, see scrobbled_tracks
+    :param ignored: (Optional) How many of them (from the start) to report as ignored
+
+    :type tracks: list
+    :type ignored: int
+
+    :return: Last.FM's XML answer to a track.scrobble call
+    :rtype: str
+    """
+
+    entries = []
+    for index, (track, artist, timestamp) in enumerate(tracks):
+        entries.append(
+            '<scrobble><track corrected="0">{}</track><artist corrected="0">{}</artist>'
+            '<timestamp>{}</timestamp><ignoredMessage code="{}"></ignoredMessage></scrobble>'.format(
+                xml.sax.saxutils.escape(track),
+                xml.sax.saxutils.escape(artist),
+                timestamp,
+                1 if index < ignored else 0,
+            )
+        )
+
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<lfm status="ok"><scrobbles accepted="{}" ignored="{}">{}</scrobbles></lfm>'
+    ).format(len(tracks) - ignored, ignored, "".join(entries))
+
+
+def scrobble_response_json(tracks, ignored=0):
+    """
+    :param tracks: The (track, artist, timestamp) of every track scrobbled, see scrobbled_tracks
+    :param ignored: (Optional) How many of them (from the start) to report as ignored
+
+    :type tracks: list
+    :type ignored: int
+
+    :return: Last.FM's JSON answer to a track.scrobble call
+    :rtype: str
+    """
+
+    entries = [
+        {
+            "track": {"corrected": "0", "#text": track},
+            "artist": {"corrected": "0", "#text": artist},
+            "timestamp": timestamp,
+            "ignoredMessage": {"code": "1" if index < ignored else "0"},
+        }
+        for index, (track, artist, timestamp) in enumerate(tracks)
+    ]
+
+    # Like Last.FM, a single scrobble isn't wrapped in a list
+    return json.dumps(
+        {
+            "scrobbles": {
+                "scrobble": entries[0] if len(entries) == 1 else entries,
+                "@attr": {"accepted": len(tracks) - ignored, "ignored": ignored},
+            }
+        }
+    )
+
+
+def make_playlist(count, duration, start=0):
+    """
+    :param count: The amount of tracks
+    :param duration: Every track's duration, in seconds
+    :param start: (Optional) The number of the first track
+
+    :type count: int
+    :type duration: float
+    :type start: int
+
+    :return: A playlist for a FakePlayer, every track with its own title
+    :rtype: list
+    """
+
+    return [
+        {
+            "file": "Artist {0}/Album {1}/Track {2}.flac".format(
+                index % 13, index % 31, index
+            ),
+            "Title": "Track {}".format(index),
+            "Artist": "Artist {}".format(index % 13),
+            "Album": "Album {}".format(index % 31),
+            "AlbumArtist": "Artist {}".format(index % 13),
+            "Track": str(index % 12 + 1),
+            "duration": duration,
+        }
+        for index in range(start, start + count)
+    ]
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+End-to-end load harness: plays a scripted playlist on a fake MPD server, runs YAMS against it (and a fake
+Last.FM), then reports how long scrobbles took to arrive, how many requests were made, and how much CPU
+YAMS used, scaled to an hour of playback. From the root of the repository:
+
+    python -m benchmarks.load                                  # 12 tracks of 20s, through cli_run
+    python -m benchmarks.load --latency 2 --error-code 11 --error-rate 0.3
+    python -m benchmarks.load --mode watcher --json load.json  # through mpd_watch_track, in-process
+
+'daemon' mode runs the real `python -m yams` (so cli_run, in the foreground) against a throwaway config,
+and measures that process alone. 'watcher' mode runs mpd_watch_track on a thread of this process, which
+is quicker to poke at, but its CPU figures include the fakes.
+"""
+
+import argparse
+import os
+from pathlib import Path
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import psutil
+import yaml
+
+from yams.configure import DEFAULTS
+
+from benchmarks.common import compare, quiet_logging, read_results, write_results
+from benchmarks.fakes import FakeLastFM, FakeMPD, FakePlayer, make_playlist
+
+SESSION_USER = "harness"
+SESSION_KEY = "d580d57f32848f5dcf574d1ce18d78b2"
+
+
+def harness_config(directory, mpd_port, base_url, options):
+    """
+    :return: A complete YAMS config pointing at the fakes, keeping every file YAMS writes inside directory
+    :rtype: dict
+    """
+
+    session_file = str(Path(directory, "session"))
+    with open(session_file, "w") as session_stream:
+        session_stream.write("{}\n{}\n".format(SESSION_USER, SESSION_KEY))
+
+    config = dict(DEFAULTS)
+    config.update(
+        {
+            "mpd_host": "127.0.0.1",
+            "mpd_port": mpd_port,
+            "base_url": base_url,
+            "session_file": session_file,
+            "cache_file": str(Path(directory, "scrobbles.cache")),
+            "pid_file": str(Path(directory, "yams.pid")),
+            "log_file": str(Path(directory, "yams.log")),
+            "runtime": options.runtime,
+            "cache_backend": options.cache_backend,
+        }
+    )
+    return config
+
+
+def run_daemon(config, directory, duration, player):
+    """
+    Run `python -m yams` in the foreground for duration seconds, after which it's interrupted
+
+    :return: The CPU seconds the daemon used
+    :rtype: float
+    """
+
+    config_path = str(Path(directory, "yams.yml"))
+    with open(config_path, "w") as config_stream:
+        yaml.dump(config, config_stream, default_flow_style=False)
+
+    # Keep YAMS from touching the real config, state and cache directories
+    environment = dict(os.environ, NON_INTERACTIVE="1")
+    for variable in (
+        "XDG_CONFIG_HOME",
+        "XDG_STATE_HOME",
+        "XDG_CACHE_HOME",
+        "XDG_RUNTIME_DIR",
+    ):
+        environment[variable] = str(Path(directory, variable.lower()))
+        Path(environment[variable]).mkdir()
+
+    daemon = subprocess.Popen(
+        [sys.executable, "-m", "yams", "-N", "-C", config_path],
+        env=environment,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    process = psutil.Process(daemon.pid)
+
+    player.play(0)
+    time.sleep(duration)
+
+    times = process.cpu_times()
+    cpu = times.user + times.system
+    daemon.send_signal(signal.SIGINT)
+    try:
+        daemon.wait(30)
+    except subprocess.TimeoutExpired:
+        daemon.kill()
+    return cpu
+
+
+def run_watcher(config, directory, duration, player):
+    """
+    Run mpd_watch_track on a thread for duration seconds
+
+    :return: The CPU seconds this process (YAMS and the fakes) used
+    :rtype: float
+    """
+
+    from yams.scrobble import connect_to_mpd, mpd_watch_track
+    from yams.transport import transport_from_config
+
+    quiet_logging()
+    process = psutil.Process()
+    before = process.cpu_times()
+
+    client = connect_to_mpd(config["mpd_host"], config["mpd_port"])
+    transport = transport_from_config(config)
+    threading.Thread(
+        target=mpd_watch_track,
+        args=(client, SESSION_KEY, config, transport),
+        name="yams-watcher",
+        daemon=True,
+    ).start()
+
+    player.play(0)
+    time.sleep(duration)
+
+    after = process.cpu_times()
+    return (after.user + after.system) - (before.user + before.system)
+
+
+def expected_scrobble_time(start, duration, config):
+    """When a track started at 'start' should be scrobbled, going by the config's thresholds"""
+
+    return start + max(
+        duration * config["scrobble_threshold"] / 100,
+        config["scrobble_min_time"],
+        config["watch_threshold"],
+    )
+
+
+def percentile(values, fraction):
+    if len(values) < 1:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def report(options, config, player, lastfm, cpu, played):
+    """
+    :return: The results of a run, ready to be written out as JSON
+    :rtype: dict
+    """
+
+    # The scrobbles we should have seen: tracks that played past their scrobble point
+    expected = {}
+    starts = player.track_starts
+    for number, (start, index) in enumerate(starts):
+        track = player.playlist[index]
+        ended = starts[number + 1][0] if number + 1 < len(starts) else start + played
+        scrobble_at = expected_scrobble_time(start, track["duration"], config)
+        if scrobble_at <= min(ended, start + track["duration"]):
+            expected[track["Title"]] = scrobble_at
+
+    latencies = []
+    received = set()
+    for arrived, track, artist, timestamp in lastfm.scrobbles():
+        if track in expected and track not in received:
+            received.add(track)
+            latencies.append(arrived - expected[track])
+
+    requests = {}
+    for arrived, method, tracks in lastfm.calls:
+        requests[method] = requests.get(method, 0) + 1
+
+    per_hour = 3600 / played
+    return {
+        "expected_scrobbles": len(expected),
+        "received_scrobbles": len(received),
+        "duplicate_scrobbles": len(lastfm.scrobbles()) - len(received),
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_max": max(latencies) if len(latencies) > 0 else None,
+        "latency_mean": statistics.mean(latencies) if len(latencies) > 0 else None,
+        "requests": requests,
+        "failed_requests": lastfm.failures,
+        "requests_per_hour": sum(requests.values()) * per_hour,
+        "mpd_commands": dict(player.commands),
+        "mpd_commands_per_hour": sum(player.commands.values()) * per_hour,
+        "cpu_seconds": cpu,
+        "cpu_seconds_per_hour": cpu * per_hour,
+        "played_seconds": played,
+    }
+
+
+def print_report(results):
+    for key, value in results.items():
+        if isinstance(value, float):
+            value = "{:.4f}".format(value)
+        print("{:<24} {}".format(key, value))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run YAMS end-to-end against fake MPD and Last.FM servers."
+    )
+    parser.add_argument("--mode", choices=["daemon", "watcher"], default="daemon")
+    parser.add_argument(
+        "--runtime", choices=["blocking", "asyncio"], default="blocking"
+    )
+    parser.add_argument(
+        "--cache-backend", choices=["log", "sqlite", "yaml"], default="log"
+    )
+    parser.add_argument(
+        "--tracks", type=int, default=12, help="Tracks to play. Default: 12"
+    )
+    parser.add_argument(
+        "--track-length",
+        type=float,
+        default=20,
+        help="Seconds every track lasts. Default: 20",
+    )
+    parser.add_argument(
+        "--grace",
+        type=float,
+        default=15,
+        help="Seconds to keep running after the playlist ends, for late scrobbles. Default: 15",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0, help="Seconds Last.FM takes to answer"
+    )
+    parser.add_argument(
+        "--error-code", type=int, help="The Last.FM error code to fail calls with"
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=1.0,
+        help="The fraction of calls failed with --error-code. Default: 1",
+    )
+    parser.add_argument(
+        "--ignored",
+        type=int,
+        default=0,
+        help="Scrobbles to report as ignored in every track.scrobble response",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seeds which calls fail. Default: 0"
+    )
+    parser.add_argument(
+        "--json",
+        metavar="PATH",
+        help='Write the results as JSON to PATH ("-" for stdout)',
+    )
+    parser.add_argument(
+        "--baseline", help="A previous --json output to compare the results against"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.5,
+        help="How many times more requests or CPU than the baseline counts as a regression. Default: 1.5",
+    )
+    args = parser.parse_args()
+
+    player = FakePlayer(make_playlist(args.tracks, args.track_length))
+    mpd = FakeMPD(player).start()
+    lastfm = FakeLastFM(
+        args.latency, args.error_code, args.error_rate, args.ignored, args.seed
+    ).start()
+
+    duration = args.tracks * args.track_length + args.grace
+    print(
+        "Playing {} tracks of {}s through {} mode, this takes {:.0f}s...".format(
+            args.tracks, args.track_length, args.mode, duration
+        ),
+        file=sys.stderr,
+    )
+
+    with tempfile.TemporaryDirectory(prefix="yams-load-") as directory:
+        config = harness_config(directory, mpd.port, lastfm.url, args)
+        if args.mode == "daemon":
+            cpu = run_daemon(config, directory, duration, player)
+        else:
+            cpu = run_watcher(config, directory, duration, player)
+
+    played = min(duration, args.tracks * args.track_length)
+    results = report(args, config, player, lastfm, cpu, played)
+    mpd.close()
+    lastfm.close()
+
+    print_report(results)
+
+    if args.json:
+        write_results(
+            args.json,
+            {"load": results},
+            {"options": vars(args)},
+        )
+
+    failed = results["received_scrobbles"] < results["expected_scrobbles"]
+    if failed:
+        print("Some scrobbles never arrived!")
+
+    if args.baseline:
+        # Only the per-hour costs are comparable between runs of different lengths
+        def costs(load):
+            return {
+                key: {"value": value}
+                for key, value in load.items()
+                if key.endswith("_per_hour")
+            }
+
+        baseline = {"results": costs(read_results(args.baseline)["results"]["load"])}
+        if len(compare(costs(results), baseline, "value", args.threshold)) > 0:
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for the hot paths of building, signing and caching scrobbles. Runs offline, no MPD or
+network needed. From the root of the repository:
+
+    python -m benchmarks.micro                      # compare against benchmarks/baseline.json
+    python -m benchmarks.micro --json results.json  # also save the results, machine-readable
+    python -m benchmarks.micro --save-baseline      # make these results the new baseline
+
+Exits with a non-zero status if anything got slower than the baseline by more than --threshold times.
+Baselines are only comparable on the machine they were recorded on, re-record one before comparing.
+
+The cache is benchmarked at backlogs of up to 10,000 scrobbles by default. --full goes all the way up to
+1,000,000, which needs a lot of time (tens of minutes) and memory (upwards of 10GB) with the YAML cache.
+"""
+
+import argparse
+import os
+from pathlib import Path
+import sys
+import tempfile
+
+from yams.cache import (
+    read_failed_scrobbles_from_disk,
+    save_failed_scrobbles_to_disk,
+    truncate_pending_scrobbles_list,
+)
+from yams.responses import parse_response
+from yams.scrobble import (
+    MAX_TRACKS_PER_SCROBBLE,
+    TrackRecord,
+    build_scrobble_parameters,
+    extract_single,
+    make_scrobble,
+    sign_signature,
+)
+
+from benchmarks.common import (
+    STATUS,
+    compare,
+    make_backlog,
+    make_song,
+    measure,
+    quiet_logging,
+    read_results,
+    write_results,
+)
+from benchmarks.fakes import (
+    scrobble_response_json,
+    scrobble_response_xml,
+    scrobbled_tracks,
+)
+
+BASELINE = str(Path(__file__).with_name("baseline.json"))
+SIZES = [10, 100, 1000, 10000]
+QUICK_SIZES = [10, 100, 1000]
+FULL_SIZES = [10, 100, 1000, 10000, 100000, 1000000]
+
+API_KEY = "293ef0836603c5c8023ba86eb413794b"
+API_SECRET = "e952c611efe32c66f2b48a93b39d6219"
+SESSION_KEY = "d580d57f32848f5dcf574d1ce18d78b2"
+
+
+def function_benchmarks():
+    """
+    :return: A dictionary of benchmark name to the function to time, for everything that doesn't depend on backlog size
+    :rtype: dict
+    """
+
+    song = make_song(1)
+    multi_valued_song = dict(song, artist=["Artist 1", "Artist 2"])
+    prepared_song = TrackRecord(song)
+    batch = make_backlog(MAX_TRACKS_PER_SCROBBLE)
+    now_playing_parameters = make_scrobble(
+        song, STATUS, api_key=API_KEY, sk=SESSION_KEY, method="track.updateNowPlaying"
+    )
+    batch_parameters, count = build_scrobble_parameters(
+        batch, API_KEY, API_SECRET, SESSION_KEY
+    )
+    del batch_parameters["api_sig"]
+    batch_tracks = scrobbled_tracks(batch_parameters)
+    xml_response = scrobble_response_xml(batch_tracks).encode("utf-8")
+    json_response = scrobble_response_json(batch_tracks).encode("utf-8")
+
+    return {
+        "extract_single": lambda: extract_single(song, "artist"),
+        "extract_single[multi-valued]": lambda: extract_single(
+            multi_valued_song, "artist"
+        ),
+        "make_scrobble": lambda: make_scrobble(song, STATUS, timestamp=1600000000),
+        "make_scrobble[prepared]": lambda: make_scrobble(
+            prepared_song, STATUS, timestamp=1600000000
+        ),
+        "make_scrobble[signed]": lambda: make_scrobble(
+            song,
+            STATUS,
+            api_secret=API_SECRET,
+            timestamp=1600000000,
+            api_key=API_KEY,
+            sk=SESSION_KEY,
+            method="track.scrobble",
+        ),
+        "sign_signature[tracks=1]": lambda: sign_signature(
+            now_playing_parameters, API_SECRET
+        ),
+        "sign_signature[tracks={}]".format(
+            MAX_TRACKS_PER_SCROBBLE
+        ): lambda: sign_signature(batch_parameters, API_SECRET),
+        "build_scrobble_parameters[tracks={}]".format(
+            MAX_TRACKS_PER_SCROBBLE
+        ): lambda: build_scrobble_parameters(batch, API_KEY, API_SECRET, SESSION_KEY),
+        "parse_response[xml,tracks={}]".format(
+            MAX_TRACKS_PER_SCROBBLE
+        ): lambda: parse_response(xml_response).scrobble_counts(),
+        "parse_response[json,tracks={}]".format(
+            MAX_TRACKS_PER_SCROBBLE
+        ): lambda: parse_response(json_response).scrobble_counts(),
+    }
+
+
+def cache_benchmarks(size, directory):
+    """
+    :param size: The amount of scrobbles in the cache
+    :param directory: Where to write cache files
+
+    :type size: int
+    :type directory: str
+
+    :return: A dictionary of benchmark name to the function to time, for the cache functions at one backlog size
+    :rtype: dict
+    """
+
+    backlog = make_backlog(size)
+    save_path = os.path.join(directory, "save-{}.cache".format(size))
+    read_path = os.path.join(directory, "read-{}.cache".format(size))
+    truncate_path = os.path.join(directory, "truncate-{}.cache".format(size))
+    save_failed_scrobbles_to_disk(read_path, backlog)
+
+    return {
+        "save_failed_scrobbles_to_disk[n={}]".format(
+            size
+        ): lambda: save_failed_scrobbles_to_disk(save_path, backlog),
+        "read_failed_scrobbles_from_disk[n={}]".format(
+            size
+        ): lambda: read_failed_scrobbles_from_disk(read_path),
+        # Acknowledging one full batch, what happens after every successful mass scrobble
+        "truncate_pending_scrobbles_list[n={}]".format(
+            size
+        ): lambda: truncate_pending_scrobbles_list(
+            MAX_TRACKS_PER_SCROBBLE, backlog, truncate_path
+        ),
+    }
+
+
+def run(sizes, name_filter=None, repeat=5, budget=2.0):
+    """
+    :return: A dictionary of benchmark name to its measurements (seconds per call)
+    :rtype: dict
+    """
+
+    def selected(benchmarks):
+        return {
+            name: function
+            for name, function in benchmarks.items()
+            if name_filter is None or name_filter in name
+        }
+
+    results = {}
+
+    def time_all(benchmarks, size=None):
+        for name, function in selected(benchmarks).items():
+            print("Running {}...".format(name), file=sys.stderr)
+            results[name] = measure(function, repeat, budget)
+            results[name]["size"] = size
+
+    time_all(function_benchmarks())
+
+    with tempfile.TemporaryDirectory(prefix="yams-benchmarks-") as directory:
+        for size in sizes:
+            benchmarks = selected(cache_benchmarks(size, directory))
+            if len(benchmarks) > 0:
+                time_all(benchmarks, size)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Microbenchmarks for building, signing and caching scrobbles."
+    )
+    parser.add_argument(
+        "--sizes",
+        type=lambda sizes: [int(size) for size in sizes.split(",")],
+        default=SIZES,
+        help="Comma separated backlog sizes to benchmark the cache at. Default: {}".format(
+            ",".join(str(size) for size in SIZES)
+        ),
+    )
+    parser.add_argument(
+        "--quick",
+        action="store_true",
+        help="Only benchmark the cache at small backlog sizes ({})".format(
+            ",".join(str(size) for size in QUICK_SIZES)
+        ),
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Benchmark the cache at every backlog size from {} to {}".format(
+            FULL_SIZES[0], FULL_SIZES[-1]
+        ),
+    )
+    parser.add_argument(
+        "-k", "--filter", help="Only run benchmarks whose name contains this"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="The maximum amount of runs per benchmark"
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=2.0,
+        help="Seconds per benchmark after which no more runs are started",
+    )
+    parser.add_argument(
+        "--json",
+        metavar="PATH",
+        help='Write the results as JSON to PATH ("-" for stdout)',
+    )
+    parser.add_argument(
+        "--baseline",
+        default=BASELINE,
+        help="The results to compare against. Default: {}".format(BASELINE),
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Write the results to the baseline file instead of comparing against it",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.5,
+        help="How many times slower than the baseline counts as a regression. Default: 1.5",
+    )
+    args = parser.parse_args()
+
+    quiet_logging()
+    sizes = args.sizes
+    if args.quick:
+        sizes = QUICK_SIZES
+    elif args.full:
+        sizes = FULL_SIZES
+    results = run(sizes, args.filter, args.repeat, args.budget)
+
+    if args.json:
+        write_results(args.json, results)
+
+    if args.save_baseline:
+        write_results(args.baseline, results)
+        print("Baseline written to {}".format(args.baseline))
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline at {}, nothing to compare to.".format(args.baseline))
+        return 0
+
+    regressions = compare(results, read_results(args.baseline), "best", args.threshold)
+    if len(regressions) > 0:
+        print("{} benchmark(s) regressed!".format(len(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+Replays a recording of MPD's responses (made with `yams --record-mpd PATH`) through mpd_watch_track, as
+fast as it'll go, and reports every decision it made (now playing updates and scrobbles) along with what
+every iteration of the watcher cost. Nothing is sent anywhere. From the root of the repository:
+
+    python -m benchmarks.replay mpd.rec.gz --json before.json   # on the old version
+    python -m benchmarks.replay mpd.rec.gz --baseline before.json  # on the new one
+
+Comparing against a baseline flags decisions that changed and iterations that got more expensive, and
+exits with a non-zero status if there are any.
+
+The watcher sees MPD as it was at the recorded moment nearest before it asks, with elapsed times moved
+along since then, so versions that poll MPD differently can be replayed against the same recording.
+Changes are only as precise as the recording though: idle responses are exact, but a skip noticed by
+polling is dated to the poll that noticed it.
+"""
+
+import argparse
+import bisect
+import sys
+
+import yaml
+
+from yams.configure import DEFAULTS
+from yams.recording import read_recording
+from yams.scrobble import TrackWatcher, extract_single, mpd_watch_track
+
+from benchmarks.common import (
+    compare,
+    measure,
+    quiet_logging,
+    read_results,
+    write_results,
+)
+from benchmarks.fakes import VirtualClock
+
+
+class EndOfRecording(Exception):
+    pass
+
+
+def rewound(status):
+    """
+    :return: A copy of status, as it would have been the moment its track started
+    :rtype: dict
+    """
+
+    status = dict(status, elapsed="0.000")
+    if "time" in status:
+        status["time"] = "0:" + status["time"].split(":")[-1]
+    return status
+
+
+class ReplayMPDClient:
+    """
+    Stands in for mpd.MPDClient, answering from a recording on a virtual clock: status and currentsong
+    with the latest response recorded at (or before) the current time, idle by moving the clock on to
+    the next recorded change. currentsong and playlistid answer with the recorded track that has the
+    song id asked about, if there is one, since tracks fetched ahead of time were never asked for with
+    currentsong.
+
+    :param responses: The recording, as returned by yams.recording.read_recording
+    :param clock: The clock the watcher runs on, starting at the recording's first response
+
+    :type responses: list
+    :type clock: benchmarks.fakes.VirtualClock
+    """
+
+    def __init__(self, responses, clock):
+        self.clock = clock
+        self.commands = 0
+
+        self.status_times, self.statuses = [], []
+        self.song_times, self.songs = [], []
+        # Song id -> the track, from currentsong and playlistid
+        self.songs_by_id = {}
+        changes = set()
+
+        last_state = None
+        last_response = responses[0][0]
+        # When the track in the latest status really started, if that was before we heard of it
+        started = None
+        for when, command, response in responses:
+            if command == "status":
+                state = (response.get("state"), response.get("songid"))
+                if last_state is not None and state != last_state:
+                    changes.add(when)
+                    started = self.started(when, response, last_response)
+                    if started is not None:
+                        changes.add(started)
+                        self.status_times.append(started)
+                        self.statuses.append(rewound(response))
+                last_state = state
+                self.status_times.append(when)
+                self.statuses.append(response)
+            elif command == "currentsong":
+                if started is not None:
+                    self.song_times.append(started)
+                    self.songs.append(response)
+                    started = None
+                self.song_times.append(when)
+                self.songs.append(response)
+                self.remember(response)
+            elif command == "playlistid":
+                for song in response:
+                    self.remember(song)
+            elif command == "idle" and len(response) > 0:
+                # An empty response is an idle cut short by noidle, when nothing changed
+                changes.add(when)
+            last_response = when
+
+        if len(self.statuses) < 1:
+            raise ValueError("The recording has no status responses to replay")
+
+        self.changes = sorted(changes)
+        self.start = responses[0][0]
+        self.end = responses[-1][0]
+
+    def remember(self, song):
+        if "id" in song:
+            self.songs_by_id[song["id"]] = song
+
+    def started(self, when, status, previous):
+        """
+        A track noticed by polling started a while before the poll, as its elapsed time tells. Date it
+        back to then, so the watcher sees it as early as the daemon could have, but no earlier than the
+        previous response (when it wasn't playing yet, as far as we know).
+
+        :return: When the track started playing, or None if it's not playing or that's when we heard of it
+        :rtype: float
+        """
+
+        if status.get("state") != "play" or "elapsed" not in status:
+            return None
+        started = max(when - float(status["elapsed"]), previous)
+        return started if started < when else None
+
+    def latest(self, times, responses):
+        now = self.clock.time()
+        if now > self.end:
+            raise EndOfRecording()
+        return responses[max(bisect.bisect_right(times, now) - 1, 0)]
+
+    def status(self):
+        self.commands += 1
+        status = dict(self.latest(self.status_times, self.statuses))
+        if status.get("state") != "play":
+            return status
+
+        # Move playback along by however long it's been since this was recorded
+        index = max(bisect.bisect_right(self.status_times, self.clock.time()) - 1, 0)
+        since = self.clock.time() - self.status_times[index]
+        if "elapsed" in status:
+            elapsed = float(status["elapsed"]) + since
+            if "duration" in status:
+                elapsed = min(elapsed, float(status["duration"]))
+            status["elapsed"] = "{:.3f}".format(elapsed)
+        if "time" in status and ":" in status["time"]:
+            elapsed, total = status["time"].split(":")
+            elapsed = int(elapsed) + int(since)
+            if int(total) > 0:
+                elapsed = min(elapsed, int(total))
+            status["time"] = "{}:{}".format(elapsed, total)
+        return status
+
+    def currentsong(self):
+        self.commands += 1
+        status = self.latest(self.status_times, self.statuses)
+        if (
+            status.get("state") in ("play", "pause")
+            and status.get("songid") in self.songs_by_id
+        ):
+            return dict(self.songs_by_id[status["songid"]])
+        if len(self.songs) < 1:
+            return {}
+        return dict(self.latest(self.song_times, self.songs))
+
+    def playlistid(self, song_id):
+        self.commands += 1
+        if song_id not in self.songs_by_id:
+            return []
+        return [dict(self.songs_by_id[song_id])]
+
+    def idle(self, *subsystems):
+        self.commands += 1
+        upcoming = bisect.bisect_right(self.changes, self.clock.time())
+        if upcoming >= len(self.changes):
+            raise EndOfRecording()
+        self.clock.advance_to(self.changes[upcoming])
+        return ["player"]
+
+
+class DecisionLog:
+    """Takes the watcher's requests in place of the submission workers, noting them down instead of sending them"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.decisions = []
+
+    def note(self, action, song, timestamp=None):
+        decision = {
+            "time": self.clock.time(),
+            "action": action,
+            "artist": extract_single(song, "artist"),
+            "title": extract_single(song, "title"),
+        }
+        if timestamp is not None:
+            decision["timestamp"] = timestamp
+        self.decisions.append(decision)
+
+    def now_playing(self, song, status):
+        self.note(TrackWatcher.NOW_PLAYING, song)
+
+    def warm(self):
+        pass
+
+    def scrobble(self, song, status, timestamp):
+        self.note(TrackWatcher.SCROBBLE, song, timestamp)
+
+
+def replay(responses, config):
+    """
+    Replay a recording through mpd_watch_track once
+
+    :return: The decisions made, and the amount of watcher iterations and MPD commands it took
+    :rtype: (list,int,int)
+    """
+
+    clock = VirtualClock(responses[0][0])
+    client = ReplayMPDClient(responses, clock)
+    decisions = DecisionLog(clock)
+    # Watcher iterations that got as far as sleeping, i.e. ones that saw a track playing
+    iterations = [0]
+
+    def sleep(seconds):
+        iterations[0] += 1
+        clock.sleep(seconds)
+
+    try:
+        mpd_watch_track(
+            client, None, config, None, decisions, clock=clock.time, sleep=sleep
+        )
+    except EndOfRecording:
+        pass
+
+    return decisions.decisions, iterations[0], client.commands
+
+
+def describe(decision):
+    return "{action:<12} {artist} - {title}".format(**decision) + (
+        " @ {:.0f}".format(decision["timestamp"]) if "timestamp" in decision else ""
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a recording of MPD through YAMS' watcher, reporting its decisions and cost."
+    )
+    parser.add_argument("recording", help="A recording made with yams --record-mpd")
+    parser.add_argument(
+        "-C",
+        "--config",
+        help="A YAMS config to replay with, e.g. the one the recording was made with. Default: YAMS' defaults",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="The maximum amount of timed runs, keeping the fastest. Default: 5",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=2.0,
+        help="Seconds after which no more timed runs are started. Default: 2",
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Print every decision"
+    )
+    parser.add_argument(
+        "--json",
+        metavar="PATH",
+        help='Write the results as JSON to PATH ("-" for stdout)',
+    )
+    parser.add_argument(
+        "--baseline",
+        help="A previous --json output to compare the decisions and costs against",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.5,
+        help="How many times more expensive than the baseline counts as a regression. Default: 1.5",
+    )
+    args = parser.parse_args()
+
+    quiet_logging()
+    config = dict(DEFAULTS)
+    if args.config:
+        with open(args.config) as config_stream:
+            config.update(yaml.safe_load(config_stream) or {})
+    # Nothing to record while replaying
+    config["mpd_record_file"] = ""
+
+    responses = read_recording(args.recording)
+    if len(responses) < 1:
+        print("{} is empty, nothing to replay.".format(args.recording))
+        return 1
+
+    decisions, iterations, commands = replay(responses, config)
+    best = measure(lambda: replay(responses, config), args.repeat, args.budget)["best"]
+
+    results = {
+        "recorded_seconds": responses[-1][0] - responses[0][0],
+        "recorded_responses": len(responses),
+        "now_playing": sum(
+            1
+            for decision in decisions
+            if decision["action"] == TrackWatcher.NOW_PLAYING
+        ),
+        "scrobbles": sum(
+            1 for decision in decisions if decision["action"] == TrackWatcher.SCROBBLE
+        ),
+        "iterations": iterations,
+        "mpd_commands": commands,
+        "mpd_commands_per_iteration": commands / max(iterations, 1),
+        "replay_seconds": best,
+        "seconds_per_iteration": best / max(iterations, 1),
+    }
+
+    if args.verbose:
+        for decision in decisions:
+            print(describe(decision))
+    for key, value in results.items():
+        if isinstance(value, float):
+            value = "{:.6g}".format(value)
+        print("{:<28} {}".format(key, value))
+
+    if args.json:
+        write_results(args.json, {"replay": results}, {"decisions": decisions})
+
+    if not args.baseline:
+        return 0
+
+    baseline = read_results(args.baseline)
+    failed = False
+
+    before = [describe(decision) for decision in baseline["decisions"]]
+    after = [describe(decision) for decision in decisions]
+    if before != after:
+        failed = True
+        print("Decisions changed:")
+        for decision in before:
+            if decision not in after:
+                print("  - {}".format(decision))
+        for decision in after:
+            if decision not in before:
+                print("  + {}".format(decision))
+
+    def costs(replayed):
+        return {
+            key: {"value": replayed[key]}
+            for key in ("mpd_commands_per_iteration", "seconds_per_iteration")
+        }
+
+    if (
+        len(
+            compare(
+                costs(results),
+                {"results": costs(baseline["results"]["replay"])},
+                "value",
+                args.threshold,
+            )
+        )
+        > 0
+    ):
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
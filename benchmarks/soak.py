@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+"""
+Soak test: simulates weeks of listening, with skips, seeks, pauses, repeated tracks and Last.FM outages,
+on a virtual clock, so it takes minutes instead of weeks. YAMS' watcher, submission logic, cache and HTTP
+transport all run for real (against a fake Last.FM), only the waiting is skipped. From the root of the
+repository:
+
+    python -m benchmarks.soak                      # 30 days, 4 hours of listening a day
+    python -m benchmarks.soak --days 90 --json soak.json
+
+Exits with a non-zero status if the daemon went over any of its budgets: memory or file descriptors
+growing over the run, too many bytes written to the cache or HTTP calls made, or scrobbles lost or
+sent twice.
+"""
+
+import argparse
+import queue
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import psutil
+
+from yams.cache import open_scrobble_store
+from yams.configure import DEFAULTS
+from yams.metrics import METRICS
+from yams.scrobble import (
+    SubmissionWorker,
+    mpd_watch_track,
+    retry_delay,
+    retry_failed_scrobbles,
+)
+from yams.transport import transport_from_config
+
+from benchmarks.common import quiet_logging, write_results
+from benchmarks.fakes import FakeLastFM, FakeMPDClient, FakePlayer, VirtualClock
+
+SESSION_KEY = "d580d57f32848f5dcf574d1ce18d78b2"
+DAY = 24 * 60 * 60
+MEBIBYTE = 1024 * 1024
+
+
+class InlineSubmitter:
+    """
+    Hands the watcher's requests to a SubmissionWorker, through its queue like the watcher would, and has the
+    worker handle them straight away on the watcher's thread. Also re-sends failed scrobbles whenever the worker
+    would (see yams.scrobble.retry_delay) while any are cached - what the worker's own thread would do, but on
+    the virtual clock.
+    """
+
+    def __init__(self, worker, clock):
+        self.worker = worker
+        self.clock = clock
+        self.retry_scheduled = False
+
+    def now_playing(self, song, status):
+        self.worker.now_playing(song, status)
+        self.drain()
+
+    def drain(self):
+        while True:
+            try:
+                intent = self.worker.intents.get_nowait()
+            except queue.Empty:
+                break
+            self.worker.handle(*intent)
+
+    def warm(self):
+        self.worker.warm()
+        self.drain()
+
+    def scrobble(self, song, status, timestamp):
+        self.worker.scrobble(song, status, timestamp)
+        self.drain()
+        self.schedule_retry()
+
+    def schedule_retry(self):
+        if len(self.worker.failed_scrobbles) > 0 and not self.retry_scheduled:
+            self.retry_scheduled = True
+            self.clock.at(
+                self.clock.time()
+                + retry_delay(self.worker.config, self.worker.transport),
+                self.retry,
+            )
+
+    def retry(self):
+        self.retry_scheduled = False
+        retry_failed_scrobbles(
+            self.worker.failed_scrobbles,
+            self.worker.session,
+            self.worker.config,
+            self.worker.transport,
+            self.worker.sessions,
+        )
+        self.schedule_retry()
+
+
+class Outages:
+    """Makes the fake Last.FM fail every call while at least one outage is going on"""
+
+    def __init__(self, lastfm, error_code=11):
+        self.lastfm = lastfm
+        self.error_code = error_code
+        self.ongoing = 0
+        self.seconds = 0
+
+    def begin(self):
+        self.ongoing += 1
+        self.lastfm.error_code = self.error_code
+        self.lastfm.error_rate = 1.0
+
+    def end(self):
+        self.ongoing -= 1
+        if self.ongoing < 1:
+            self.lastfm.error_code = None
+
+
+def add_track(player, rng):
+    index = len(player.playlist)
+    player.playlist.append(
+        {
+            "Title": "Track {}".format(index),
+            "Artist": "Artist {}".format(index % 53),
+            "Album": "Album {}".format(index % 211),
+            "Track": str(index % 12 + 1),
+            "duration": rng.uniform(90, 420),
+        }
+    )
+    return index
+
+
+def script_listening(clock, player, outages, rng, options, start):
+    """
+    Schedule every day's listening session on the clock, track by track, along with the day's outages
+
+    :return: The amount of seconds of listening scheduled
+    :rtype: float
+    """
+
+    listened = 0
+    for day in range(options.days):
+        midnight = start + day * DAY
+
+        if rng.random() < options.outage_rate:
+            outage_start = midnight + rng.uniform(0, DAY)
+            outage_length = rng.uniform(10 * 60, options.max_outage * 60 * 60)
+            outages.seconds += outage_length
+            clock.at(outage_start, outages.begin)
+            clock.at(outage_start + outage_length, outages.end)
+
+        session_start = midnight + rng.uniform(17, 20) * 60 * 60
+        session_end = session_start + options.hours * 60 * 60
+        now = session_start
+
+        index = add_track(player, rng)
+        clock.at(now, lambda index=index: player.play(index))
+
+        while now < session_end:
+            duration = player.playlist[index]["duration"]
+            behaviour = rng.random()
+
+            if behaviour < 0.10:
+                # Skip it
+                skip_at = rng.uniform(2, duration - 1)
+                clock.at(now + skip_at, player.next)
+                now += skip_at
+            elif behaviour < 0.15:
+                # Seek somewhere
+                seek_at = rng.uniform(10, duration * 0.4)
+                position = rng.uniform(0, duration * 0.9)
+                clock.at(now + seek_at, lambda position=position: player.seek(position))
+                now += seek_at + duration - position
+            elif behaviour < 0.20:
+                # Pause it for a while
+                pause_at = rng.uniform(5, duration - 5)
+                paused_for = rng.uniform(60, 30 * 60)
+                clock.at(now + pause_at, player.pause)
+                clock.at(now + pause_at + paused_for, player.resume)
+                now += duration + paused_for
+            elif behaviour < 0.25:
+                # Play it again, from the top, right before it ends
+                clock.at(now + duration - 1, lambda index=index: player.play(index))
+                now += 2 * duration - 1
+            else:
+                now += duration
+
+            # Tracks play on into the next one by themselves, which needs to be there by then
+            index = add_track(player, rng)
+
+        # Stop just before the session's last track would have ended
+        clock.at(now - 0.5, player.stop)
+        listened += now - session_start
+
+    return listened
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate weeks of listening with YAMS on a virtual clock, and check its steady-state cost."
+    )
+    parser.add_argument(
+        "--days", type=int, default=30, help="Days to simulate. Default: 30"
+    )
+    parser.add_argument(
+        "--hours",
+        type=float,
+        default=4,
+        help="Hours of listening a day. Default: 4",
+    )
+    parser.add_argument(
+        "--outage-rate",
+        type=float,
+        default=0.2,
+        help="The chance of Last.FM being down at some point on any given day. Default: 0.2",
+    )
+    parser.add_argument(
+        "--max-outage",
+        type=float,
+        default=3,
+        help="The longest an outage lasts, in hours. Default: 3",
+    )
+    parser.add_argument(
+        "--cache-backend", choices=["log", "sqlite", "yaml"], default="log"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Default: 0")
+    parser.add_argument(
+        "--json",
+        metavar="PATH",
+        help='Write the results as JSON to PATH ("-" for stdout)',
+    )
+
+    budgets = parser.add_argument_group("budgets")
+    budgets.add_argument(
+        "--max-rss-growth",
+        type=float,
+        default=16,
+        help="MiB resident memory may grow by after the first day. Default: 16",
+    )
+    budgets.add_argument(
+        "--max-fd-growth",
+        type=int,
+        default=2,
+        help="Open file descriptors may grow by after the first day. Default: 2",
+    )
+    budgets.add_argument(
+        "--max-cache-bytes-per-day",
+        type=float,
+        default=4096,
+        help="Bytes written to the cache per simulated day. Default: 4096",
+    )
+    budgets.add_argument(
+        "--max-http-calls-per-track",
+        type=float,
+        default=3,
+        help="HTTP calls per track played, retries included. Default: 3",
+    )
+    args = parser.parse_args()
+
+    quiet_logging()
+    rng = random.Random(args.seed)
+    start = 1700000000 - 1700000000 % DAY
+    clock = VirtualClock(start)
+    player = FakePlayer([], clock.time, background=False)
+    lastfm = FakeLastFM().start()
+    outages = Outages(lastfm)
+    listened = script_listening(clock, player, outages, rng, args, start)
+
+    process = psutil.Process()
+    samples = []
+
+    def sample():
+        samples.append((process.memory_info().rss, process.num_fds()))
+
+    for day in range(1, args.days + 1):
+        clock.at(start + day * DAY, sample)
+
+    with tempfile.TemporaryDirectory(prefix="yams-soak-") as directory:
+        config = dict(DEFAULTS)
+        config.update(
+            {
+                "base_url": lastfm.url,
+                "cache_file": str(Path(directory, "scrobbles.cache")),
+                "cache_backend": args.cache_backend,
+            }
+        )
+
+        transport = transport_from_config(config, clock.time)
+        store = open_scrobble_store(config)
+        worker = SubmissionWorker(SESSION_KEY, config, transport, store)
+        submitter = InlineSubmitter(worker, clock)
+        client = FakeMPDClient(player, clock.wait_for_next)
+
+        cache_bytes = METRICS.total("yams_cache_write_bytes_total")
+        print(
+            "Simulating {} days ({:.0f} hours of listening)...".format(
+                args.days, listened / 3600
+            ),
+            file=sys.stderr,
+        )
+        began = time.perf_counter()
+        mpd_watch_track(
+            client,
+            SESSION_KEY,
+            config,
+            transport,
+            submitter,
+            clock=clock.time,
+            sleep=clock.sleep,
+        )
+        wall_time = time.perf_counter() - began
+        sample()
+
+        cache_bytes = METRICS.total("yams_cache_write_bytes_total") - cache_bytes
+        pending = len(store)
+        store.close()
+        transport.close()
+
+    lastfm.close()
+
+    accepted = lastfm.scrobbles()
+    sent = set((track, timestamp) for arrived, track, artist, timestamp in accepted)
+    tracks_played = len(player.track_starts)
+    http_calls = len(lastfm.calls)
+
+    results = {
+        "simulated_days": args.days,
+        "listened_hours": listened / 3600,
+        "outage_hours": outages.seconds / 3600,
+        "wall_seconds": wall_time,
+        "tracks_played": tracks_played,
+        "scrobbles_accepted": len(accepted),
+        "duplicate_scrobbles": len(accepted) - len(sent),
+        "pending_scrobbles": pending,
+        "http_calls": http_calls,
+        "failed_http_calls": lastfm.failures,
+        "http_calls_per_track": http_calls / max(tracks_played, 1),
+        "cache_bytes": cache_bytes,
+        "cache_bytes_per_day": cache_bytes / args.days,
+        "rss_first_day": samples[0][0],
+        "rss_peak": max(rss for rss, fds in samples),
+        "rss_growth_mib": (samples[-1][0] - samples[0][0]) / MEBIBYTE,
+        "fds_first_day": samples[0][1],
+        "fd_growth": samples[-1][1] - samples[0][1],
+    }
+
+    for key, value in results.items():
+        if isinstance(value, float):
+            value = "{:.2f}".format(value)
+        print("{:<24} {}".format(key, value))
+
+    over_budget = []
+    if results["rss_growth_mib"] > args.max_rss_growth:
+        over_budget.append("memory grew by {:.1f}MiB".format(results["rss_growth_mib"]))
+    if results["fd_growth"] > args.max_fd_growth:
+        over_budget.append("{} file descriptors leaked".format(results["fd_growth"]))
+    if results["cache_bytes_per_day"] > args.max_cache_bytes_per_day:
+        over_budget.append(
+            "{:.0f} bytes written to the cache a day".format(
+                results["cache_bytes_per_day"]
+            )
+        )
+    if results["http_calls_per_track"] > args.max_http_calls_per_track:
+        over_budget.append(
+            "{:.1f} HTTP calls per track".format(results["http_calls_per_track"])
+        )
+    if results["duplicate_scrobbles"] > 0:
+        over_budget.append(
+            "{} scrobbles sent twice".format(results["duplicate_scrobbles"])
+        )
+    if results["pending_scrobbles"] > 0:
+        over_budget.append(
+            "{} scrobbles never sent".format(results["pending_scrobbles"])
+        )
+
+    if args.json:
+        write_results(
+            args.json,
+            {"soak": results},
+            {"options": vars(args), "over_budget": over_budget},
+        )
+
+    for problem in over_budget:
+        print("Over budget: {}".format(problem))
+    return 1 if len(over_budget) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,180 @@
+import json
+import sqlite3
+
+import pytest
+
+from yams.cache import (
+    AcceptedFilter,
+    DURABILITY_ALWAYS,
+    DURABILITY_BATCHED,
+    FlushPolicy,
+    SEGMENT_SUFFIX,
+    SegmentedLogStore,
+    SqliteScrobbleStore,
+)
+
+
+def make_scrobble(index):
+    return {
+        "artist": "Artist",
+        "track": "Track {}".format(index),
+        "album": "Album",
+        "timestamp": 1000 + index,
+    }
+
+
+def drain(store, batch_size):
+    sent = []
+    while len(store) > 0:
+        batch = store.peek(batch_size)
+        assert len(batch) > 0
+        sent.extend(scrobble.track for scrobble in batch)
+        store.ack(len(batch))
+    return sent
+
+
+@pytest.mark.parametrize("durability", [DURABILITY_ALWAYS, DURABILITY_BATCHED])
+def test_enqueue_peek_ack_enqueue(tmp_path, durability):
+    """Scrobbles appended to the active segment while it's being read from all come out, once and in order"""
+
+    store = SegmentedLogStore(
+        tmp_path, segment_size=100, window=100, flush_policy=FlushPolicy(durability)
+    )
+    for index in range(250):
+        store.enqueue(make_scrobble(index))
+
+    sent = []
+    for _ in range(3):
+        batch = store.peek(50)
+        sent.extend(scrobble.track for scrobble in batch)
+        store.ack(len(batch))
+
+    for index in range(250, 260):
+        store.enqueue(make_scrobble(index))
+    sent.extend(drain(store, 50))
+    store.close()
+
+    assert sent == ["Track {}".format(index) for index in range(260)]
+    assert len(SegmentedLogStore(tmp_path)) == 0
+
+
+def test_damaged_scrobble_before_the_cursor(tmp_path):
+    """A damaged scrobble among the accepted ones doesn't make the cursor skip past pending ones"""
+
+    store = SegmentedLogStore(tmp_path, segment_size=100)
+    for index in range(10):
+        store.enqueue(make_scrobble(index))
+    store.ack(3)
+    store.close()
+
+    segment_path = tmp_path / "{:010d}{}".format(0, SEGMENT_SUFFIX)
+    lines = segment_path.read_text().splitlines(keepends=True)
+    # The header comes first, so this is the second scrobble
+    lines[2] = "{not a scrobble\n"
+    segment_path.write_text("".join(lines))
+
+    store = SegmentedLogStore(tmp_path, segment_size=100)
+    assert len(store) == 7
+    store.close()
+
+    # The salvaged segment and its cursor agree from then on
+    store = SegmentedLogStore(tmp_path, segment_size=100)
+    assert drain(store, 50) == ["Track {}".format(index) for index in range(3, 10)]
+    store.close()
+
+
+def test_sqlite_store(tmp_path):
+    """Scrobbles come out in order, once each (going by identity), and stay queued across restarts"""
+
+    path = tmp_path / "scrobbles.db"
+    store = SqliteScrobbleStore(path)
+    for index in range(10):
+        store.enqueue(make_scrobble(index))
+    store.enqueue(dict(make_scrobble(4), duration="200"))
+    store.enqueue(dict(make_scrobble(4), album="Another Album"))
+    assert len(store) == 11
+    assert make_scrobble(4) in store
+    assert make_scrobble(10) not in store
+
+    store.ack(len(store.peek(3)))
+    store.close()
+
+    store = SqliteScrobbleStore(path)
+    assert len(store) == 8
+    assert make_scrobble(2) not in store
+    assert drain(store, 5) == ["Track {}".format(index) for index in range(3, 10)] + [
+        "Track 4"
+    ]
+    store.close()
+
+
+def test_sqlite_store_album_migration(tmp_path):
+    """A database whose index left out the album gets the album column, and its index"""
+
+    path = tmp_path / "scrobbles.db"
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute(
+            "CREATE TABLE scrobbles ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "artist TEXT NOT NULL, "
+            "track TEXT NOT NULL, "
+            "timestamp REAL NOT NULL, "
+            "scrobble TEXT NOT NULL)"
+        )
+        connection.execute(
+            "CREATE UNIQUE INDEX scrobbles_identity "
+            "ON scrobbles (artist, track, timestamp)"
+        )
+        for index in range(3):
+            scrobble = make_scrobble(index)
+            connection.execute(
+                "INSERT INTO scrobbles (artist, track, timestamp, scrobble) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    scrobble["artist"],
+                    scrobble["track"],
+                    scrobble["timestamp"],
+                    json.dumps(scrobble),
+                ),
+            )
+    connection.close()
+
+    store = SqliteScrobbleStore(path)
+    assert len(store) == 3
+    assert make_scrobble(1) in store
+    # The same listen, as far as the old index went
+    assert dict(make_scrobble(1), album="Another Album") not in store
+    store.enqueue(dict(make_scrobble(1), album="Another Album"))
+    store.enqueue(make_scrobble(1))
+    assert len(store) == 4
+    store.close()
+
+    connection = sqlite3.connect(path)
+    indexes = [
+        row[0]
+        for row in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+        )
+    ]
+    connection.close()
+    assert "scrobbles_identity" not in indexes
+    assert "scrobbles_listen" in indexes
+
+
+@pytest.mark.parametrize("batch_size", [1, 7])
+def test_accepted_filter_generations(tmp_path, batch_size):
+    """The older generation's forgotten once the newer one fills up, in memory and on disk alike"""
+
+    path = str(tmp_path / "accepted")
+    accepted = AcceptedFilter(path, capacity=3)
+    scrobbles = [make_scrobble(index) for index in range(7)]
+    for start in range(0, len(scrobbles), batch_size):
+        accepted.add(scrobbles[start : start + batch_size])
+    accepted.close()
+
+    for remembered in [accepted, AcceptedFilter(path, capacity=3)]:
+        assert len(remembered) == 4
+        assert [scrobble in remembered for scrobble in scrobbles] == [False] * 3 + [
+            True
+        ] * 4
@@ -0,0 +1,74 @@
+import pytest
+
+from yams.responses import (
+    JSONResponse,
+    ScrobbleCounts,
+    Session,
+    XMLResponse,
+    parse_response,
+)
+
+
+@pytest.mark.parametrize(
+    "body, response_type",
+    [
+        (b'{"token": "abc"}', JSONResponse),
+        (b'  \n{"token": "abc"}', JSONResponse),
+        (b'<lfm status="ok"><token>abc</token></lfm>', XMLResponse),
+        (
+            b'<?xml version="1.0" encoding="utf-8"?>\n<lfm status="ok"><token>abc</token></lfm>',
+            XMLResponse,
+        ),
+    ],
+)
+def test_parse_response_sniffs_format(body, response_type):
+    """The body decides how a response is parsed, whatever format was asked for"""
+
+    response = parse_response(body)
+
+    assert isinstance(response, response_type)
+    assert not response.failed()
+    assert response.token() == "abc"
+    assert response.error() == (None, "")
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b'{"error": 9, "message": "Invalid session key"}',
+        b'<lfm status="failed"><error code="9">\n  Invalid session key\n</error></lfm>',
+    ],
+)
+def test_error(body):
+    response = parse_response(body)
+
+    assert response.failed()
+    assert response.error() == (9, "Invalid session key")
+
+
+@pytest.mark.parametrize("body", [b"", b"Bad Gateway", b'{"token": '])
+def test_parse_response_garbage(body):
+    with pytest.raises(ValueError):
+        parse_response(body)
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b'{"session": {"name": "user", "key": "secret"}, '
+        b'"scrobbles": {"@attr": {"accepted": 2, "ignored": "1"}}}',
+        b'<lfm status="ok"><session><name>user</name><key>secret</key></session>'
+        b'<scrobbles accepted="2" ignored="1"/></lfm>',
+    ],
+)
+def test_session_and_counts(body):
+    response = parse_response(body)
+
+    assert response.session() == Session("user", "secret")
+    assert response.scrobble_counts() == ScrobbleCounts(2, 1)
+
+
+@pytest.mark.parametrize("body", [b'{"token": "abc"}', b'<lfm status="ok"/>'])
+def test_no_scrobble_counts(body):
+    with pytest.raises(ValueError):
+        parse_response(body).scrobble_counts()
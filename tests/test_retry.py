@@ -0,0 +1,155 @@
+import pytest
+
+from yams.retry import (
+    INVALID_SESSION,
+    PERMANENT,
+    RATE_LIMITED,
+    UNAVAILABLE,
+    CircuitBreaker,
+    LastFMError,
+    RequestThrottled,
+    RetryPolicy,
+    TokenBucket,
+    parse_error,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def open_circuit(policy):
+    """Fail requests until the circuit opens"""
+
+    while policy.breaker.state != CircuitBreaker.OPEN:
+        policy.failed(LastFMError(UNAVAILABLE, 11, "Service offline"))
+
+
+@pytest.mark.parametrize(
+    "status_code, body, kind, code",
+    [
+        (200, b'{"error": 29, "message": "Rate limit exceeded"}', RATE_LIMITED, 29),
+        (200, b'{"error": 11, "message": "Service offline"}', UNAVAILABLE, 11),
+        (403, b'{"error": 9, "message": "Invalid session key"}', INVALID_SESSION, 9),
+        (400, b'{"error": 13, "message": "Invalid signature"}', PERMANENT, 13),
+        (
+            403,
+            b'<lfm status="failed"><error code="9">Invalid session key</error></lfm>',
+            INVALID_SESSION,
+            9,
+        ),
+        # Codes we don't know of are retried
+        (500, b'{"error": 99, "message": "Something new"}', UNAVAILABLE, 99),
+        # No code to go on, so the HTTP status decides
+        (429, b"<html>Slow down</html>", RATE_LIMITED, None),
+        (503, b"", UNAVAILABLE, None),
+    ],
+)
+def test_parse_error(status_code, body, kind, code):
+    error = parse_error(status_code, body)
+
+    assert error.kind == kind
+    assert error.code == code
+    assert error.permanent == (kind == PERMANENT)
+
+
+def test_parse_error_retry_after():
+    error = parse_error(429, b"", {"Retry-After": "120"})
+
+    assert error.kind == RATE_LIMITED
+    assert error.retry_after == 120
+
+
+def test_half_open_probe():
+    """Once the circuit's due to close one request goes out, and how it goes decides what's next"""
+
+    clock = FakeClock()
+    policy = RetryPolicy(failure_threshold=2, clock=clock)
+    open_circuit(policy)
+    with pytest.raises(RequestThrottled):
+        policy.acquire()
+
+    clock.advance(policy.breaker.time_until_closed())
+    policy.acquire()
+    # Only the one, until we hear how it went
+    with pytest.raises(RequestThrottled):
+        policy.acquire()
+
+    policy.failed(LastFMError(UNAVAILABLE, 11, "Service offline"))
+    assert policy.breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(RequestThrottled):
+        policy.acquire()
+
+    clock.advance(policy.breaker.time_until_closed())
+    policy.acquire()
+    policy.succeeded()
+    assert policy.breaker.state == CircuitBreaker.CLOSED
+    policy.acquire()
+    policy.acquire()
+
+
+def test_half_open_probe_released():
+    """A probe the token bucket turns down isn't used up, the next request gets to be it"""
+
+    clock = FakeClock()
+    policy = RetryPolicy(rate=1, burst=1, failure_threshold=1, clock=clock)
+    open_circuit(policy)
+    clock.advance(policy.breaker.time_until_closed())
+    policy.bucket.empty()
+
+    with pytest.raises(RequestThrottled) as throttled:
+        policy.acquire()
+    assert throttled.value.message == "Sending requests too quickly"
+    assert policy.breaker.state == CircuitBreaker.OPEN
+
+    clock.advance(1)
+    policy.acquire()
+    assert policy.breaker.state == CircuitBreaker.HALF_OPEN
+
+
+def test_rate_limit_hold_off():
+    """Being rate limited holds every request off for at least as long as we were asked to wait"""
+
+    clock = FakeClock()
+    policy = RetryPolicy(backoff_base=1, clock=clock)
+    policy.failed(LastFMError(RATE_LIMITED, 29, "Rate limit exceeded", 120))
+
+    with pytest.raises(RequestThrottled) as throttled:
+        policy.acquire()
+    assert throttled.value.retry_after == pytest.approx(120)
+    assert policy.retry_delay(0) == pytest.approx(120)
+
+    clock.advance(119)
+    with pytest.raises(RequestThrottled):
+        policy.acquire()
+
+    clock.advance(1)
+    policy.acquire()
+    policy.succeeded()
+    assert policy.retry_delay(0) == 0
+
+
+def test_no_rate_limit():
+    """A rate of 0 lets every request through, including once a rate limit hold-off is over"""
+
+    clock = FakeClock()
+    bucket = TokenBucket(0, 10, clock)
+    assert all(bucket.take() for _ in range(100))
+    assert bucket.time_until_available() == 0
+
+    policy = RetryPolicy(rate=0, burst=10, clock=clock)
+    for _ in range(100):
+        policy.acquire()
+    policy.failed(LastFMError(RATE_LIMITED, 29, "Rate limit exceeded", 5))
+    clock.advance(policy.retry_delay(0))
+    policy.acquire()
+    policy.succeeded()
+    for _ in range(100):
+        policy.acquire()
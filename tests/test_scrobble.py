@@ -0,0 +1,131 @@
+from collections import Counter
+
+import pytest
+
+from yams.scrobble import NowPlayingSlot, TrackCache
+
+ROOM = ("room", "room session")
+
+
+class FakeMPDClient:
+    """Answers currentsong and playlistid from a queue of songs, counting the calls"""
+
+    def __init__(self, songs):
+        self.songs = songs
+        self.playing = songs[0]["id"]
+        self.calls = Counter()
+
+    def currentsong(self):
+        self.calls["currentsong"] += 1
+        return self.song(self.playing)
+
+    def playlistid(self, song_id):
+        self.calls["playlistid"] += 1
+        return [song for song in self.songs if song["id"] == song_id]
+
+    def song(self, song_id):
+        return next(song for song in self.songs if song["id"] == song_id)
+
+
+def make_songs(title="Track"):
+    return [
+        {"id": str(index), "artist": "Artist", "title": "{} {}".format(title, index)}
+        for index in range(3)
+    ]
+
+
+def test_now_playing_slot_coalesces():
+    """Only the latest update waits to be sent, and only the first needs queueing up"""
+
+    slot = NowPlayingSlot()
+    assert slot.offer("Track 1")
+    assert not slot.offer("Track 2")
+
+    update, generation = slot.take()
+    assert update == "Track 2"
+    assert not slot.superseded(None, generation)
+    # Already taken, the queued request for the first one has nothing left to send
+    assert slot.take() == (None, generation)
+
+    # A newer track came along while it was being sent
+    assert slot.offer("Track 3")
+    assert slot.superseded(None, generation)
+
+
+def test_now_playing_slot_accounts():
+    """Every account has a now playing of its own"""
+
+    slot = NowPlayingSlot()
+    assert slot.offer("Track 1")
+    assert slot.offer("Room Track 1", ROOM)
+    assert not slot.offer("Room Track 2", ROOM)
+
+    update, generation = slot.take()
+    assert update == "Track 1"
+    assert slot.take(ROOM)[0] == "Room Track 2"
+
+    assert slot.offer("Room Track 3", ROOM)
+    assert not slot.superseded(None, generation)
+
+
+def test_now_playing_slot_discard():
+    """An update that couldn't be queued up doesn't keep the next one from being queued"""
+
+    slot = NowPlayingSlot()
+    assert slot.offer("Track 1", ROOM)
+    slot.discard(ROOM)
+    assert slot.take(ROOM)[0] is None
+    assert slot.offer("Track 2", ROOM)
+    assert slot.take(ROOM)[0] == "Track 2"
+
+
+def test_track_cache():
+    """Tracks are only asked for once, and the one up next is fetched ahead of time"""
+
+    client = FakeMPDClient(make_songs())
+    tracks = TrackCache()
+    status = {"songid": "0", "nextsongid": "1"}
+
+    assert tracks.current(client, status)["title"] == "Track 0"
+    assert tracks.current(client, status)["title"] == "Track 0"
+    tracks.prefetch(client, status)
+    tracks.prefetch(client, status)
+    assert client.calls == Counter(currentsong=1, playlistid=1)
+
+    client.playing = "1"
+    tracks.changed(["player"])
+    assert tracks.current(client, {"songid": "1"})["title"] == "Track 1"
+    assert client.calls == Counter(currentsong=1, playlistid=1)
+
+
+@pytest.mark.parametrize("subsystem", ["playlist", "database"])
+def test_track_cache_invalidation(subsystem):
+    """Song ids and tags can change with the queue or database, so changes to either forget every track"""
+
+    client = FakeMPDClient(make_songs())
+    tracks = TrackCache()
+    status = {"songid": "0", "nextsongid": "1"}
+    tracks.current(client, status)
+    tracks.prefetch(client, status)
+
+    client.songs = make_songs("Retagged")
+    tracks.changed([subsystem])
+
+    assert tracks.current(client, status)["title"] == "Retagged 0"
+    tracks.prefetch(client, status)
+    client.playing = "1"
+    assert tracks.current(client, {"songid": "1"})["title"] == "Retagged 1"
+    assert client.calls == Counter(currentsong=2, playlistid=2)
+
+
+def test_track_cache_player_moved_on():
+    """If the track changed between status and currentsong, what currentsong returned isn't cached as the old id"""
+
+    client = FakeMPDClient(make_songs())
+    tracks = TrackCache()
+    client.playing = "2"
+
+    assert tracks.current(client, {"songid": "0"})["title"] == "Track 2"
+    client.playing = "0"
+    assert tracks.current(client, {"songid": "0"})["title"] == "Track 0"
+    assert client.calls["currentsong"] == 2
@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+
+import asyncio
+import functools
+import logging
+
+from mpd.asyncio import MPDClient
+from mpd.base import ConnectionError
+
+from yams.metrics import METRICS, CountingMPDClient, store_gauges
+from yams.scheduler import Scheduler
+from yams.scrobble import (
+    RECONNECT_TIMEOUT,
+    SCROBBLE_RETRY_INTERVAL,
+    EndpointFanout,
+    NowPlayingSlot,
+    TrackWatcher,
+    endpoint_accounts,
+    is_track_scrobbleable,
+    now_playing,
+    queue_failed_scrobble,
+    retry_delay,
+    retry_failed_scrobbles,
+    scrobble_track,
+)
+
+logger = logging.getLogger("yams")
+
+
+class AsyncScrobbler:
+    """
+    The submission side of the asyncio runtime. Runs the HTTP submissions and cache writes as a task of
+    their own, so they never stall MPD tracking. Blocking calls (requests, disk I/O) are pushed onto the
+    event loop's default executor. Like yams.scrobble.SubmissionWorker there's one per endpoint, now
+    playing updates are coalesced, and requests may name the account (a tuple of user name and session
+    key) they're to be sent with, otherwise they're sent with session.
+
+    :param session: The Session key for last.fm
+    :param config: The endpoint's config
+    :param transport: The long-lived HTTP transport to send requests over
+    :param failed_scrobbles: The failed scrobbles cache
+
+    :type session: str
+    :type config: dict
+    :type transport: yams.transport.Transport
+    :type failed_scrobbles: yams.cache.SegmentedLogStore
+    """
+
+    def __init__(self, session, config, transport, failed_scrobbles):
+        self.session = session
+        self.config = config
+        self.transport = transport
+        self.failed_scrobbles = failed_scrobbles
+
+        self.submissions = asyncio.Queue(maxsize=config["submission_queue_size"])
+        # The session key of every account we've been told about, to send their cached scrobbles with
+        self.sessions = {}
+        # Set whenever a scrobble is added to the cache
+        self.cached = asyncio.Event()
+        self.now_playing_slot = NowPlayingSlot()
+        # Scrobbles queued up and not handled yet, that now playing updates are held back for
+        self.scrobbles_waiting = 0
+        # Scrobbles being cached in the background because the queue was full, kept so they finish
+        self.caching = set()
+
+    async def run_blocking(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(function, *args))
+
+    def add_account(self, account):
+        user_name, session = account
+        self.sessions[user_name] = session
+
+    def pending(self):
+        """The number of cached scrobbles, counted on the executor as the store's lock may be held for a disk read"""
+        return self.run_blocking(len, self.failed_scrobbles)
+
+    def put(self, intent):
+        try:
+            self.submissions.put_nowait(intent)
+            return True
+        except asyncio.QueueFull:
+            logger.warn(
+                "Submission queue for {} is full ({} waiting), it can't keep up!".format(
+                    self.config.get("name", "default"), self.submissions.qsize()
+                )
+            )
+            return False
+
+    def now_playing(self, song, status, account=None):
+        if self.submissions.full():
+            METRICS.inc("yams_now_playing_dropped_total", reason="congested")
+            return False
+        if not self.now_playing_slot.offer((song, status, account), account):
+            # There's already one queued up, which will send this instead
+            return True
+        if self.put((TrackWatcher.NOW_PLAYING, None, None, None, account)):
+            return True
+        # Nothing's queued up to send it, so it mustn't keep later updates from being queued
+        self.now_playing_slot.discard(account)
+        METRICS.inc("yams_now_playing_dropped_total", reason="congested")
+        return False
+
+    def warm(self):
+        return self.put((TrackWatcher.WARM, None, None, None, None))
+
+    def scrobble(self, song, status, timestamp, account=None):
+        if self.put((TrackWatcher.SCROBBLE, song, status, timestamp, account)):
+            self.scrobbles_waiting += 1
+            return True
+
+        # No room, cache it so it's sent along with the rest of the backlog
+        user_name = account[0] if account is not None else None
+        task = asyncio.ensure_future(
+            self.cache_scrobble(song, status, timestamp, user_name)
+        )
+        self.caching.add(task)
+        task.add_done_callback(self.caching.discard)
+        return False
+
+    async def cache_scrobble(self, song, status, timestamp, user_name):
+        try:
+            await self.queue_failed_scrobble(song, status, timestamp, user_name)
+        except Exception:
+            logger.exception("Something went wrong caching a scrobble!")
+
+    async def queue_failed_scrobble(self, song, status, timestamp, user_name=None):
+        # Checking the cache for it may read from disk, so it's done on the executor along with the write
+        await self.run_blocking(
+            queue_failed_scrobble,
+            song,
+            status,
+            timestamp,
+            self.failed_scrobbles,
+            user_name,
+        )
+        self.cached.set()
+
+    async def retry_failed_scrobbles(self):
+        if await self.pending() < 1:
+            return
+
+        await self.run_blocking(
+            retry_failed_scrobbles,
+            self.failed_scrobbles,
+            self.session,
+            self.config,
+            self.transport,
+            self.sessions,
+        )
+
+    async def submit(self):
+        """Task: sends queued now playing updates and scrobbles, one after the other"""
+
+        while True:
+            action, song, status, timestamp, account = await self.submissions.get()
+            try:
+                await self.handle(action, song, status, timestamp, account)
+            except Exception:
+                logger.exception("Something went wrong sending requests to Last.FM!")
+
+    async def handle(self, action, song, status, timestamp, account):
+
+        base_url = self.config["base_url"]
+        api_key = self.config["api_key"]
+        api_secret = self.config["api_secret"]
+
+        if action == TrackWatcher.NOW_PLAYING:
+            update, generation = self.now_playing_slot.take(account)
+            if update is None:
+                return
+            if self.scrobbles_waiting > 0:
+                # Scrobbles are waiting, and the track's likely changed again by the time they're through
+                logger.debug("Requests are waiting, not sending now playing")
+                METRICS.inc("yams_now_playing_dropped_total", reason="congested")
+                return
+            song, status, account = update
+
+        user_name, session = (None, self.session)
+        if account is not None:
+            self.add_account(account)
+            user_name, session = account
+
+        if action == TrackWatcher.NOW_PLAYING:
+            # The executor may not get to it until after a newer track's come along
+            await self.run_blocking(
+                now_playing,
+                song,
+                status,
+                base_url,
+                api_key,
+                api_secret,
+                session,
+                self.transport,
+                functools.partial(
+                    self.now_playing_slot.superseded, account, generation
+                ),
+                self.config["response_format"],
+            )
+        elif action == TrackWatcher.WARM and self.transport is not None:
+            await self.run_blocking(self.transport.warm, base_url)
+        elif action == TrackWatcher.SCROBBLE:
+            self.scrobbles_waiting -= 1
+            if await self.pending() < 1:
+                # If we don't have any pending scrobbles, try to scrobble this
+                scrobble_succeeded = await self.run_blocking(
+                    scrobble_track,
+                    song,
+                    status,
+                    timestamp,
+                    base_url,
+                    api_key,
+                    api_secret,
+                    session,
+                    self.transport,
+                    self.config["response_format"],
+                )
+                if not scrobble_succeeded:
+                    await self.queue_failed_scrobble(song, status, timestamp, user_name)
+            else:
+                # If we have failed and queued up scrobbles, add this one to the list and try to do them all in one go
+                await self.queue_failed_scrobble(song, status, timestamp, user_name)
+                await self.retry_failed_scrobbles()
+        elif action is None:
+            await self.retry_failed_scrobbles()
+
+    async def retry_timer(self):
+        """Task: asks the submission task to re-send failed scrobbles, SCROBBLE_RETRY_INTERVAL after they've been cached (or once the endpoint's done backing off)"""
+
+        while True:
+            try:
+                await asyncio.sleep(retry_delay(self.config, self.transport))
+                if await self.pending() > 0:
+                    # When the queue's full the submission task's busy, and it'll be asked again next time
+                    self.put((None, None, None, None, None))
+                else:
+                    # Nothing to retry, sleep until something gets cached
+                    self.cached.clear()
+                    await self.cached.wait()
+            except Exception:
+                logger.exception("Something went wrong scheduling failed scrobbles!")
+                await asyncio.sleep(SCROBBLE_RETRY_INTERVAL)
+
+
+async def mpd_events(client, wakeup):
+    """Task: wakes the watcher up whenever MPD's player subsystem changes"""
+
+    async for changes in client.idle(["player"]):
+        logger.debug("Received event in subsystem: {}".format(changes))
+        wakeup.set()
+
+
+async def mpd_watch_track_async(client, submitter, config):
+    """
+    The asyncio counterpart to yams.scrobble.mpd_watch_track. Re-checks MPD whenever it reports a player
+    event, and every update_interval seconds while a track is playing.
+
+    :param client: The (asyncio) MPD client object
+    :param submitter: Where to hand requests to, the scrobblers of every endpoint the player scrobbles to
+    :param config: The global (or this player's) config file
+
+    :type client: mpd.asyncio.MPDClient
+    :type submitter: yams.scrobble.EndpointFanout
+    :type config: dict
+    """
+
+    update_interval = config["update_interval"]
+    player = config.get("name", "{}:{}".format(config["mpd_host"], config["mpd_port"]))
+
+    watcher = TrackWatcher(config)
+    scheduler = Scheduler()
+    wakeup = asyncio.Event()
+    events = asyncio.create_task(mpd_events(client, wakeup))
+    client = CountingMPDClient(client)
+    round_trips = 0
+
+    try:
+        while True:
+            status = await client.status()
+            playing = status["state"] == "play"
+
+            scheduler.cancel("track")
+
+            if playing:
+                song = await client.currentsong()
+
+                if is_track_scrobbleable(song, status):
+                    action = watcher.update(song, status)
+                    scheduler.schedule("track", watcher.next_check)
+
+                    if action == TrackWatcher.NOW_PLAYING:
+                        submitter.now_playing(song, status)
+                    elif action == TrackWatcher.WARM:
+                        submitter.warm()
+                    elif action == TrackWatcher.SCROBBLE:
+                        submitter.scrobble(song, status, watcher.start_time)
+
+            # Wait for MPD to tell us something changed - while playing we also need to wake up on our own,
+            # once the watcher's next deadline (e.g. the scrobble threshold being crossed) comes around
+            try:
+                await asyncio.wait_for(
+                    wakeup.wait(), scheduler.time_until_next(minimum=update_interval)
+                )
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+            scheduler.pop_due()
+
+            METRICS.observe(
+                "yams_mpd_roundtrips_per_iteration",
+                client.round_trips - round_trips,
+                player=player,
+            )
+            round_trips = client.round_trips
+
+            # The event task only ever ends on a lost connection, let it raise its error
+            if events.done():
+                events.result()
+                raise ConnectionError("MPD idle task ended unexpectedly")
+    finally:
+        events.cancel()
+
+
+async def watch_player_async(player, submitter):
+    """
+    Task: watches one MPD server, reconnecting to it whenever the connection's lost.
+
+    :param player: The player's config, see yams.configure.player_configs
+    :param submitter: Where to hand the player's requests to
+
+    :type player: dict
+    :type submitter: yams.scrobble.EndpointFanout
+    """
+
+    connected_before = False
+
+    while True:
+        client = MPDClient()
+        try:
+            await client.connect(player["mpd_host"], player["mpd_port"])
+            logger.info("Connected to mpd, version: {}".format(client.mpd_version))
+            if connected_before:
+                METRICS.inc("yams_mpd_reconnects_total", player=player["name"])
+            connected_before = True
+            await mpd_watch_track_async(client, submitter, player)
+        except ConnectionError as e:
+            logger.error(
+                "Received an MPD Connection error from {}!: {}".format(
+                    player["name"], e
+                )
+            )
+            logger.info(
+                "YAMS will keep trying to reconnect to MPD, every {} seconds.".format(
+                    RECONNECT_TIMEOUT
+                )
+            )
+        except OSError as e:
+            logger.debug("Could not connect to MPD! Error: {}".format(e))
+        finally:
+            client.disconnect()
+
+        await asyncio.sleep(RECONNECT_TIMEOUT)
+
+
+async def run_async(players, routes, endpoints, stores, transport):
+    """
+    Entrypoint for the asyncio runtime. Watches every player (reconnecting if need be), and runs the
+    submission and retry tasks of every endpoint, on one event loop until cancelled.
+
+    :param players: The config of each player, see yams.configure.player_configs
+    :param routes: For each player, a list of (endpoint name, account) tuples
+    :param endpoints: A dictionary of endpoint name to endpoint config
+    :param stores: A dictionary of endpoint name to its failed scrobbles cache
+    :param transport: The long-lived HTTP transport to send requests over
+
+    :type players: list
+    :type routes: list
+    :type endpoints: dict
+    :type stores: dict
+    :type transport: yams.transport.Transport
+    """
+
+    # Scrobbles not tagged with an account (e.g. cached by an older YAMS) go to the endpoint's first one
+    accounts = endpoint_accounts(routes)
+
+    scrobblers = {}
+    background = []
+    for name, endpoint in endpoints.items():
+        scrobbler = AsyncScrobbler(
+            accounts[name][0][1], endpoint, transport, stores[name]
+        )
+        for account in accounts[name]:
+            scrobbler.add_account(account)
+        scrobblers[name] = scrobbler
+        store_gauges(name, stores[name], scrobbler.submissions.qsize)
+        background.append(asyncio.create_task(scrobbler.submit()))
+        background.append(asyncio.create_task(scrobbler.retry_timer()))
+
+    try:
+        await asyncio.gather(
+            *(
+                watch_player_async(
+                    player,
+                    EndpointFanout(
+                        [(scrobblers[name], account) for name, account in route]
+                    ),
+                )
+                for player, route in zip(players, routes)
+            )
+        )
+    finally:
+        for task in background:
+            task.cancel()
@@ -0,0 +1,1494 @@
+#!/usr/bin/env python3
+
+import array
+import bisect
+import collections
+import hashlib
+import itertools
+import json
+import logging
+import os
+from pathlib import Path
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+import yaml
+
+from yams.configure import YAML_DUMPER, YAML_LOADER
+from yams.metrics import record_cache_write
+
+logger = logging.getLogger("yams")
+
+SEGMENT_SUFFIX = ".seg"
+TEMPORARY_SEGMENT_SUFFIX = ".seg.tmp"
+SALVAGED_SEGMENT_SUFFIX = ".seg.salvaged"
+CORRUPT_SEGMENT_SUFFIX = ".seg.corrupt"
+CURSOR_FILENAME = "cursor"
+# How many entries of a YAML scrobbles file to parse at once
+ENTRIES_PER_PARSE = 100
+# How many segments on disk to remember the identities of, once they've been read to check a scrobble against
+READ_BACK_SEGMENTS = 2
+# A scrobble's timestamp in a segment, see SegmentedLogStore.scan_segment
+TIMESTAMP_LINE = re.compile(r"^(?:- |  )timestamp: '?([0-9.]+)'?\s*$")
+TIMESTAMP_FIELD = re.compile(r'"timestamp": ?([0-9.]+)')
+# Cache files are read with undecodable bytes escaped (see iter_scrobbles), this finds them
+UNDECODABLE = re.compile("[\udc80-\udcff]")
+
+# The formats a cache file can be in: a YAML list of scrobbles, or JSON Lines (a header, then a scrobble
+# per line). JSON Lines is far quicker to read and write
+YAML_FORMAT = "yaml"
+JSONL_FORMAT = "jsonl"
+CACHE_VERSION = 1
+# How a cache gets its changes to disk, see FlushPolicy
+DURABILITY_ALWAYS = "always"
+DURABILITY_BATCHED = "batched"
+# Separates the older generation of keys from the newer one in an accepted scrobbles file, see AcceptedFilter
+GENERATION_MARKER = "-\n"
+
+
+class ScrobbleRecord:
+    """
+    A queued scrobble, as kept in memory by the scrobble stores. Much smaller than the dictionary
+    make_scrobble returns: no per-record dictionary, and every string is interned, so a backlog full of
+    the same few albums keeps one copy of each artist and album name. Fields a scrobble doesn't have are
+    None. Caches on disk still hold plain dictionaries, see from_dict and to_dict.
+
+    :param artist: The track's artist
+    :param track: The track's title
+    :param timestamp: When the track started playing, as a UTC Unix Timestamp
+    :param album: (Optional) The track's album
+    :param track_number: (Optional) The track's number on its album
+    :param album_artist: (Optional) The album's artist
+    :param duration: (Optional) The track's length in seconds
+    :param user: (Optional) The Last.FM user the scrobble belongs to
+
+    :type artist: str
+    :type track: str
+    :type timestamp: float
+    :type album: str
+    :type track_number: str
+    :type album_artist: str
+    :type duration: str
+    :type user: str
+    """
+
+    # (attribute, key in the scrobble dictionary and Last.FM's form fields), in make_scrobble's order
+    FIELDS = (
+        ("artist", "artist"),
+        ("track", "track"),
+        ("album", "album"),
+        ("track_number", "trackNumber"),
+        ("album_artist", "albumArtist"),
+        ("duration", "duration"),
+        ("timestamp", "timestamp"),
+        ("user", "user"),
+    )
+    __slots__ = tuple(attribute for attribute, key in FIELDS)
+
+    def __init__(
+        self,
+        artist,
+        track,
+        timestamp,
+        album=None,
+        track_number=None,
+        album_artist=None,
+        duration=None,
+        user=None,
+    ):
+        self.artist = interned(artist)
+        self.track = interned(track)
+        self.timestamp = timestamp
+        self.album = interned(album)
+        self.track_number = interned(track_number)
+        self.album_artist = interned(album_artist)
+        self.duration = interned(duration)
+        self.user = interned(user)
+
+    @classmethod
+    def from_dict(cls, scrobble):
+        """
+        :param scrobble: A scrobble as made by make_scrobble, or read from a cache on disk
+        :type scrobble: dict
+
+        :rtype: yams.cache.ScrobbleRecord
+        """
+        return cls(
+            **{
+                attribute: scrobble[key]
+                for attribute, key in ScrobbleRecord.FIELDS
+                if key in scrobble
+            }
+        )
+
+    @classmethod
+    def of(cls, scrobble):
+        """
+        :param scrobble: A scrobble, either as a dictionary or a record already
+        :type scrobble: dict
+
+        :rtype: yams.cache.ScrobbleRecord
+        """
+        return scrobble if isinstance(scrobble, cls) else cls.from_dict(scrobble)
+
+    def fields(self):
+        """
+        :return: Every field the scrobble has, as (key, value) pairs keyed like make_scrobble's dictionaries
+        :rtype: list
+        """
+        return [
+            (key, getattr(self, attribute))
+            for attribute, key in ScrobbleRecord.FIELDS
+            if getattr(self, attribute) is not None
+        ]
+
+    def to_dict(self):
+        return dict(self.fields())
+
+    def values(self):
+        return tuple(getattr(self, attribute) for attribute in ScrobbleRecord.__slots__)
+
+    def identity(self):
+        """
+        :return: What makes two scrobbles the same listen, whatever else (duration, tags...) differs between them
+        :rtype: tuple
+        """
+        return (
+            str(self.artist or ""),
+            str(self.track or ""),
+            str(self.album or ""),
+            float(self.timestamp or 0),
+        )
+
+    def __eq__(self, other):
+        return isinstance(other, ScrobbleRecord) and self.values() == other.values()
+
+    def __hash__(self):
+        return hash(self.values())
+
+    def __repr__(self):
+        return "ScrobbleRecord({})".format(self.to_dict())
+
+
+def interned(value):
+    """Intern value if it's a string, so equal tags share one copy"""
+    return sys.intern(value) if type(value) is str else value
+
+
+def save_failed_scrobbles_to_disk(path, scrobbles):
+    logger.info("Writing scrobbles to disk...")
+    started = time.perf_counter()
+
+    # Write-then-rename, so there's always a complete cache on disk, the old one or the new one
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as file_stream:
+        yaml.dump(
+            {"scrobbles": [as_dict(scrobble) for scrobble in scrobbles]},
+            file_stream,
+            default_flow_style=False,
+            Dumper=YAML_DUMPER,
+        )
+        file_stream.flush()
+        os.fsync(file_stream.fileno())
+        written_bytes = file_stream.tell()
+    os.replace(temporary_path, path)
+    record_cache_write("yaml", written_bytes, time.perf_counter() - started)
+    logger.info("Failed scrobbles written to: {}".format(path))
+
+
+def as_dict(scrobble):
+    return scrobble.to_dict() if isinstance(scrobble, ScrobbleRecord) else scrobble
+
+
+def format_header(cache_format):
+    """
+    :return: What a cache file in cache_format starts with, before any scrobbles
+    :rtype: str
+    """
+
+    if cache_format == JSONL_FORMAT:
+        return json.dumps({"yams_cache": CACHE_VERSION, "format": JSONL_FORMAT}) + "\n"
+    return ""
+
+
+def format_scrobble(scrobble, cache_format):
+    """
+    :return: scrobble as an entry of a cache file in cache_format, ready to be appended to it
+    :rtype: str
+    """
+
+    if cache_format == JSONL_FORMAT:
+        return json.dumps(as_dict(scrobble)) + "\n"
+    # A one item YAML list appended to a YAML list is still a valid YAML list
+    return yaml.dump([as_dict(scrobble)], default_flow_style=False, Dumper=YAML_DUMPER)
+
+
+def detect_format(first_line):
+    """
+    :param first_line: The first line of a cache file
+    :type first_line: str
+
+    :return: The format the file's in, JSONL_FORMAT if it starts with a JSON Lines header, otherwise YAML_FORMAT
+    :rtype: str
+    """
+
+    if first_line.startswith("{"):
+        try:
+            header = json.loads(first_line)
+            if isinstance(header, dict) and "yams_cache" in header:
+                return JSONL_FORMAT
+        except ValueError:
+            pass
+    return YAML_FORMAT
+
+
+def is_scrobble(entry):
+    return isinstance(entry, dict) and all(
+        key in entry for key in ("artist", "track", "timestamp")
+    )
+
+
+def parse_scrobble_entries(entries, path, damaged=None):
+    """
+    Parse a run of entries of a YAML list of scrobbles, in one go if they're intact, otherwise one by one
+    to find the damaged ones
+
+    :param entries: (line number, text) tuples, one per entry
+    :param path: The path to the file the entries are from, for the log
+    :param damaged: (Optional) A list to add the text of every damaged entry to
+
+    :return: The intact scrobbles among them, in order
+    :rtype: list
+    """
+
+    try:
+        scrobbles = yaml.load(
+            "".join(text for line_number, text in entries), Loader=YAML_LOADER
+        )
+        if len(scrobbles) == len(entries) and all(map(is_scrobble, scrobbles)):
+            return scrobbles
+    except Exception:
+        pass
+
+    scrobbles = []
+    for line_number, text in entries:
+        try:
+            scrobble = yaml.load(text, Loader=YAML_LOADER)[0]
+            if is_scrobble(scrobble):
+                scrobbles.append(scrobble)
+                continue
+        except Exception:
+            pass
+
+        logger.warn("Skipping a damaged scrobble at {}:{}".format(path, line_number))
+        if damaged is not None:
+            damaged.append(text)
+    return scrobbles
+
+
+def iter_scrobbles(path, damaged=None):
+    """
+    Read the scrobbles in a cache file a few at a time, so only a few are ever held in memory. Reads JSON
+    Lines files (see format_header) and YAML lists of scrobbles, whether it's a whole cache file (the
+    list under "scrobbles") or a log segment (a bare list). Damaged entries are skipped, and everything
+    around them is still read. Bytes that aren't valid text only damage the entry they're in: they're
+    read escaped (see UNDECODABLE), and written back out as they were by anything opening its file with
+    errors="surrogateescape".
+
+    :param path: The path to the file
+    :param damaged: (Optional) A list to add the text of every damaged entry to, for recovery by hand
+
+    :type path: str
+    :type damaged: list
+
+    :return: Every intact scrobble in the file, in order
+    :rtype: generator
+    """
+
+    with open(path, errors="surrogateescape") as scrobbles_file_stream:
+        lines = enumerate(scrobbles_file_stream, 1)
+        for line_number, line in lines:
+            if detect_format(line) == JSONL_FORMAT:
+                yield from iter_jsonl_scrobbles(line, lines, path, damaged)
+            else:
+                yield from iter_yaml_scrobbles(
+                    itertools.chain([(line_number, line)], lines), path, damaged
+                )
+            break
+
+
+def iter_jsonl_scrobbles(header, lines, path, damaged=None):
+    """
+    :param header: The file's first line
+    :param lines: (line number, line) tuples for the rest of the file
+    :param path: The path to the file, for the log
+    :param damaged: (Optional) A list to add every damaged line to
+
+    :return: Every intact scrobble in a JSON Lines cache file, in order
+    :rtype: generator
+    """
+
+    if json.loads(header)["yams_cache"] > CACHE_VERSION:
+        raise ValueError("{} was written by a newer version of YAMS".format(path))
+
+    for line_number, line in lines:
+        if line.strip() == "":
+            continue
+        try:
+            scrobble = json.loads(line)
+            if is_scrobble(scrobble) and UNDECODABLE.search(line) is None:
+                yield scrobble
+                continue
+        except ValueError:
+            pass
+
+        logger.warn("Skipping a damaged scrobble at {}:{}".format(path, line_number))
+        if damaged is not None:
+            damaged.append(line if line.endswith("\n") else line + "\n")
+
+
+def iter_yaml_scrobbles(lines, path, damaged=None):
+    """
+    :param lines: (line number, line) tuples for the whole file
+    :param path: The path to the file, for the log
+    :param damaged: (Optional) A list to add the text of every damaged entry to
+
+    :return: Every intact scrobble in a YAML cache file, in order
+    :rtype: generator
+    """
+
+    header = []
+    # (line number, text) of the entries read but not parsed yet, the last one possibly incomplete
+    entries = []
+    # The indentation of the list's entries, as set by the first one
+    indent = None
+
+    for line_number, line in lines:
+        content = line.lstrip(" ")
+        if content.startswith("- ") and indent in (None, len(line) - len(content)):
+            indent = len(line) - len(content)
+            if len(entries) > ENTRIES_PER_PARSE:
+                yield from parse_scrobble_entries(entries[:-1], path, damaged)
+                entries = entries[-1:]
+            entries.append((line_number, ""))
+        if indent is None:
+            header.append(line)
+            continue
+        line_number, text = entries[-1]
+        entries[-1] = (
+            line_number,
+            text + (line[indent:] if line.startswith(" " * indent) else line),
+        )
+
+    if len(entries) > 0:
+        yield from parse_scrobble_entries(entries, path, damaged)
+    elif indent is None and "".join(header).strip() != "":
+        # Not a list we can take apart (an empty one, or hand written in flow style), read it whole
+        try:
+            scrobbles = yaml.load("".join(header), Loader=YAML_LOADER)
+            if isinstance(scrobbles, dict):
+                scrobbles = scrobbles.get("scrobbles")
+            yield from scrobbles or []
+        except Exception as e:
+            logger.warn("Couldn't read failed scrobbles file {}!: {}".format(path, e))
+
+
+def read_failed_scrobbles_from_disk(path):
+    """
+    Read a whole scrobbles cache file, salvaging everything intact from a damaged one
+
+    :param path: The path to the cached scrobbles file
+    :type path: str
+
+    :return: The cached scrobbles, or an empty list if there's no cache
+    :rtype: list
+    """
+
+    if not os.path.exists(path):
+        return []
+
+    try:
+        scrobbles = list(iter_scrobbles(path))
+    except Exception as e:
+        logger.warn("Couldn't read failed scrobbles file!: {}".format(e))
+        return []
+    if len(scrobbles) > 0:
+        logger.info(
+            "Scrobbles found, read {} from file at {}...".format(len(scrobbles), path)
+        )
+    return scrobbles
+
+
+def truncate_pending_scrobbles_list(count, scrobbles, path_to_cache):
+    """
+    Removes 'count' number of scrobbles from the current cached list and then writes to disk if necessary.
+
+    :param count: The number of scrobbles to remove
+    :param scrobbles: The list of cached scrobbles to remove from
+    :param path_to_cache: The path to the cached scrobbles file, if a write to disk is necessary
+
+    :type count: int
+    :type scrobbles: list
+    :type path_to_cache: str
+
+    :return: The truncated list of scrobbles, or an empty list (if the count to remove was larger than the length of the scrobbles list)
+    :rtype: list
+    """
+
+    if count >= len(scrobbles):
+        logger.debug(
+            "Removing all ({}/{}) scrobbles from cache".format(count, len(scrobbles))
+        )
+
+        if os.path.exists(path_to_cache):
+            logger.debug("Removing scrobble cache: {}".format(path_to_cache))
+            os.remove(path_to_cache)
+
+        return []
+    else:
+        scrobbles = scrobbles[count:]
+        logger.debug(
+            "Removed {} scrobbles from cache, {} left to submit.".format(
+                count, len(scrobbles)
+            )
+        )
+        save_failed_scrobbles_to_disk(path_to_cache, scrobbles)
+
+        return scrobbles
+
+
+def forget(index, scrobble):
+    """Take a scrobble that's left a queue out of that queue's index, a Counter of identities"""
+
+    identity = scrobble.identity()
+    index[identity] -= 1
+    if index[identity] <= 0:
+        del index[identity]
+
+
+def contains_key(keys, key):
+    """:return: True if key is in keys, a sorted array"""
+
+    position = bisect.bisect_left(keys, key)
+    return position < len(keys) and keys[position] == key
+
+
+class AcceptedFilter:
+    """
+    Remembers the scrobbles that recently left the cache for good (almost always because Last.FM accepted
+    them), so one that was sent but never acknowledged, say because we crashed in between, isn't sent twice.
+    Scrobbles are remembered by a 64 bit hash of their identity (see ScrobbleRecord.identity), in two
+    sorted generations of up to 'capacity' keys each. When the newer generation fills up the older one's
+    forgotten, so at least the last 'capacity' scrobbles are always remembered, at 8 bytes apiece.
+
+    On disk the filter's a file of hexadecimal keys, one per line, the older generation first. It's appended
+    to as scrobbles are accepted, and only rewritten when the generations turn over.
+
+    :param path: (Optional) The file to keep the filter in, if None it's only kept in memory
+    :param capacity: (Optional) The most keys per generation
+
+    :type path: str
+    :type capacity: int
+    """
+
+    def __init__(self, path=None, capacity=10000):
+        self.path = path
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.previous = array.array("Q")
+        self.current = array.array("Q")
+        self.stream = None
+
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    @staticmethod
+    def key(scrobble):
+        identity = "\x1f".join(
+            str(part) for part in ScrobbleRecord.of(scrobble).identity()
+        )
+        digest = hashlib.blake2b(identity.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "big")
+
+    def load(self):
+        generations = [[]]
+        try:
+            with open(self.path) as filter_stream:
+                for line in filter_stream:
+                    if line == GENERATION_MARKER:
+                        generations.append([])
+                        continue
+                    try:
+                        generations[-1].append(int(line, 16))
+                    except ValueError:
+                        # Cut short by a crash, the scrobble will just have to be sent again
+                        pass
+        except OSError as e:
+            logger.error(
+                "Couldn't read the accepted scrobbles in {}!: {}".format(self.path, e)
+            )
+            return
+
+        if len(generations) > 1:
+            self.previous = array.array("Q", sorted(generations[-2]))
+        self.current = array.array("Q", sorted(generations[-1]))
+
+    def add(self, scrobbles):
+        """
+        :param scrobbles: Scrobbles that have left the cache for good
+        :type scrobbles: list
+        """
+
+        keys = [self.key(scrobble) for scrobble in scrobbles]
+        with self.lock:
+            unwritten = []
+            for key in keys:
+                if len(self.current) >= self.capacity:
+                    self.previous = self.current
+                    self.current = array.array("Q")
+                    self.rewrite()
+                    unwritten = []
+                bisect.insort(self.current, key)
+                unwritten.append(key)
+
+            if self.path is not None and len(unwritten) > 0:
+                if self.stream is None:
+                    self.stream = open(self.path, "a")
+                self.stream.write("".join("{:016x}\n".format(key) for key in unwritten))
+                self.stream.flush()
+
+    def rewrite(self):
+        """Write the filter out in full, write-then-rename so a crash never leaves half of it"""
+
+        if self.path is None:
+            return
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as filter_stream:
+            filter_stream.write(
+                "".join("{:016x}\n".format(key) for key in self.previous)
+            )
+            filter_stream.write(GENERATION_MARKER)
+            filter_stream.write(
+                "".join("{:016x}\n".format(key) for key in self.current)
+            )
+            filter_stream.flush()
+            os.fsync(filter_stream.fileno())
+        os.replace(temporary_path, self.path)
+
+    def close(self):
+        with self.lock:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+
+    def __len__(self):
+        return len(self.previous) + len(self.current)
+
+    def __contains__(self, scrobble):
+        key = self.key(scrobble)
+        with self.lock:
+            return contains_key(self.current, key) or contains_key(self.previous, key)
+
+
+class FlushPolicy:
+    """
+    Decides when a scrobble store writes its changes to disk. With DURABILITY_ALWAYS every change is written
+    (and synced) as it's made. With DURABILITY_BATCHED a change only marks the store dirty, and changes are
+    written together once there are 'size' of them, 'interval' seconds after the first of them, or when the
+    store's closed, whichever comes first. That's far fewer writes, at the risk of losing the unwritten
+    changes if YAMS is killed outright (a clean shutdown, --kill-daemon included, writes them).
+
+    :param durability: (Optional) DURABILITY_ALWAYS or DURABILITY_BATCHED
+    :param interval: (Optional) The most seconds a change is left unwritten, when batched
+    :param size: (Optional) The most changes left unwritten, when batched
+
+    :type durability: str
+    :type interval: float
+    :type size: int
+    """
+
+    def __init__(self, durability=DURABILITY_ALWAYS, interval=1200, size=10):
+        if durability not in (DURABILITY_ALWAYS, DURABILITY_BATCHED):
+            raise ValueError("Unknown cache_durability: {}".format(durability))
+        self.durability = durability
+        self.interval = interval
+        self.size = size
+        # Changes made since the last write
+        self.dirty = 0
+        self.timer = None
+
+    def changed(self, flush):
+        """
+        Note a change to the store, called with the store's lock held
+
+        :param flush: Writes the store's changes out, for when they've been left unwritten long enough
+        :type flush: function
+
+        :return: True if the store should write its changes now
+        :rtype: bool
+        """
+
+        self.dirty += 1
+        if self.durability == DURABILITY_ALWAYS or self.dirty >= self.size:
+            return True
+        if self.timer is None:
+            self.timer = threading.Timer(self.interval, flush)
+            self.timer.daemon = True
+            self.timer.start()
+        return False
+
+    def flushed(self):
+        """Note the store's written its changes out, called with the store's lock held"""
+
+        self.dirty = 0
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
+class YamlScrobbleStore:
+    """
+    The original failed scrobbles cache: a single YAML file, rewritten in full on every change.
+
+    All scrobble stores share the same interface: enqueue() adds a scrobble to the end of the queue,
+    peek() returns the oldest scrobbles (as ScrobbleRecords), ack() removes the oldest scrobbles once they've been accepted,
+    and len()/in work as they would on a list, except that in compares scrobbles by ScrobbleRecord.identity. Every store
+    also has an 'accepted' AcceptedFilter of the scrobbles that recently left it. Stores are safe to share between threads.
+
+    Stores write their changes to disk as their FlushPolicy says, and flush() writes any that are left
+    unwritten. close() does too.
+
+    :param path: The path to the cached scrobbles file
+    :param accepted: (Optional) The store's AcceptedFilter, an in-memory one if None
+    :param flush_policy: (Optional) When to write changes to disk, every change if None
+
+    :type path: str
+    :type accepted: yams.cache.AcceptedFilter
+    :type flush_policy: yams.cache.FlushPolicy
+    """
+
+    def __init__(self, path, accepted=None, flush_policy=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.accepted = accepted if accepted is not None else AcceptedFilter()
+        self.flush_policy = flush_policy if flush_policy is not None else FlushPolicy()
+        self.scrobbles = [
+            ScrobbleRecord.from_dict(scrobble)
+            for scrobble in read_failed_scrobbles_from_disk(path)
+        ]
+        # How many of each identity are queued, so in doesn't have to look through the queue
+        self.index = collections.Counter(
+            scrobble.identity() for scrobble in self.scrobbles
+        )
+
+    def enqueue(self, scrobble):
+        scrobble = ScrobbleRecord.of(scrobble)
+        with self.lock:
+            self.scrobbles.append(scrobble)
+            self.index[scrobble.identity()] += 1
+            if self.flush_policy.changed(self.flush):
+                self.write()
+
+    def peek(self, count):
+        with self.lock:
+            return self.scrobbles[:count]
+
+    def ack(self, count):
+        with self.lock:
+            for scrobble in self.scrobbles[:count]:
+                forget(self.index, scrobble)
+            self.scrobbles = self.scrobbles[count:]
+            logger.debug(
+                "Removed {} scrobbles from cache, {} left to submit.".format(
+                    count, len(self.scrobbles)
+                )
+            )
+            if self.flush_policy.changed(self.flush):
+                self.write()
+
+    def write(self):
+        """Write the queue to disk, with the lock held"""
+
+        if len(self.scrobbles) > 0:
+            save_failed_scrobbles_to_disk(self.path, self.scrobbles)
+        elif os.path.exists(self.path):
+            logger.debug("Removing scrobble cache: {}".format(self.path))
+            os.remove(self.path)
+        self.flush_policy.flushed()
+
+    def flush(self):
+        with self.lock:
+            if self.flush_policy.dirty > 0:
+                self.write()
+
+    def close(self):
+        self.flush()
+        self.accepted.close()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.scrobbles)
+
+    def __contains__(self, scrobble):
+        identity = ScrobbleRecord.of(scrobble).identity()
+        with self.lock:
+            return identity in self.index
+
+
+class SegmentedLogStore:
+    """
+    An append-only failed scrobbles cache. Scrobbles are appended to numbered segment files, each holding
+    up to segment_size scrobbles in cache_format (see format_header). Accepted scrobbles are never rewritten, instead a small
+    cursor file records the first segment still in use and how many of its scrobbles have been accepted.
+    Segments are deleted as soon as all their scrobbles have been accepted, and the log is compacted on
+    startup if that frees up any segments, or if any of them are in another format (e.g. the YAML segments
+    of older versions), which moves the log over to cache_format once and for all.
+
+    Only the oldest segments, at least 'window' scrobbles' worth, are kept in memory (that's where the next
+    batches come from). Later segments stay on disk until they're needed, with just their size and range
+    of timestamps kept in memory, so a large backlog costs no more memory than a small one. The scrobbles in
+    memory are indexed by identity, so checking whether a scrobble's queued only reads a segment from disk
+    if it's not in memory and its timestamp falls within that segment's range. The identities in the last
+    READ_BACK_SEGMENTS segments read that way are kept, as scrobbles checked one after the other (e.g.
+    listens being imported) tend to fall within the same segment.
+
+    :param directory: The directory holding the segment files
+    :param segment_size: The maximum amount of scrobbles per segment
+    :param legacy_cache_path: (Optional) The path of an old, single file YAML cache to import into the log
+    :param window: (Optional) The least amount of scrobbles to keep in memory, if there are that many
+    :param cache_format: (Optional) The format to write segments in, JSONL_FORMAT or YAML_FORMAT
+    :param accepted: (Optional) The store's AcceptedFilter, an in-memory one if None
+    :param flush_policy: (Optional) When to sync new scrobbles and write the cursor, on every change if None
+
+    :type directory: str
+    :type segment_size: int
+    :type legacy_cache_path: str
+    :type window: int
+    :type cache_format: str
+    :type accepted: yams.cache.AcceptedFilter
+    :type flush_policy: yams.cache.FlushPolicy
+    """
+
+    def __init__(
+        self,
+        directory,
+        segment_size=1000,
+        legacy_cache_path=None,
+        window=1000,
+        cache_format=JSONL_FORMAT,
+        accepted=None,
+        flush_policy=None,
+    ):
+        self.directory = Path(directory)
+        self.segment_size = segment_size
+        self.window = window
+        self.cache_format = cache_format
+        self.lock = threading.Lock()
+        self.accepted = accepted if accepted is not None else AcceptedFilter()
+        self.flush_policy = flush_policy if flush_policy is not None else FlushPolicy()
+        # The (head id, acked) the cursor file should hold, if it's behind
+        self.unwritten_cursor = None
+
+        # The scrobbles of the first 'loaded' segments, minus the ones already accepted
+        self.scrobbles = collections.deque()
+        # How many of each identity are in scrobbles
+        self.index = collections.Counter()
+        self.loaded = 0
+        # [segment id, scrobble count, earliest timestamp, latest timestamp] for every segment on disk, oldest first
+        self.segments = collections.deque()
+        # Segment id to the identities in it, for the last READ_BACK_SEGMENTS segments read by in
+        self.read_back = collections.OrderedDict()
+        # How many scrobbles of the oldest segment have been accepted
+        self.head_acked = 0
+        self.pending = 0
+        self.next_segment_id = 0
+        self.active_stream = None
+        # Segments that aren't in cache_format yet
+        self.foreign_segments = 0
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.load()
+        self.compact()
+
+        if legacy_cache_path is not None and os.path.exists(legacy_cache_path):
+            self.import_legacy_cache(legacy_cache_path)
+
+    def segment_path(self, segment_id, suffix=SEGMENT_SUFFIX):
+        return self.directory / "{:010d}{}".format(segment_id, suffix)
+
+    def segment_ids(self, suffix):
+        ids = []
+        for path in self.directory.iterdir():
+            name = path.name
+            if name.endswith(suffix) and name[: -len(suffix)].isdigit():
+                ids.append(int(name[: -len(suffix)]))
+        return sorted(ids)
+
+    def read_cursor(self):
+        try:
+            with open(self.directory / CURSOR_FILENAME) as cursor_stream:
+                head_id, acked = cursor_stream.read().split()
+                return int(head_id), int(acked)
+        except FileNotFoundError:
+            return 0, 0
+
+    def write_cursor(self, head_id, acked):
+        # Write-then-rename, so a crash never leaves us with a half written cursor
+        temporary_path = self.directory / (CURSOR_FILENAME + ".tmp")
+        with open(temporary_path, "w") as cursor_stream:
+            cursor_stream.write("{} {}\n".format(head_id, acked))
+            cursor_stream.flush()
+            os.fsync(cursor_stream.fileno())
+        os.replace(temporary_path, self.directory / CURSOR_FILENAME)
+        self.unwritten_cursor = None
+
+    def scan_segment(self, segment_id):
+        """
+        Size up a segment without parsing it
+
+        :return: A list of [segment id, scrobble count, earliest timestamp, latest timestamp] (the timestamps are None if there aren't any), and the segment's format
+        :rtype: (list,str)
+        """
+
+        segment = [segment_id, 0, None, None]
+        segment_format = self.cache_format
+        try:
+            with open(
+                self.segment_path(segment_id), errors="surrogateescape"
+            ) as segment_stream:
+                for line_number, line in enumerate(segment_stream):
+                    if line_number == 0:
+                        segment_format = detect_format(line)
+                        if segment_format == JSONL_FORMAT:
+                            continue
+                    if segment_format == JSONL_FORMAT:
+                        if line.strip() != "":
+                            segment[1] += 1
+                        match = TIMESTAMP_FIELD.search(line)
+                    else:
+                        if line.startswith("- "):
+                            segment[1] += 1
+                        match = TIMESTAMP_LINE.match(line)
+                    if match is not None:
+                        timestamp = float(match.group(1))
+                        segment[2] = min(timestamp, segment[2] or timestamp)
+                        segment[3] = max(timestamp, segment[3] or timestamp)
+        except Exception as e:
+            logger.error(
+                "Couldn't read scrobble cache segment {}!: {}".format(segment_id, e)
+            )
+        return segment, segment_format
+
+    def read_segment(self, segment_id):
+        """
+        Read a segment from disk. What can't be read is set aside in a CORRUPT_SEGMENT_SUFFIX file, so it can
+        be recovered by hand, and the segment is rewritten without it (or left empty, if none of it can be
+        read), so it's only ever set aside once. Called with the lock held.
+
+        :return: The segment's intact scrobbles, in order
+        :rtype: list
+        """
+
+        path = self.segment_path(segment_id)
+        corrupt_path = self.segment_path(segment_id, CORRUPT_SEGMENT_SUFFIX)
+        if (
+            self.active_stream is not None
+            and len(self.segments) > 0
+            and segment_id == self.segments[-1][0]
+        ):
+            # Scrobbles may still be waiting in the active segment's write buffer
+            self.active_stream.flush()
+
+        damaged = []
+        # Where each intact scrobble was in the segment, counting the damaged ones before it
+        positions = []
+        try:
+            scrobbles = []
+            for scrobble in iter_scrobbles(path, damaged):
+                positions.append(len(scrobbles) + len(damaged))
+                scrobbles.append(ScrobbleRecord.from_dict(scrobble))
+        except Exception as e:
+            logger.error(
+                "Couldn't read scrobble cache segment {}, moving it aside!: {}".format(
+                    path, e
+                )
+            )
+            self.resize_segment(segment_id, 0)
+            if path.exists():
+                os.replace(path, corrupt_path)
+            return []
+
+        if len(damaged) > 0:
+            logger.error(
+                "Salvaged {} scrobbles from damaged cache segment {}, the {} damaged ones are in {}".format(
+                    len(scrobbles), path, len(damaged), corrupt_path
+                )
+            )
+            with open(corrupt_path, "a", errors="surrogateescape") as corrupt_stream:
+                corrupt_stream.write("".join(damaged))
+            if self.head_acked > 0 and segment_id == self.segments[0][0]:
+                self.recount_head_acked(positions)
+            self.rewrite_segment(segment_id, scrobbles)
+        return scrobbles
+
+    def recount_head_acked(self, positions):
+        """
+        The cursor counts the head segment's accepted scrobbles as they were in the segment, damaged ones
+        included. Count them again as they'll be once the damaged ones are gone, before the segment's rewritten.
+        Should we crash in between, the cursor's only behind: the accepted scrobbles it still counts as pending
+        are left out by the accepted filter when they're sent again.
+
+        :param positions: Where each of the head segment's intact scrobbles was in it
+        :type positions: list
+        """
+
+        acked = sum(1 for position in positions if position < self.head_acked)
+        self.pending += self.head_acked - acked
+        self.head_acked = acked
+        self.write_cursor(self.segments[0][0], acked)
+
+    def resize_segment(self, segment_id, count):
+        """
+        Count a damaged segment as holding count scrobbles, those that could be salvaged from it. Damaged
+        scrobbles were counted when the segment was sized up, this goes by what was actually read.
+        """
+
+        for segment in self.segments:
+            if segment[0] == segment_id:
+                self.pending += count - segment[1]
+                segment[1] = count
+                break
+        if len(self.segments) > 0 and segment_id == self.segments[-1][0]:
+            # The active stream's file is about to be replaced, the next enqueue opens the new one
+            self.close_active_segment()
+
+    def rewrite_segment(self, segment_id, scrobbles):
+        """Replace a damaged segment with the scrobbles salvaged from it"""
+
+        self.resize_segment(segment_id, len(scrobbles))
+        started = time.perf_counter()
+        salvaged_path = self.segment_path(segment_id, SALVAGED_SEGMENT_SUFFIX)
+        with open(salvaged_path, "w") as segment_stream:
+            segment_stream.write(format_header(self.cache_format))
+            for scrobble in scrobbles:
+                segment_stream.write(format_scrobble(scrobble, self.cache_format))
+            written_bytes = self.finish_temporary_segment(segment_stream)
+        os.replace(salvaged_path, self.segment_path(segment_id))
+        record_cache_write("log", written_bytes, time.perf_counter() - started)
+
+    def load(self):
+        head_id, acked = self.read_cursor()
+        self.next_segment_id = head_id
+
+        # A compaction was interrupted. If it got as far as writing the cursor its new segments are the
+        # real ones, otherwise they're throwaway copies
+        temporary_ids = self.segment_ids(TEMPORARY_SEGMENT_SUFFIX)
+        for segment_id in temporary_ids:
+            temporary_path = self.segment_path(segment_id, TEMPORARY_SEGMENT_SUFFIX)
+            if len(temporary_ids) > 0 and temporary_ids[0] == head_id:
+                os.replace(temporary_path, self.segment_path(segment_id))
+            else:
+                os.remove(temporary_path)
+
+        # A damaged segment's rewrite was interrupted, it's still there to be salvaged again
+        for segment_id in self.segment_ids(SALVAGED_SEGMENT_SUFFIX):
+            self.segment_path(segment_id, SALVAGED_SEGMENT_SUFFIX).unlink()
+
+        for segment_id in self.segment_ids(SEGMENT_SUFFIX):
+            if segment_id < head_id:
+                # Fully accepted, we just didn't get around to deleting it
+                self.segment_path(segment_id).unlink(missing_ok=True)
+                continue
+
+            segment, segment_format = self.scan_segment(segment_id)
+            if segment_format != self.cache_format:
+                self.foreign_segments += 1
+            self.segments.append(segment)
+            self.pending += segment[1]
+            self.next_segment_id = segment_id + 1
+
+        if len(self.segments) > 0 and self.segments[0][0] == head_id:
+            self.head_acked = acked
+            self.pending -= acked
+        self.fill(self.window)
+
+        if self.pending > 0:
+            logger.info(
+                "Scrobbles found, {} pending in the log at {}...".format(
+                    self.pending, self.directory
+                )
+            )
+
+    def fill(self, count):
+        """Read segments into memory until there are at least count scrobbles there, or there's nothing left to read"""
+
+        while len(self.scrobbles) < count and self.loaded < len(self.segments):
+            segment = self.segments[self.loaded]
+            scrobbles = self.read_segment(segment[0])
+            # Go by what was actually read, rather than what the segment was sized up as
+            self.pending += len(scrobbles) - segment[1]
+            segment[1] = len(scrobbles)
+            if self.loaded == 0:
+                acked = min(self.head_acked, len(scrobbles))
+                self.pending += self.head_acked - acked
+                self.head_acked = acked
+                scrobbles = scrobbles[acked:]
+
+            self.scrobbles.extend(scrobbles)
+            self.index.update(scrobble.identity() for scrobble in scrobbles)
+            self.loaded += 1
+
+    def iter_pending(self):
+        """Every pending scrobble, oldest first, reading the ones that aren't in memory from disk as we go"""
+
+        yield from list(self.scrobbles)
+        for segment in list(self.segments)[self.loaded :]:
+            yield from self.read_segment(segment[0])
+
+    def compact(self):
+        """
+        Rewrite the pending scrobbles into as few segments as possible in cache_format, dropping accepted
+        ones for good. Only does anything if that frees up at least one segment, or changes a segment's format.
+        """
+
+        needed_segments = -(-self.pending // self.segment_size)
+        if self.foreign_segments == 0 and len(self.segments) <= needed_segments:
+            return
+
+        logger.info(
+            "Compacting scrobble cache at {} ({} format)...".format(
+                self.directory, self.cache_format
+            )
+        )
+        started = time.perf_counter()
+        written_bytes = 0
+        old_segments = [segment[0] for segment in self.segments]
+        next_id = self.next_segment_id
+
+        new_segments = collections.deque()
+        segment_stream = None
+        for scrobble in self.iter_pending():
+            if segment_stream is None or new_segments[-1][1] >= self.segment_size:
+                if segment_stream is not None:
+                    written_bytes += self.finish_temporary_segment(segment_stream)
+                segment_id = next_id + len(new_segments)
+                new_segments.append([segment_id, 0, None, None])
+                segment_stream = open(
+                    self.segment_path(segment_id, TEMPORARY_SEGMENT_SUFFIX), "w"
+                )
+                segment_stream.write(format_header(self.cache_format))
+            segment_stream.write(format_scrobble(scrobble, self.cache_format))
+            extend_segment(new_segments[-1], scrobble)
+        if segment_stream is not None:
+            written_bytes += self.finish_temporary_segment(segment_stream)
+        self.next_segment_id = next_id + len(new_segments)
+
+        # Writing the cursor is what commits the compaction
+        self.write_cursor(next_id, 0)
+        for segment in new_segments:
+            os.replace(
+                self.segment_path(segment[0], TEMPORARY_SEGMENT_SUFFIX),
+                self.segment_path(segment[0]),
+            )
+        for segment_id in old_segments:
+            self.segment_path(segment_id).unlink(missing_ok=True)
+
+        self.segments = new_segments
+        self.foreign_segments = 0
+        self.head_acked = 0
+        self.pending = sum(segment[1] for segment in new_segments)
+        self.scrobbles.clear()
+        self.index.clear()
+        self.read_back.clear()
+        self.loaded = 0
+        self.fill(self.window)
+        record_cache_write("log", written_bytes, time.perf_counter() - started)
+
+    def finish_temporary_segment(self, segment_stream):
+        """Sync and close a segment written by compact, returning its size in bytes"""
+        segment_stream.flush()
+        os.fsync(segment_stream.fileno())
+        written_bytes = segment_stream.tell()
+        segment_stream.close()
+        return written_bytes
+
+    def import_legacy_cache(self, path):
+        logger.info(
+            "Moving the scrobbles in {} into the log at {}".format(path, self.directory)
+        )
+        for scrobble in read_failed_scrobbles_from_disk(path):
+            self.enqueue(scrobble)
+        # They're only safe to delete once they're on disk in the log
+        self.flush()
+        os.remove(path)
+
+    def enqueue(self, scrobble):
+        scrobble = ScrobbleRecord.of(scrobble)
+        with self.lock:
+            if len(self.segments) == 0 or self.segments[-1][1] >= self.segment_size:
+                self.close_active_segment()
+                # A new segment starts out in memory as long as everything before it is, and there's room
+                in_memory = self.loaded == len(self.segments) and (
+                    len(self.segments) == 0 or len(self.scrobbles) < self.window
+                )
+                segment_id = self.next_segment_id
+                self.next_segment_id += 1
+                if len(self.segments) == 0:
+                    self.head_acked = 0
+                    self.write_cursor(segment_id, 0)
+                self.segments.append([segment_id, 0, None, None])
+                if in_memory:
+                    self.loaded += 1
+
+            started = time.perf_counter()
+            entry = format_scrobble(scrobble, self.cache_format)
+            if self.active_stream is None:
+                self.active_stream = open(self.segment_path(self.segments[-1][0]), "a")
+                if self.active_stream.tell() == 0:
+                    entry = format_header(self.cache_format) + entry
+                elif not ends_with_newline(self.segment_path(self.segments[-1][0])):
+                    # Cut short by a crash, keep the damage to the entry that was being written
+                    entry = "\n" + entry
+            self.active_stream.write(entry)
+            if self.flush_policy.changed(self.flush):
+                self.write_changes()
+            record_cache_write("log", len(entry), time.perf_counter() - started)
+
+            extend_segment(self.segments[-1], scrobble)
+            self.pending += 1
+            if self.segments[-1][0] in self.read_back:
+                self.read_back[self.segments[-1][0]].add(scrobble.identity())
+            if self.loaded == len(self.segments):
+                self.scrobbles.append(scrobble)
+                self.index[scrobble.identity()] += 1
+
+    def peek(self, count):
+        with self.lock:
+            self.fill(count)
+            count = min(count, len(self.scrobbles))
+            return [self.scrobbles[i] for i in range(count)]
+
+    def ack(self, count):
+        with self.lock:
+            self.fill(count)
+            count = min(count, len(self.scrobbles))
+            for i in range(count):
+                forget(self.index, self.scrobbles.popleft())
+            self.head_acked += count
+            self.pending -= count
+
+            # Drop every segment that's been accepted in its entirety. The cursor may be written later
+            # than that (see FlushPolicy), which is fine: a cursor pointing at a segment that's gone is ignored
+            while len(self.segments) > 0 and self.head_acked >= self.segments[0][1]:
+                segment_id, segment_count, earliest, latest = self.segments.popleft()
+                self.head_acked -= segment_count
+                self.loaded -= 1
+                if len(self.segments) == 0:
+                    self.close_active_segment()
+                logger.debug("Removing scrobble cache segment: {}".format(segment_id))
+                self.unwritten_cursor = (segment_id + 1, 0)
+                self.segment_path(segment_id).unlink(missing_ok=True)
+
+            if len(self.segments) > 0:
+                self.unwritten_cursor = (self.segments[0][0], self.head_acked)
+            if self.flush_policy.changed(self.flush):
+                self.write_changes()
+
+            logger.debug(
+                "Removed {} scrobbles from cache, {} left to submit.".format(
+                    count, self.pending
+                )
+            )
+
+    def write_changes(self):
+        """Sync the scrobbles appended so far and write the cursor, with the lock held"""
+
+        if self.active_stream is not None:
+            self.active_stream.flush()
+            os.fsync(self.active_stream.fileno())
+        if self.unwritten_cursor is not None:
+            self.write_cursor(*self.unwritten_cursor)
+        self.flush_policy.flushed()
+
+    def flush(self):
+        with self.lock:
+            if self.flush_policy.dirty > 0:
+                self.write_changes()
+
+    def close_active_segment(self):
+        if self.active_stream is not None:
+            self.active_stream.close()
+            self.active_stream = None
+
+    def close(self):
+        with self.lock:
+            if self.flush_policy.dirty > 0:
+                self.write_changes()
+            self.close_active_segment()
+        self.accepted.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.pending
+
+    def __contains__(self, scrobble):
+        identity = ScrobbleRecord.of(scrobble).identity()
+        with self.lock:
+            if identity in self.index:
+                return True
+            # Only look through the segments on disk it could be in
+            timestamp = identity[-1]
+            for segment_id, count, earliest, latest in list(self.segments)[
+                self.loaded :
+            ]:
+                if earliest is not None and not earliest <= timestamp <= latest:
+                    continue
+                if identity in self.read_back_identities(segment_id):
+                    return True
+            return False
+
+    def read_back_identities(self, segment_id):
+        """The identities in a segment on disk, reading it only if it's not one of the last few read. Called with the lock held"""
+
+        if segment_id in self.read_back:
+            self.read_back.move_to_end(segment_id)
+            return self.read_back[segment_id]
+
+        identities = {scrobble.identity() for scrobble in self.read_segment(segment_id)}
+        self.read_back[segment_id] = identities
+        if len(self.read_back) > READ_BACK_SEGMENTS:
+            self.read_back.popitem(last=False)
+        return identities
+
+
+def ends_with_newline(path):
+    with open(path, "rb") as file_stream:
+        file_stream.seek(-1, os.SEEK_END)
+        return file_stream.read(1) == b"\n"
+
+
+def extend_segment(segment, scrobble):
+    """Count a scrobble written to a segment in its [segment id, count, earliest, latest] entry"""
+
+    segment[1] += 1
+    timestamp = float(scrobble.timestamp or 0)
+    segment[2] = timestamp if segment[2] is None else min(segment[2], timestamp)
+    segment[3] = timestamp if segment[3] is None else max(segment[3], timestamp)
+
+
+class SqliteScrobbleStore:
+    """
+    A failed scrobbles cache kept in an SQLite database (in WAL mode). Scrobbles are stored in insertion
+    order, with a unique index on their identity (see ScrobbleRecord.identity), so duplicate checks are
+    index lookups and the oldest scrobbles can be read without loading the rest of the queue.
+
+    :param path: The path to the database file
+    :param legacy_cache_path: (Optional) The path of an old, single file YAML cache to import into the database
+    :param accepted: (Optional) The store's AcceptedFilter, an in-memory one if None
+    :param flush_policy: (Optional) Only its durability is used: SQLite syncs every commit if it's DURABILITY_ALWAYS (or None), and only at WAL checkpoints if it's DURABILITY_BATCHED
+
+    :type path: str
+    :type legacy_cache_path: str
+    :type accepted: yams.cache.AcceptedFilter
+    :type flush_policy: yams.cache.FlushPolicy
+    """
+
+    def __init__(self, path, legacy_cache_path=None, accepted=None, flush_policy=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.accepted = accepted if accepted is not None else AcceptedFilter()
+        self.flush_policy = flush_policy if flush_policy is not None else FlushPolicy()
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        # We're sharing this between threads, the lock keeps that safe
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "PRAGMA synchronous={}".format(
+                "FULL"
+                if self.flush_policy.durability == DURABILITY_ALWAYS
+                else "NORMAL"
+            )
+        )
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS scrobbles ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "artist TEXT NOT NULL, "
+                "track TEXT NOT NULL, "
+                "album TEXT NOT NULL DEFAULT '', "
+                "timestamp REAL NOT NULL, "
+                "scrobble TEXT NOT NULL)"
+            )
+            self.add_album_column()
+            self.connection.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS scrobbles_listen "
+                "ON scrobbles (artist, track, album, timestamp)"
+            )
+
+        self.count = self.connection.execute(
+            "SELECT COUNT(*) FROM scrobbles"
+        ).fetchone()[0]
+        if self.count > 0:
+            logger.info(
+                "Scrobbles found, {} pending in the database at {}...".format(
+                    self.count, path
+                )
+            )
+
+        if legacy_cache_path is not None and os.path.exists(legacy_cache_path):
+            self.import_legacy_cache(legacy_cache_path)
+
+    def add_album_column(self):
+        """
+        Bring a database made by an older YAMS, whose identity index left out the album, up to date.
+        Called in a transaction.
+        """
+
+        columns = [
+            row[1] for row in self.connection.execute("PRAGMA table_info(scrobbles)")
+        ]
+        if "album" in columns:
+            return
+
+        self.connection.execute(
+            "ALTER TABLE scrobbles ADD COLUMN album TEXT NOT NULL DEFAULT ''"
+        )
+        rows = self.connection.execute("SELECT id, scrobble FROM scrobbles").fetchall()
+        self.connection.executemany(
+            "UPDATE scrobbles SET album = ? WHERE id = ?",
+            [
+                (ScrobbleRecord.from_dict(json.loads(entry)).identity()[2], row_id)
+                for row_id, entry in rows
+            ],
+        )
+        self.connection.execute("DROP INDEX IF EXISTS scrobbles_identity")
+
+    def import_legacy_cache(self, path):
+        scrobbles = read_failed_scrobbles_from_disk(path)
+        logger.info(
+            "Moving {} scrobbles from {} into the database at {}".format(
+                len(scrobbles), path, self.path
+            )
+        )
+        with self.lock, self.connection:
+            for scrobble in scrobbles:
+                self.insert(scrobble)
+        os.remove(path)
+
+    def insert(self, scrobble):
+        scrobble = ScrobbleRecord.of(scrobble)
+        entry = json.dumps(scrobble.to_dict())
+        cursor = self.connection.execute(
+            "INSERT OR IGNORE INTO scrobbles (artist, track, album, timestamp, scrobble) "
+            "VALUES (?, ?, ?, ?, ?)",
+            scrobble.identity() + (entry,),
+        )
+        self.count += cursor.rowcount
+        return len(entry)
+
+    def enqueue(self, scrobble):
+        started = time.perf_counter()
+        with self.lock, self.connection:
+            written_bytes = self.insert(scrobble)
+        # Timed past the commit, which is when the write actually hits the disk
+        record_cache_write("sqlite", written_bytes, time.perf_counter() - started)
+
+    def peek(self, count):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT scrobble FROM scrobbles ORDER BY id LIMIT ?", (count,)
+            ).fetchall()
+        return [ScrobbleRecord.from_dict(json.loads(row[0])) for row in rows]
+
+    def ack(self, count):
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "DELETE FROM scrobbles WHERE id IN "
+                "(SELECT id FROM scrobbles ORDER BY id LIMIT ?)",
+                (count,),
+            )
+            self.count -= cursor.rowcount
+            logger.debug(
+                "Removed {} scrobbles from cache, {} left to submit.".format(
+                    cursor.rowcount, self.count
+                )
+            )
+
+    def flush(self):
+        # Every change is committed as it's made
+        pass
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+        self.accepted.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.count
+
+    def __contains__(self, scrobble):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM scrobbles "
+                "WHERE artist = ? AND track = ? AND album = ? AND timestamp = ?",
+                ScrobbleRecord.of(scrobble).identity(),
+            ).fetchone()
+        return row is not None
+
+
+def open_scrobble_store(config):
+    """
+    Open the failed scrobbles cache configured by cache_backend
+
+    :param config: The global config file
+    :type config: dict
+
+    :return: The opened store
+    :rtype: yams.cache.SegmentedLogStore or yams.cache.SqliteScrobbleStore or yams.cache.YamlScrobbleStore
+    """
+
+    cache_file_path = config["cache_file"]
+    backend = config["cache_backend"]
+    if config["cache_format"] not in (JSONL_FORMAT, YAML_FORMAT):
+        raise ValueError("Unknown cache_format: {}".format(config["cache_format"]))
+
+    flush_policy = FlushPolicy(
+        config["cache_durability"],
+        config["cache_flush_interval"],
+        config["cache_flush_size"],
+    )
+    accepted = AcceptedFilter(
+        cache_file_path + ".accepted", config["cache_accepted_size"]
+    )
+    if backend == "yaml":
+        return YamlScrobbleStore(
+            cache_file_path, accepted=accepted, flush_policy=flush_policy
+        )
+    if backend == "sqlite":
+        return SqliteScrobbleStore(
+            cache_file_path + ".sqlite",
+            legacy_cache_path=cache_file_path,
+            accepted=accepted,
+            flush_policy=flush_policy,
+        )
+    if backend == "log":
+        return SegmentedLogStore(
+            cache_file_path + ".d",
+            config["cache_segment_size"],
+            legacy_cache_path=cache_file_path,
+            window=config["cache_window"],
+            cache_format=config["cache_format"],
+            accepted=accepted,
+            flush_policy=flush_policy,
+        )
+
+    raise ValueError("Unknown cache_backend: {}".format(backend))
@@ -8,6 +8,7 @@ from pathlib import Path
 import signal
 import subprocess
 from sys import exit
+from urllib.parse import urlparse
 
 import platformdirs
 import psutil
@@ -37,6 +38,7 @@ DEFAULTS = {
     "scrobble_min_time": 10,
     "watch_threshold": 5,
     "update_interval": 1,
+    "max_update_interval": 15,
     "base_url": "http://ws.audioscrobbler.com/2.0/",
     "mpd_host": "127.0.0.1",
     "mpd_port": "6600",
@@ -46,22 +48,52 @@ DEFAULTS = {
     "allow_same_track_scrobble_in_a_row": False,
     "disable_log": False,
     "no_daemon": False,
+    "http_connect_timeout": 5,
+    "http_read_timeout": 30,
+    "http_pool_size": 4,
+    "http_prewarm": 5,
+    "http_deadline": 45,
+    "http_rate_limit": 5,
+    "http_rate_burst": 10,
+    "http_backoff_base": 10,
+    "http_backoff_max": 1800,
+    "http_circuit_threshold": 3,
+    "response_format": "json",
+    "runtime": "blocking",
+    "cache_backend": "log",
+    "cache_segment_size": 1000,
+    "cache_window": 1000,
+    "cache_format": "jsonl",
+    "cache_accepted_size": 10000,
+    "cache_durability": "always",
+    "cache_flush_interval": 1200,
+    "cache_flush_size": 10,
+    "submission_queue_size": 100,
+    "drain_concurrency": 4,
+    "metrics_listen": "",
+    "metrics_file": "",
+    "metrics_interval": 15,
+    "mpd_record_file": "",
 }
 
+# libyaml's C loader and dumper are many times faster than PyYAML's own, when it's been built with them
+YAML_LOADER = getattr(yaml, "CFullLoader", yaml.FullLoader)
+YAML_DUMPER = getattr(yaml, "CDumper", yaml.Dumper)
+
 logger = logging.getLogger("yams")
 
 
 def write_config_to_file(path, config):
     logger.info("Writing config...")
     with open(path, "w+") as config_stream:
-        yaml.dump(config, config_stream, default_flow_style=False, Dumper=yaml.Dumper)
+        yaml.dump(config, config_stream, default_flow_style=False, Dumper=YAML_DUMPER)
     logger.info("Config written to: {}".format(path))
 
 
 def read_from_file(path, working_config):
     try:
         with open(path) as config_stream:
-            config = yaml.load(config_stream, Loader=yaml.FullLoader)
+            config = yaml.load(config_stream, Loader=YAML_LOADER)
 
             logger.info("Config found, reading from config at {}...".format(path))
             for key in config.keys():
@@ -71,6 +103,73 @@ def read_from_file(path, working_config):
         logger.info("Couldn't open config at path {}!: {}".format(path, e))
 
 
+def player_configs(config):
+    """
+    Split the config up into one config per MPD server to watch. Each entry of the optional 'players' list
+    names an MPD server (mpd_host, mpd_port) and may override any other option for that server alone, most
+    usefully session_file, to scrobble it to a different account. Without a 'players' list the top-level
+    mpd_host and mpd_port make up the one and only player.
+
+    :param config: The YAMS config
+    :type config: dict
+
+    :return: A list of configs, one per player, each with a 'name' to tell them apart in the log
+    :rtype: list
+    """
+
+    entries = config.get("players") or [{}]
+
+    players = []
+    for entry in entries:
+        player = {key: value for key, value in config.items() if key != "players"}
+        player.update(entry)
+        if "name" not in player:
+            player["name"] = "{}:{}".format(player["mpd_host"], player["mpd_port"])
+        players.append(player)
+
+    return players
+
+
+def endpoint_configs(config):
+    """
+    Split the config up into one config per scrobbling service to submit to. Each entry of the optional
+    'endpoints' list may set its own base_url, api_key, api_secret, session_file and cache_file, the rest
+    are taken from the top level. Without an 'endpoints' list the top-level base_url is the only endpoint.
+    Every endpoint past the first gets a session and cache file of its own, named after it, by default.
+
+    :param config: The YAMS (or a player's) config
+    :type config: dict
+
+    :return: A list of configs, one per endpoint, each with a 'name' (the host of its base_url by default)
+    :rtype: list
+    """
+
+    entries = config.get("endpoints") or [{}]
+
+    endpoints = []
+    for index, entry in enumerate(entries):
+        endpoint = {
+            key: value
+            for key, value in config.items()
+            if key not in ("players", "endpoints", "name")
+        }
+        endpoint.update(entry)
+        if "name" not in endpoint:
+            endpoint["name"] = urlparse(endpoint["base_url"]).netloc
+        if index > 0:
+            if "session_file" not in entry:
+                endpoint["session_file"] = "{}.{}".format(
+                    config["session_file"], endpoint["name"]
+                )
+            if "cache_file" not in entry:
+                endpoint["cache_file"] = "{}.{}".format(
+                    config["cache_file"], endpoint["name"]
+                )
+        endpoints.append(endpoint)
+
+    return endpoints
+
+
 def bootstrap_config():
     """Creates a config directory and writes a suitable base config into it"""
 
@@ -343,6 +442,37 @@ def process_cli_args():
         action="store_true",
         help="If set to True will not exit on initial MPD connection failure. (E.g. always reconnect) Default: False",
     )
+    parser.add_argument(
+        "--runtime",
+        type=str,
+        choices=["blocking", "asyncio"],
+        help='Which runtime to watch MPD with. "asyncio" runs MPD events, timers, submissions and cache writes as separate tasks on one event loop. Default: blocking',
+    )
+    parser.add_argument(
+        "--record-mpd",
+        type=str,
+        help="Record every status, currentsong, playlistid and idle response from MPD to this file (gzipped if it ends in .gz), for replaying later with benchmarks/replay.py. Default: Off",
+        metavar="/path/to/recording",
+    )
+    parser.add_argument(
+        "-f",
+        "--flush",
+        action="store_true",
+        help="Send every cached (failed) scrobble to Last.FM, printing progress, and exit. Won't run alongside a running daemon. Default: False",
+    )
+    parser.add_argument(
+        "--import",
+        type=str,
+        nargs="+",
+        dest="import_paths",
+        help="Import the listens in MPD's log files and portable players' .scrobbler.log files into the cache (to be sent like any other cached scrobble), and exit. Importing MPD's log needs MPD running, to look the tracks up. Interrupted imports carry on where they left off. Won't run alongside a running daemon. Default: Off",
+        metavar="/path/to/log",
+    )
+    parser.add_argument(
+        "--import-send",
+        action="store_true",
+        help="Send imported listens to Last.FM straight away, rather than caching them. Default: False",
+    )
     parser.add_argument(
         "-a",
         "--attach",
@@ -489,6 +619,10 @@ def configure():
         config["cache_file"] = args.cache_file
     if args.keep_alive:
         config["keep_alive"] = args.keep_alive
+    if args.runtime:
+        config["runtime"] = args.runtime
+    if args.record_mpd:
+        config["mpd_record_file"] = args.record_mpd
 
     # 5 Sanity check
     if (
@@ -508,6 +642,11 @@ def configure():
     # 6.1 Lets do this after saving the config, as we don't ever really want to save this to disk
     if args.no_daemon:
         config["no_daemon"] = args.no_daemon
+    if args.flush:
+        config["flush"] = args.flush
+    if args.import_paths:
+        config["import"] = args.import_paths
+        config["import_send"] = args.import_send
 
     # 7 Kill or not? (We're doing this all the way down here as the user might have defined a non-standard pid in their config file)
     if args.kill_daemon:
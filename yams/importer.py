@@ -0,0 +1,531 @@
+#!/usr/bin/env python3
+
+import collections
+from datetime import datetime
+import functools
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+from yams.cache import DURABILITY_BATCHED, ScrobbleRecord, open_scrobble_store
+from yams.scrobble import (
+    MAX_TRACKS_PER_SCROBBLE,
+    connect_to_mpd,
+    make_scrobble,
+    send_cached_batch,
+)
+
+logger = logging.getLogger("yams")
+
+# The first line of a portable player's .scrobbler.log, see
+# https://web.archive.org/web/20170107015006/http://www.audioscrobbler.net/wiki/Portable_Player_Logging
+SCROBBLER_LOG_HEADER = "#AUDIOSCROBBLER/"
+# A track starting to play, in MPD's log
+MPD_PLAYED = re.compile(r'player: played "(.*)"\s*$')
+# When it started: newer versions of MPD log an ISO 8601 time, older ones a syslog style one, without the year
+MPD_ISO_TIME = re.compile(r"^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})")
+MPD_SYSLOG_TIME = re.compile(r"^([A-Z][a-z]{2} +\d{1,2} \d{2}:\d{2}(?::\d{2})?) : ")
+# How many of the latest listens to remember, to drop duplicates within the files being imported
+RECENT_LISTENS = 1000
+# How many tracks' tags to remember, when looking up the tracks in MPD's log
+RESOLVED_TRACKS = 4096
+# How often to save the checkpoint, in listens
+CHECKPOINT_INTERVAL = 1000
+# How many files the checkpoint remembers, the least recently imported are forgotten first
+CHECKPOINT_FILES = 100
+# How much of the start of a file to hash, to tell whether it's still the file we checkpointed
+FINGERPRINT_BYTES = 4096
+
+
+def open_listens(path):
+    """Open a file of listens for reading, as bytes, gunzipping it if path ends in .gz"""
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+
+def fingerprint(path, length):
+    """:return: A hash of the first length bytes of path"""
+
+    with open_listens(path) as stream:
+        return hashlib.sha1(stream.read(length)).hexdigest()
+
+
+def read_lines(stream, offset):
+    """
+    Read a stream line by line from offset on
+
+    :return: A generator of (offset of the line's start, offset of its end, line) tuples
+    """
+
+    stream.seek(offset)
+    for raw_line in stream:
+        start = offset
+        offset += len(raw_line)
+        yield start, offset, raw_line.decode("utf-8", errors="replace")
+
+
+class ImportCheckpoint:
+    """
+    Remembers how far into each file an import got, so an interrupted import (or one of a file that's been
+    added to since) carries on from there. Files are told apart by their path, and the hash of their first
+    few bytes: a file that's been replaced, e.g. by log rotation, is imported from the start again. Only the
+    CHECKPOINT_FILES most recently imported files are remembered.
+
+    :param path: The file to keep the checkpoint in
+    :type path: str
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = collections.OrderedDict()
+
+        if os.path.exists(path):
+            try:
+                with open(path) as checkpoint_stream:
+                    self.files.update(json.load(checkpoint_stream))
+            except Exception as e:
+                logger.warn(
+                    "Couldn't read the import checkpoint at {}, importing from the start!: {}".format(
+                        path, e
+                    )
+                )
+
+    def resume_offset(self, path):
+        """
+        :return: Where to carry on importing path from, 0 if it's new (or not what it was)
+        :rtype: int
+        """
+
+        entry = self.files.get(os.path.realpath(path))
+        if entry is None:
+            return 0
+        if (
+            fingerprint(path, min(entry["offset"], FINGERPRINT_BYTES))
+            != entry["fingerprint"]
+        ):
+            logger.info(
+                "{} has changed since it was last imported, importing it from the start".format(
+                    path
+                )
+            )
+            return 0
+        return entry["offset"]
+
+    def update(self, path, offset):
+        key = os.path.realpath(path)
+        self.files[key] = {
+            "offset": offset,
+            "fingerprint": fingerprint(path, min(offset, FINGERPRINT_BYTES)),
+        }
+        self.files.move_to_end(key)
+        while len(self.files) > CHECKPOINT_FILES:
+            self.files.popitem(last=False)
+
+    def save(self):
+        # Write-then-rename, so a crash never leaves us with a half written checkpoint
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as checkpoint_stream:
+            json.dump(self.files, checkpoint_stream)
+            checkpoint_stream.flush()
+            os.fsync(checkpoint_stream.fileno())
+        os.replace(temporary_path, self.path)
+
+
+def local_to_utc(timestamp):
+    """:return: The UTC Unix timestamp of a 'timestamp' that's really the local time, as some portable players log"""
+    return int(time.mktime(time.gmtime(timestamp)[:8] + (-1,)))
+
+
+def parse_scrobbler_log(lines, local_time):
+    """
+    Read the listens out of a .scrobbler.log: tab separated artist, album, title, track number, length,
+    rating (L for listened, S for skipped), timestamp and MusicBrainz ID, one track per line
+
+    :param lines: The log's lines after the header, from read_lines
+    :param local_time: True if the log's timestamps are in local time rather than UTC
+
+    :type lines: generator
+    :type local_time: bool
+
+    :return: A generator of (offset to carry on from, ScrobbleRecord) tuples
+    """
+
+    for start, end, line in lines:
+        if line.startswith("#") or line.strip() == "":
+            continue
+        fields = line.rstrip("\r\n").split("\t")
+        if len(fields) < 7:
+            logger.warn("Skipping malformed .scrobbler.log line: {}".format(line))
+            continue
+
+        artist, album, title, track_number, length, rating, timestamp = fields[:7]
+        if rating != "L" or artist == "" or title == "":
+            continue
+        try:
+            timestamp = int(timestamp)
+        except ValueError:
+            logger.warn("Skipping malformed .scrobbler.log line: {}".format(line))
+            continue
+        if local_time:
+            timestamp = local_to_utc(timestamp)
+
+        track_info = {"artist": artist, "title": title}
+        if album != "":
+            track_info["album"] = album
+        if track_number != "":
+            track_info["track"] = track_number
+        status = {"duration": length} if length != "" else {}
+        yield end, ScrobbleRecord.from_dict(
+            make_scrobble(track_info, status, timestamp=timestamp)
+        )
+
+
+def mpd_log_time(line, now):
+    """
+    :return: When a line of MPD's log was logged, as a UTC Unix timestamp, or None if it doesn't say
+    :rtype: float
+    """
+
+    match = MPD_ISO_TIME.match(line)
+    if match is not None:
+        return time.mktime(
+            datetime.strptime(match.group(1), "%Y-%m-%dT%H:%M:%S").timetuple()
+        )
+
+    match = MPD_SYSLOG_TIME.match(line)
+    if match is None:
+        return None
+    logged = " ".join(match.group(1).split())
+    logged_format = "%Y %b %d %H:%M:%S" if logged.count(":") > 1 else "%Y %b %d %H:%M"
+    year = time.localtime(now).tm_year
+    timestamp = time.mktime(
+        datetime.strptime("{} {}".format(year, logged), logged_format).timetuple()
+    )
+    # No year to go on, so it's the latest time like this that isn't in the future
+    if timestamp > now:
+        timestamp = time.mktime(
+            datetime.strptime(
+                "{} {}".format(year - 1, logged), logged_format
+            ).timetuple()
+        )
+    return timestamp
+
+
+def parse_mpd_log(lines, config, resolve, now=None):
+    """
+    Read the listens out of MPD's log. It only notes when each track started playing, so a track's
+    counted as listened to if the next one started late enough for it to have reached its scrobble point
+    (as the watcher would, see scrobble_threshold and scrobble_min_time), going by its length in MPD's
+    database. The last track in the log is left for when we know how long it played.
+
+    :param lines: The log's lines, from read_lines
+    :param config: The global config file
+    :param resolve: Looks up the tags of a track in MPD's database by its URI, returning None if it's not there
+    :param now: (Optional) The current time, as a UTC Unix timestamp
+
+    :type lines: generator
+    :type config: dict
+    :type resolve: function
+    :type now: float
+
+    :return: A generator of (offset to carry on from, ScrobbleRecord) tuples
+    """
+
+    if now is None:
+        now = time.time()
+    threshold = config["scrobble_threshold"] / 100
+
+    # (timestamp, URI) of the track that's playing as of the last line read
+    playing = None
+    for start, end, line in lines:
+        match = MPD_PLAYED.search(line)
+        if match is None:
+            continue
+        timestamp = mpd_log_time(line, now)
+        if timestamp is None:
+            continue
+
+        if playing is not None:
+            track_info = resolve(playing[1])
+            if track_info is not None:
+                duration = float(
+                    track_info.get("duration", track_info.get("time", 0)) or 0
+                )
+                played = min(timestamp - playing[0], duration)
+                if (
+                    duration > 0
+                    and played >= threshold * duration
+                    and played > config["scrobble_min_time"]
+                ):
+                    # Carrying on from this line gets the track after this one right
+                    yield start, ScrobbleRecord.from_dict(
+                        make_scrobble(track_info, track_info, timestamp=playing[0])
+                    )
+        playing = (timestamp, match.group(1))
+
+
+def read_listens(path, offset, config, resolve=None):
+    """
+    Read the listens in a file, MPD's log or a .scrobbler.log (told apart by the latter's header)
+
+    :param path: The file to read
+    :param offset: Where in the file to start reading
+    :param config: The global config file
+    :param resolve: (Optional) Looks up the tags of a track in MPD's database by its URI, needed for MPD's log
+
+    :type path: str
+    :type offset: int
+    :type config: dict
+    :type resolve: function
+
+    :return: A generator of (offset to carry on from, ScrobbleRecord) tuples
+    """
+
+    with open_listens(path) as stream:
+        scrobbler_log = False
+        header = {}
+        header_end = 0
+        for start, end, line in read_lines(stream, 0):
+            if start == 0:
+                scrobbler_log = line.startswith(SCROBBLER_LOG_HEADER)
+            if not scrobbler_log or not line.startswith("#"):
+                break
+            key, _, value = line.strip()[1:].partition("/")
+            header[key] = value
+            header_end = end
+
+        if scrobbler_log:
+            lines = read_lines(stream, max(offset, header_end))
+            yield from parse_scrobbler_log(lines, header.get("TZ") != "UTC")
+        else:
+            if resolve is None:
+                raise ValueError(
+                    "{} looks like MPD's log, which can only be imported while connected to MPD".format(
+                        path
+                    )
+                )
+            yield from parse_mpd_log(read_lines(stream, offset), config, resolve)
+
+
+def unique_listens(listens, store, recent):
+    """
+    Drop the listens that are already in the cache, were recently sent from it, or came up among the
+    last RECENT_LISTENS listens (e.g. in an overlapping file). Listens are in order, so checking them
+    against the cache reads each of its segments on disk about once (see SegmentedLogStore).
+
+    :param listens: (offset, ScrobbleRecord) tuples, from read_listens
+    :param store: The failed scrobbles cache
+    :param recent: The identities of the latest listens, see ScrobbleRecord.identity. Shared by every file being imported, and added to as we go
+
+    :type listens: generator
+    :type store: yams.cache.SegmentedLogStore
+    :type recent: collections.OrderedDict
+
+    :return: A generator of (offset, ScrobbleRecord) tuples, the ScrobbleRecord None for duplicates
+    """
+
+    for offset, scrobble in listens:
+        identity = scrobble.identity()
+        if identity in recent or scrobble in store or scrobble in store.accepted:
+            yield offset, None
+            continue
+        recent[identity] = True
+        if len(recent) > RECENT_LISTENS:
+            recent.popitem(last=False)
+        yield offset, scrobble
+
+
+def import_listens(
+    paths,
+    store,
+    config,
+    checkpoint,
+    session=None,
+    transport=None,
+    resolve=None,
+    sleep=time.sleep,
+):
+    """
+    Import the listens in files of them, carrying on from wherever the checkpoint says an earlier import
+    left off. Listens are added to the failed scrobbles cache, to be sent by YAMS like any other, or, given
+    a session, sent to Last.FM as we go (at the endpoint's http_rate_limit). If sending fails, the rest of
+    the import goes to the cache instead.
+
+    :param paths: The files to import, see read_listens
+    :param store: The failed scrobbles cache
+    :param config: The global config file
+    :param checkpoint: Where each file's import got to
+    :param session: (Optional) The Session key for last.fm, to send listens with instead of caching them
+    :param transport: (Optional) The HTTP transport to send requests over
+    :param resolve: (Optional) Looks up the tags of a track in MPD's database by its URI, needed for MPD's log
+    :param sleep: (Optional) The function used to wait between requests
+
+    :type paths: list
+    :type store: yams.cache.SegmentedLogStore
+    :type config: dict
+    :type checkpoint: yams.importer.ImportCheckpoint
+    :type session: str
+    :type transport: yams.transport.Transport
+    :type resolve: function
+    :type sleep: function
+
+    :return: A tuple of (imported count of listens, duplicate count of listens)
+    :rtype: (int,int)
+    """
+
+    imported = 0
+    duplicates = 0
+    batch = []
+    # The latest listens of every file, so overlapping files' duplicates are dropped too
+    recent = collections.OrderedDict()
+
+    def submit():
+        nonlocal session
+        if len(batch) < 1:
+            return
+        if session is not None:
+            accepted_count, submitted_count = send_cached_batch(
+                batch, store.accepted, config, session, transport
+            )
+            if submitted_count > 0:
+                batch.clear()
+                if config["http_rate_limit"] > 0:
+                    sleep(1 / config["http_rate_limit"])
+                return
+            logger.warn("Couldn't send imported scrobbles, caching the rest for later.")
+            session = None
+        for scrobble in batch:
+            store.enqueue(scrobble)
+        batch.clear()
+
+    def save(path, offset):
+        submit()
+        # Only once the listens are on disk can the checkpoint say they've been imported
+        store.flush()
+        checkpoint.update(path, offset)
+        checkpoint.save()
+
+    for path in paths:
+        offset = checkpoint.resume_offset(path)
+        if offset > 0:
+            logger.info("Carrying on importing {} from byte {}".format(path, offset))
+        else:
+            logger.info("Importing {}".format(path))
+
+        since_checkpoint = 0
+        for offset, scrobble in unique_listens(
+            read_listens(path, offset, config, resolve), store, recent
+        ):
+            if scrobble is None:
+                duplicates += 1
+            else:
+                batch.append(scrobble)
+                imported += 1
+                if len(batch) >= MAX_TRACKS_PER_SCROBBLE:
+                    submit()
+
+            since_checkpoint += 1
+            if since_checkpoint >= CHECKPOINT_INTERVAL:
+                save(path, offset)
+                since_checkpoint = 0
+                logger.info("Imported {} listens so far".format(imported))
+        save(path, offset)
+
+    return imported, duplicates
+
+
+def mpd_resolver(client):
+    """
+    :param client: A connected MPD client
+    :type client: mpd.MPDClient
+
+    :return: A function looking up a track's tags in MPD's database by its URI, remembering the last RESOLVED_TRACKS
+    :rtype: function
+    """
+
+    @functools.lru_cache(maxsize=RESOLVED_TRACKS)
+    def resolve(uri):
+        try:
+            found = client.find("file", uri)
+        except Exception as e:
+            logger.debug("Couldn't look up {} in MPD: {}".format(uri, e))
+            return None
+        return found[0] if len(found) > 0 else None
+
+    return resolve
+
+
+def import_files(paths, player, endpoints, accounts, transport, send=False):
+    """
+    Import files of listens into every endpoint's cache (or, with send, straight to every endpoint). Used by --import.
+
+    :param paths: The files to import, see read_listens
+    :param player: The config of the player whose MPD to look up MPD log entries in
+    :param endpoints: A dictionary of endpoint name to endpoint config, see resolve_endpoints
+    :param accounts: A dictionary of endpoint name to its (user name, session key) tuples, see endpoint_accounts
+    :param transport: The HTTP transport to send requests over
+    :param send: (Optional) Send the listens as we go, instead of caching them
+
+    :type paths: list
+    :type player: dict
+    :type endpoints: dict
+    :type accounts: dict
+    :type transport: yams.transport.Transport
+    :type send: bool
+
+    :return: True if every file was imported
+    :rtype: bool
+    """
+
+    resolve = None
+    client = None
+    try:
+        client = connect_to_mpd(player["mpd_host"], player["mpd_port"])
+        resolve = mpd_resolver(client)
+    except Exception as e:
+        logger.warn(
+            "Couldn't connect to MPD, so only .scrobbler.log files can be imported: {}".format(
+                e
+            )
+        )
+
+    succeeded = True
+    try:
+        for name, endpoint in endpoints.items():
+            # Anything imported since the last checkpoint is simply read again, so there's no sense in
+            # writing the cache out any more often than that
+            store = open_scrobble_store(
+                dict(
+                    endpoint,
+                    cache_durability=DURABILITY_BATCHED,
+                    cache_flush_size=CHECKPOINT_INTERVAL,
+                )
+            )
+            try:
+                imported, duplicates = import_listens(
+                    paths,
+                    store,
+                    endpoint,
+                    ImportCheckpoint(endpoint["cache_file"] + ".import"),
+                    session=accounts[name][0][1] if send else None,
+                    transport=transport,
+                    resolve=resolve,
+                )
+                logger.info(
+                    "Imported {} listens for {} ({} duplicates skipped), {} scrobbles now cached.".format(
+                        imported, name, duplicates, len(store)
+                    )
+                )
+            except (OSError, ValueError) as e:
+                logger.error("Import for {} failed!: {}".format(name, e))
+                succeeded = False
+            finally:
+                store.close()
+    finally:
+        if client is not None:
+            client.disconnect()
+
+    return succeeded
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+
+import http.server
+import logging
+import os
+from pathlib import Path
+import socketserver
+import threading
+import time
+
+import psutil
+
+logger = logging.getLogger("yams")
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DISK_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+ROUND_TRIP_BUCKETS = (1, 2, 3, 4, 6, 8, 12, 16)
+
+
+class Metrics:
+    """
+    A small, thread safe registry of counters, histograms and gauges, rendered in the Prometheus text
+    exposition format. Counters and histograms are updated as things happen; gauges are functions called
+    whenever the metrics are rendered, so measuring e.g. a queue's depth costs nothing in between.
+    Every metric is identified by its name and a (possibly empty) dictionary of labels.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> (type, help text, histogram buckets)
+        self.descriptions = {}
+        # (name, labels) -> value, for counters; -> [bucket counts, sum, count] for histograms
+        self.values = {}
+        # name -> [function], each returning a value or a dictionary of labels tuple to value
+        self.gauges = {}
+
+    def describe(self, name, metric_type, help_text, buckets=None):
+        self.descriptions[name] = (metric_type, help_text, buckets)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = self.descriptions[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = [[0] * len(buckets), 0, 0]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def total(self, name):
+        """
+        :return: The value of counter 'name', summed over all of its labels
+        :rtype: float
+        """
+        with self.lock:
+            return sum(
+                value
+                for (value_name, labels), value in self.values.items()
+                if value_name == name
+            )
+
+    def gauge(self, name, function):
+        """
+        Register a function reporting the current value of gauge 'name'
+
+        :param name: The gauge's name, as given to describe
+        :param function: Returns either a number, or a dictionary of labels tuple (e.g. (("endpoint", "x"),)) to number
+
+        :type name: str
+        :type function: function
+        """
+        with self.lock:
+            self.gauges.setdefault(name, []).append(function)
+
+    def render(self):
+        """
+        :return: Every metric, in the Prometheus text exposition format
+        :rtype: str
+        """
+
+        with self.lock:
+            values = {
+                key: (
+                    [list(value[0]), value[1], value[2]]
+                    if isinstance(value, list)
+                    else value
+                )
+                for key, value in self.values.items()
+            }
+            gauges = {name: list(functions) for name, functions in self.gauges.items()}
+
+        samples = {}
+        for (name, labels), value in values.items():
+            samples.setdefault(name, []).append((labels, value))
+
+        for name, functions in gauges.items():
+            for function in functions:
+                try:
+                    value = function()
+                except Exception as e:
+                    logger.debug("Could not read gauge {}: {}".format(name, e))
+                    continue
+                if isinstance(value, dict):
+                    samples.setdefault(name, []).extend(value.items())
+                else:
+                    samples.setdefault(name, []).append(((), value))
+
+        lines = []
+        for name in sorted(samples):
+            metric_type, help_text, buckets = self.descriptions.get(
+                name, ("untyped", "", None)
+            )
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+
+            for labels, value in sorted(samples[name], key=lambda sample: sample[0]):
+                if metric_type != "histogram":
+                    lines.append("{}{} {}".format(name, format_labels(labels), value))
+                    continue
+
+                counts, total, count = value
+                for bound, bucket_count in zip(buckets, counts):
+                    lines.append(
+                        "{}_bucket{} {}".format(
+                            name, format_labels(labels + (("le", bound),)), bucket_count
+                        )
+                    )
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        name, format_labels(labels + (("le", "+Inf"),)), count
+                    )
+                )
+                lines.append("{}_sum{} {}".format(name, format_labels(labels), total))
+                lines.append("{}_count{} {}".format(name, format_labels(labels), count))
+
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if len(labels) < 1:
+        return ""
+    return (
+        "{"
+        + ",".join(
+            '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+            for key, value in labels
+        )
+        + "}"
+    )
+
+
+METRICS = Metrics()
+
+METRICS.describe(
+    "yams_mpd_commands_total", "counter", "Commands sent to MPD, by command"
+)
+METRICS.describe(
+    "yams_mpd_roundtrips_per_iteration",
+    "histogram",
+    "MPD round-trips made by one iteration of the watch loop",
+    ROUND_TRIP_BUCKETS,
+)
+METRICS.describe(
+    "yams_mpd_reconnects_total", "counter", "Times the connection to MPD was re-made"
+)
+METRICS.describe(
+    "yams_http_request_duration_seconds",
+    "histogram",
+    "Time taken by requests to the scrobbling API, by API method and HTTP status",
+    LATENCY_BUCKETS,
+)
+METRICS.describe(
+    "yams_scrobbles_accepted_total", "counter", "Scrobbles accepted, by API host"
+)
+METRICS.describe(
+    "yams_scrobbles_ignored_total", "counter", "Scrobbles ignored, by API host"
+)
+METRICS.describe(
+    "yams_submission_queue_depth",
+    "gauge",
+    "Requests waiting for the submission worker",
+)
+METRICS.describe(
+    "yams_pending_scrobbles", "gauge", "Scrobbles waiting in the failed scrobbles cache"
+)
+METRICS.describe(
+    "yams_pending_scrobbles_oldest_age_seconds",
+    "gauge",
+    "How long ago the oldest scrobble in the failed scrobbles cache was played",
+)
+METRICS.describe(
+    "yams_cache_write_bytes_total", "counter", "Bytes written to the scrobbles cache"
+)
+METRICS.describe(
+    "yams_cache_write_duration_seconds",
+    "histogram",
+    "Time taken by writes to the scrobbles cache",
+    DISK_BUCKETS,
+)
+METRICS.describe(
+    "yams_process_resident_memory_bytes", "gauge", "Resident memory size in bytes"
+)
+METRICS.describe(
+    "yams_process_cpu_seconds_total", "counter", "User and system CPU time spent"
+)
+METRICS.describe("yams_process_open_fds", "gauge", "Open file descriptors")
+
+
+def process_gauges():
+    # Only measure once, even with more than one exporter
+    if "yams_process_resident_memory_bytes" in METRICS.gauges:
+        return
+
+    process = psutil.Process()
+
+    def cpu_seconds():
+        times = process.cpu_times()
+        return times.user + times.system
+
+    METRICS.gauge(
+        "yams_process_resident_memory_bytes", lambda: process.memory_info().rss
+    )
+    METRICS.gauge("yams_process_cpu_seconds_total", cpu_seconds)
+    if hasattr(process, "num_fds"):
+        METRICS.gauge("yams_process_open_fds", process.num_fds)
+
+
+def record_cache_write(backend, written_bytes, duration):
+    METRICS.inc("yams_cache_write_bytes_total", written_bytes, backend=backend)
+    METRICS.observe("yams_cache_write_duration_seconds", duration, backend=backend)
+
+
+def store_gauges(endpoint, failed_scrobbles, queue_depth=None):
+    """
+    Report on an endpoint's failed scrobbles cache (and submission queue) whenever metrics are rendered
+
+    :param endpoint: The endpoint's name
+    :param failed_scrobbles: The endpoint's failed scrobbles cache
+    :param queue_depth: (Optional) Returns the amount of requests waiting to be sent to the endpoint
+
+    :type endpoint: str
+    :type failed_scrobbles: yams.cache.SegmentedLogStore
+    :type queue_depth: function
+    """
+
+    labels = (("endpoint", endpoint),)
+
+    def oldest_age():
+        oldest = failed_scrobbles.peek(1)
+        if len(oldest) < 1:
+            return {labels: 0}
+        return {labels: max(time.time() - float(oldest[0].timestamp), 0)}
+
+    METRICS.gauge("yams_pending_scrobbles", lambda: {labels: len(failed_scrobbles)})
+    METRICS.gauge("yams_pending_scrobbles_oldest_age_seconds", oldest_age)
+    if queue_depth is not None:
+        METRICS.gauge("yams_submission_queue_depth", lambda: {labels: queue_depth()})
+
+
+class CountingMPDClient:
+    """
+    Wraps an MPD client, counting every command sent through it. Everything else is passed straight through.
+    An idle split in two (send_idle, then fetch_idle) is counted once, as idle.
+
+    :param client: The MPD client object
+    :type client: mpd.MPDClient
+    """
+
+    NOT_COMMANDS = {"connect", "disconnect", "fileno", "fetch_idle"}
+    ALIASES = {"send_idle": "idle"}
+
+    def __init__(self, client):
+        self.client = client
+        self.round_trips = 0
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute) or name in CountingMPDClient.NOT_COMMANDS:
+            return attribute
+
+        def command(*args, **kwargs):
+            self.round_trips += 1
+            METRICS.inc(
+                "yams_mpd_commands_total",
+                command=CountingMPDClient.ALIASES.get(name, name),
+            )
+            return attribute(*args, **kwargs)
+
+        return command
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = METRICS.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixMetricsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class MetricsExporter:
+    """
+    Exposes METRICS, as configured: served over HTTP from metrics_listen (either "host:port", or
+    "unix:/path/to/socket"), and/or written to metrics_file every metrics_interval seconds.
+
+    :param config: The YAMS config
+    :type config: dict
+    """
+
+    def __init__(self, config):
+        self.listen = config["metrics_listen"]
+        self.path = config["metrics_file"]
+        self.interval = config["metrics_interval"]
+
+        self.server = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        process_gauges()
+
+        if self.listen:
+            if self.listen.startswith("unix:"):
+                socket_path = self.listen[len("unix:") :]
+                if os.path.exists(socket_path):
+                    os.remove(socket_path)
+                self.server = UnixMetricsServer(socket_path, MetricsHandler)
+            else:
+                host, port = self.listen.rsplit(":", 1)
+                self.server = http.server.ThreadingHTTPServer(
+                    (host, int(port)), MetricsHandler
+                )
+            threading.Thread(
+                target=self.server.serve_forever, name="yams-metrics", daemon=True
+            ).start()
+            logger.info("Serving metrics on {}".format(self.listen))
+
+        if self.path:
+            threading.Thread(
+                target=self.write_periodically, name="yams-metrics-file", daemon=True
+            ).start()
+
+    def write(self):
+        temporary_path = "{}.tmp".format(self.path)
+        with open(temporary_path, "w") as metrics_stream:
+            metrics_stream.write(METRICS.render())
+        os.replace(temporary_path, self.path)
+
+    def write_periodically(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except Exception as e:
+                logger.warn("Could not write metrics to {}: {}".format(self.path, e))
+
+    def close(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            if self.listen.startswith("unix:"):
+                Path(self.listen[len("unix:") :]).unlink(missing_ok=True)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import gzip
+import json
+import logging
+import time
+
+logger = logging.getLogger("yams")
+
+RECORDING_VERSION = 1
+
+
+def open_recording(path, mode="r"):
+    """
+    Open a recording of MPD's responses, gzipped if path ends in .gz
+
+    :param path: The recording's path
+    :param mode: (Optional) "r" to read it, "a" to add to it
+
+    :type path: str
+    :type mode: str
+
+    :return: A text stream
+    """
+
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    # Line buffered, so a recording cut short by a crash loses at most one response
+    return open(path, mode, encoding="utf-8", buffering=1)
+
+
+class RecordingMPDClient:
+    """
+    Wraps an MPD client, writing every response to status, currentsong, playlistid and idle to a recording, along
+    with when it arrived. Everything else is passed straight through.
+
+    A recording is a JSON Lines file: a header object every time recording starts (e.g. after a reconnect),
+    followed by one [time, command, response] array per response. Gzipped recordings are only flushed
+    before idling, when nothing's going on, plain ones after every line.
+
+    :param client: The MPD client object
+    :param stream: The recording, as opened by open_recording(path, "a")
+    :param player: (Optional) The name of the player being recorded, for the header
+    :param clock: (Optional) The function used to tell the time, in seconds since the Epoch
+
+    :type client: mpd.MPDClient
+    :type stream: io.TextIOBase
+    :type player: str
+    :type clock: function
+    """
+
+    RECORDED = {"status", "currentsong", "playlistid", "idle", "fetch_idle", "noidle"}
+    # The second half of an idle split in two is recorded as the idle it finishes
+    ALIASES = {"fetch_idle": "idle", "noidle": "idle"}
+
+    def __init__(self, client, stream, player=None, clock=time.time):
+        self.client = client
+        self.stream = stream
+        self.clock = clock
+
+        self.write(
+            {"yams_recording": RECORDING_VERSION, "player": player, "started": clock()}
+        )
+
+    def write(self, entry):
+        self.stream.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name == "send_idle":
+            self.stream.flush()
+        if not callable(attribute) or name not in RecordingMPDClient.RECORDED:
+            return attribute
+
+        def command(*args, **kwargs):
+            if name == "idle":
+                self.stream.flush()
+            response = attribute(*args, **kwargs)
+            self.write(
+                [
+                    round(self.clock(), 3),
+                    RecordingMPDClient.ALIASES.get(name, name),
+                    response,
+                ]
+            )
+            return response
+
+        return command
+
+    def close(self):
+        try:
+            self.stream.close()
+        except Exception as e:
+            logger.warn("Could not close the MPD recording: {}".format(e))
+
+
+def read_recording(path):
+    """
+    Read a recording back, as written by RecordingMPDClient
+
+    :param path: The recording's path
+    :type path: str
+
+    :return: Every recorded response, as a (time, command, response) tuple, in the order they arrived
+    :rtype: list
+    """
+
+    responses = []
+    with open_recording(path) as recording_stream:
+        try:
+            for line in recording_stream:
+                line = line.strip()
+                if line == "":
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Most likely the last line, cut short by a crash
+                    logger.warn("Skipping a damaged line in {}".format(path))
+                    continue
+                if isinstance(entry, dict):
+                    if entry.get("yams_recording", 0) > RECORDING_VERSION:
+                        raise ValueError(
+                            "{} was recorded by a newer version of YAMS".format(path)
+                        )
+                    continue
+                responses.append(tuple(entry))
+        except EOFError:
+            logger.warn("{} ends abruptly, replaying what's there".format(path))
+
+    return responses
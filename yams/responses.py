@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+from collections import namedtuple
+import json
+import xml.etree.ElementTree as ET
+
+# What to ask the API to answer in, see make_request
+FORMAT_JSON = "json"
+FORMAT_XML = "xml"
+FORMATS = (FORMAT_JSON, FORMAT_XML)
+
+Session = namedtuple("Session", ["name", "key"])
+ScrobbleCounts = namedtuple("ScrobbleCounts", ["accepted", "ignored"])
+
+
+def parse_response(body):
+    """
+    Parse a response from the Last.FM API straight from its bytes. What's in it decides how it's parsed,
+    not what was asked for: services without JSON answer in XML whatever the format parameter says.
+
+    :param body: The body of the response
+    :type body: bytes
+
+    :raises ValueError: If the body is neither JSON nor XML
+
+    :rtype: yams.responses.JSONResponse or yams.responses.XMLResponse
+    """
+
+    if body.lstrip()[:1] == b"{":
+        return JSONResponse(json.loads(body))
+    try:
+        return XMLResponse(ET.fromstring(body))
+    except ET.ParseError as e:
+        # Not a ValueError, unlike json's
+        raise ValueError("Couldn't parse the response: {}".format(e)) from e
+
+
+class JSONResponse:
+    """
+    A response in the API's JSON format, e.g. {"token": "..."}, or {"error": 9, "message": "..."} if it failed
+
+    :param document: The parsed JSON
+    :type document: dict
+    """
+
+    def __init__(self, document):
+        self.document = document
+
+    def failed(self):
+        return "error" in self.document
+
+    def error(self):
+        """
+        :return: Last.FM's error code and message, or (None, "") if there isn't one
+        :rtype: (int,str)
+        """
+        if "error" not in self.document:
+            return None, ""
+        return int(self.document["error"]), str(self.document.get("message", ""))
+
+    def token(self):
+        return self.document["token"]
+
+    def session(self):
+        session = self.document["session"]
+        return Session(session["name"], session["key"])
+
+    def scrobble_counts(self):
+        """
+        :raises ValueError: If there are no counts in the response
+        :rtype: yams.responses.ScrobbleCounts
+        """
+        try:
+            counts = self.document["scrobbles"]["@attr"]
+        except (KeyError, TypeError):
+            raise ValueError("No scrobble counts in the response")
+        return ScrobbleCounts(
+            int(counts.get("accepted", 0)), int(counts.get("ignored", 0))
+        )
+
+
+class XMLResponse:
+    """
+    A response in the API's XML format, e.g. <lfm status="ok"><token>...</token></lfm>
+
+    :param root: The parsed XML's root (lfm) element
+    :type root: xml.etree.ElementTree.Element
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def failed(self):
+        return self.root.get("status") == "failed"
+
+    def error(self):
+        """
+        :return: Last.FM's error code and message, or (None, "") if there isn't one
+        :rtype: (int,str)
+        """
+        error = self.root.find("error")
+        if error is None:
+            return None, ""
+        return int(error.get("code")), (error.text or "").strip()
+
+    def token(self):
+        return self.root.find("token").text
+
+    def session(self):
+        session = self.root.find("session")
+        return Session(session.find("name").text, session.find("key").text)
+
+    def scrobble_counts(self):
+        """
+        :raises ValueError: If there are no counts in the response
+        :rtype: yams.responses.ScrobbleCounts
+        """
+        scrobbles = self.root.find("scrobbles")
+        if scrobbles is None:
+            raise ValueError("No scrobble counts in the response")
+        return ScrobbleCounts(
+            int(scrobbles.get("accepted", 0)), int(scrobbles.get("ignored", 0))
+        )
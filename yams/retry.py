@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+
+import logging
+import random
+import threading
+import time
+
+from yams.responses import parse_response
+
+logger = logging.getLogger("yams")
+
+# What a failed request tells us, and so what to do about it
+UNAVAILABLE = "unavailable"
+RATE_LIMITED = "rate_limited"
+INVALID_SESSION = "invalid_session"
+PERMANENT = "permanent"
+
+# Last.FM's error codes, see https://www.last.fm/api/errorcodes. Anything not in here is retried as if
+# the service were unavailable, that's the safest bet for a scrobble
+ERROR_KINDS = {
+    # Operation failed, service offline, temporarily unavailable
+    8: UNAVAILABLE,
+    11: UNAVAILABLE,
+    16: UNAVAILABLE,
+    29: RATE_LIMITED,
+    # Invalid session key, authentication failed, invalid or suspended API key: sending the same thing
+    # again won't help until the user re-authenticates (or fixes their config), but it will once they do
+    4: INVALID_SESSION,
+    9: INVALID_SESSION,
+    10: INVALID_SESSION,
+    26: INVALID_SESSION,
+    # Invalid service, method, format, parameters or signature: this request will never be accepted
+    2: PERMANENT,
+    3: PERMANENT,
+    5: PERMANENT,
+    6: PERMANENT,
+    7: PERMANENT,
+    13: PERMANENT,
+}
+
+# How long to leave an account be after being told its session is invalid
+INVALID_SESSION_BACKOFF = 60 * 60
+
+
+class LastFMError(Exception):
+    """
+    A request Last.FM (or the network) turned down
+
+    :param kind: What to do about it: UNAVAILABLE, RATE_LIMITED, INVALID_SESSION or PERMANENT
+    :param code: (Optional) Last.FM's error code, if it sent one
+    :param message: (Optional) Last.FM's (or our) description of the error
+    :param retry_after: (Optional) Seconds the server asked us to wait before trying again
+
+    :type kind: str
+    :type code: int
+    :type message: str
+    :type retry_after: float
+    """
+
+    def __init__(self, kind, code=None, message="", retry_after=None):
+        super().__init__(
+            "{} (error {}): {}".format(kind, code, message)
+            if code is not None
+            else "{}: {}".format(kind, message)
+        )
+        self.kind = kind
+        self.code = code
+        self.message = message
+        self.retry_after = retry_after
+
+    @property
+    def permanent(self):
+        return self.kind == PERMANENT
+
+
+class RequestThrottled(LastFMError):
+    """A request we didn't send, because the endpoint's retry policy holds off for now"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(UNAVAILABLE, None, message, retry_after)
+
+
+def parse_error(status_code, body, headers=None):
+    """
+    Work out what a failed response means
+
+    :param status_code: The HTTP status of the response
+    :param body: The body of the response, Last.FM's JSON or XML if we're lucky
+    :param headers: (Optional) The response's headers, for Retry-After
+
+    :type status_code: int
+    :type body: bytes
+    :type headers: dict
+
+    :rtype: yams.retry.LastFMError
+    """
+
+    code = None
+    message = ""
+    try:
+        code, message = parse_response(body).error()
+    except Exception:
+        pass
+
+    retry_after = None
+    if headers is not None and headers.get("Retry-After", "").isdigit():
+        retry_after = float(headers["Retry-After"])
+
+    if code is not None:
+        kind = ERROR_KINDS.get(code, UNAVAILABLE)
+    elif status_code == 429:
+        kind = RATE_LIMITED
+    else:
+        # No code to go on (a proxy, an outage page...), so assume it'll pass
+        kind = UNAVAILABLE
+
+    return LastFMError(
+        kind, code, message or "HTTP {}".format(status_code), retry_after
+    )
+
+
+class Backoff:
+    """
+    Exponential backoff with jitter: the delay doubles with every consecutive failure, up to a maximum, and
+    a random part of it (up to half) is taken off so clients that failed together don't retry together.
+
+    :param base: The delay after the first failure, in seconds
+    :param maximum: The longest delay, in seconds
+    :param rng: (Optional) Where the jitter comes from
+
+    :type base: float
+    :type maximum: float
+    :type rng: random.Random
+    """
+
+    def __init__(self, base, maximum, rng=None):
+        self.base = base
+        self.maximum = maximum
+        self.rng = rng if rng is not None else random.Random()
+
+    def delay(self, failures):
+        """
+        :param failures: The amount of consecutive failures so far, at least 1
+        :type failures: int
+
+        :rtype: float
+        """
+        ceiling = min(self.maximum, self.base * 2 ** min(max(failures - 1, 0), 32))
+        return ceiling / 2 + self.rng.uniform(0, ceiling / 2)
+
+
+class TokenBucket:
+    """
+    Limits how often requests go out: every request takes a token, and tokens come back at 'rate' a second,
+    up to 'capacity' of them (so short bursts are fine).
+
+    :param rate: Tokens added per second, 0 for no limit
+    :param capacity: The most tokens the bucket holds
+    :param clock: (Optional) The function used to tell the time, in seconds
+
+    :type rate: float
+    :type capacity: float
+    :type clock: function
+    """
+
+    def __init__(self, rate, capacity, clock=time.time):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """
+        :return: True if there was a token to take, False if the request should wait
+        :rtype: bool
+        """
+        if self.rate <= 0:
+            return True
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def empty(self):
+        self.refill()
+        self.tokens = 0
+
+    def time_until_available(self):
+        if self.rate <= 0:
+            return 0
+        self.refill()
+        return max((1 - self.tokens) / self.rate, 0)
+
+
+class CircuitBreaker:
+    """
+    Stops us from hammering an endpoint that's down. After 'threshold' failures in a row the circuit opens,
+    and nothing's sent until it's due to close again. Then one request is let through to try the waters:
+    if it succeeds the circuit closes, if it fails it opens again, for longer (see Backoff).
+
+    :param threshold: Consecutive failures after which the circuit opens
+    :param backoff: How long to stay open, by consecutive failures
+    :param clock: (Optional) The function used to tell the time, in seconds
+
+    :type threshold: int
+    :type backoff: yams.retry.Backoff
+    :type clock: function
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold, backoff, clock=time.time):
+        self.threshold = threshold
+        self.backoff = backoff
+        self.clock = clock
+
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_until = 0
+
+    def allow(self):
+        if self.state == CircuitBreaker.CLOSED:
+            return True
+        if self.state == CircuitBreaker.OPEN and self.clock() >= self.opened_until:
+            # Let one request through, the rest wait to hear how it went
+            self.state = CircuitBreaker.HALF_OPEN
+            return True
+        return False
+
+    def release(self):
+        """Give the half-open circuit's one request back, if it was taken by a request that's not going out"""
+        if self.state == CircuitBreaker.HALF_OPEN:
+            self.state = CircuitBreaker.OPEN
+
+    def succeeded(self):
+        if self.state != CircuitBreaker.CLOSED:
+            logger.info("The endpoint is back, closing the circuit.")
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+
+    def failed(self, hold_off=None):
+        """
+        :param hold_off: (Optional) Open the circuit for at least this many seconds, whatever the failure count
+        :type hold_off: float
+        """
+
+        self.failures += 1
+        if (
+            self.failures < self.threshold
+            and hold_off is None
+            and self.state == CircuitBreaker.CLOSED
+        ):
+            return
+
+        seconds = max(self.backoff.delay(self.failures), hold_off or 0)
+        if self.state != CircuitBreaker.OPEN:
+            logger.warn(
+                "Opening the circuit after {} failed requests, holding off for {}s.".format(
+                    self.failures, format(seconds, ".0f")
+                )
+            )
+        self.state = CircuitBreaker.OPEN
+        self.opened_until = self.clock() + seconds
+
+    def time_until_closed(self):
+        if self.state == CircuitBreaker.OPEN:
+            return max(self.opened_until - self.clock(), 0)
+        return 0
+
+
+class RetryPolicy:
+    """
+    Decides when requests to one endpoint may go out, going by how the last ones went. Thread safe: the
+    submission worker, drains and now playing updates all share one per endpoint.
+
+    * Unavailable (Last.FM errors 8, 11, 16, 5xx responses, timeouts and connection errors): retried with
+      exponential backoff, and the circuit opens after a few in a row.
+    * Rate limited (29, HTTP 429): the circuit opens for at least as long as we're asked to wait, and the
+      token bucket is emptied.
+    * Invalid session (9, and other authentication problems): the account's scrobbles stay cached, and
+      the cache is only retried every INVALID_SESSION_BACKOFF seconds. That's the whole endpoint's cache,
+      every account's scrobbles in it included, since it's sent in order. The circuit stays closed, so
+      requests that don't go through the cache (e.g. now playing updates) still go out.
+    * Permanent (invalid parameters or signature): the endpoint's fine, the request is just never retried.
+
+    :param rate: Requests allowed per second, on average, 0 for no limit
+    :param burst: Requests allowed in a burst
+    :param backoff_base: Seconds to back off after the first failure
+    :param backoff_max: The longest to back off for, in seconds
+    :param failure_threshold: Failures in a row after which the circuit opens
+    :param clock: (Optional) The function used to tell the time, in seconds
+
+    :type rate: float
+    :type burst: float
+    :type backoff_base: float
+    :type backoff_max: float
+    :type failure_threshold: int
+    :type clock: function
+    """
+
+    def __init__(
+        self,
+        rate=5,
+        burst=10,
+        backoff_base=10,
+        backoff_max=1800,
+        failure_threshold=3,
+        clock=time.time,
+    ):
+        self.clock = clock
+        self.lock = threading.Lock()
+
+        self.backoff = Backoff(backoff_base, backoff_max)
+        self.bucket = TokenBucket(rate, burst, clock)
+        self.breaker = CircuitBreaker(failure_threshold, self.backoff, clock)
+        # When it's next worth re-sending cached scrobbles
+        self.next_retry = 0
+
+    def acquire(self):
+        """
+        Ask to send a request now
+
+        :raises yams.retry.RequestThrottled: If it shouldn't go out yet
+        """
+
+        with self.lock:
+            if not self.breaker.allow():
+                raise RequestThrottled(
+                    "The circuit is open", self.breaker.time_until_closed()
+                )
+            if not self.bucket.take():
+                # If this was to be the half-open circuit's one request, let the next one be it instead
+                self.breaker.release()
+                raise RequestThrottled(
+                    "Sending requests too quickly", self.bucket.time_until_available()
+                )
+
+    def succeeded(self):
+        with self.lock:
+            self.breaker.succeeded()
+            self.next_retry = 0
+
+    def failed(self, error):
+        """
+        :param error: Why the request failed
+        :type error: yams.retry.LastFMError
+        """
+
+        with self.lock:
+            now = self.clock()
+            if error.kind == UNAVAILABLE:
+                self.breaker.failed()
+                self.next_retry = now + self.backoff.delay(self.breaker.failures)
+            elif error.kind == RATE_LIMITED:
+                self.bucket.empty()
+                hold_off = max(
+                    error.retry_after or 0,
+                    self.backoff.delay(self.breaker.failures + 1),
+                )
+                self.breaker.failed(hold_off)
+                self.next_retry = now + hold_off
+            elif error.kind == INVALID_SESSION:
+                logger.error(
+                    "Last.FM says a session is invalid ({}). Its scrobbles are kept, but won't be sent until you re-authenticate: delete the session file and restart YAMS.".format(
+                        error
+                    )
+                )
+                self.next_retry = now + INVALID_SESSION_BACKOFF
+
+    def retry_delay(self, minimum):
+        """
+        :param minimum: The shortest delay to return, in seconds
+        :type minimum: float
+
+        :return: Seconds until it's worth re-sending cached scrobbles
+        :rtype: float
+        """
+
+        with self.lock:
+            return max(
+                minimum,
+                self.next_retry - self.clock(),
+                self.breaker.time_until_closed(),
+            )
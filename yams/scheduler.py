@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import heapq
+import itertools
+import time
+
+
+class Scheduler:
+    """
+    A heap of named deadlines. Lets a loop sleep until the next thing it actually cares about (a track
+    crossing its scrobble threshold, a retry being due, etc.) instead of waking up on a fixed interval.
+    Scheduling a name that's already scheduled moves its deadline. Not thread safe, give every thread its own.
+
+    :param clock: (Optional) The function used to tell the time, in seconds
+    :type clock: function
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.heap = []
+        # The live deadline of every scheduled name. Heap entries that don't match it are stale, and skipped
+        self.deadlines = {}
+        self.counter = itertools.count()
+
+    def schedule(self, name, when):
+        """
+        Set the deadline for name, replacing any it had before
+
+        :param name: What's due
+        :param when: When it's due, as given by the clock
+
+        :type name: str
+        :type when: float
+        """
+        entry = (when, next(self.counter), name)
+        self.deadlines[name] = entry
+        heapq.heappush(self.heap, entry)
+
+    def schedule_in(self, name, seconds):
+        self.schedule(name, self.clock() + seconds)
+
+    def cancel(self, name):
+        self.deadlines.pop(name, None)
+
+    def is_scheduled(self, name):
+        return name in self.deadlines
+
+    def discard_stale(self):
+        while (
+            len(self.heap) > 0
+            and self.deadlines.get(self.heap[0][2]) is not self.heap[0]
+        ):
+            heapq.heappop(self.heap)
+
+    def next_deadline(self):
+        """
+        :return: The earliest deadline, or None if nothing's scheduled
+        :rtype: float
+        """
+        self.discard_stale()
+        if len(self.heap) < 1:
+            return None
+        return self.heap[0][0]
+
+    def time_until_next(self, minimum=0):
+        """
+        :param minimum: (Optional) Never return less than this
+        :type minimum: float
+
+        :return: Seconds until the earliest deadline, or None if nothing's scheduled
+        :rtype: float
+        """
+        deadline = self.next_deadline()
+        if deadline is None:
+            return None
+        return max(deadline - self.clock(), minimum)
+
+    def pop_due(self):
+        """
+        Remove and return everything that's due
+
+        :return: The names whose deadlines have passed, earliest first
+        :rtype: list
+        """
+        now = self.clock()
+        due = []
+        self.discard_stale()
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            when, count, name = heapq.heappop(self.heap)
+            del self.deadlines[name]
+            due.append(name)
+            self.discard_stale()
+        return due
@@ -1,27 +1,59 @@
 #!/usr/bin/env python3
 
+import asyncio
 import atexit
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import hashlib
 import os
 import logging
 import importlib.metadata
 from pathlib import Path
 import platformdirs
+import queue
 import select
+import signal
 from sys import exit
+import threading
 import time
-import xml.etree.ElementTree as ET
+from urllib.parse import urlparse
 
 import requests
 from mpd import MPDClient
-from mpd.base import ConnectionError
-import yaml
-
-from yams.configure import configure, remove_log_stream_of_type, DEFAULT_CACHE_FILENAME
+from mpd.base import CommandError, ConnectionError
+
+from yams.cache import ScrobbleRecord, open_scrobble_store
+from yams.configure import (
+    configure,
+    endpoint_configs,
+    player_configs,
+    remove_log_stream_of_type,
+    DEFAULT_CACHE_FILENAME,
+)
+from yams.metrics import METRICS, CountingMPDClient, MetricsExporter, store_gauges
+from yams.recording import RecordingMPDClient, open_recording
+from yams.responses import FORMAT_JSON, FORMATS, parse_response
+from yams.retry import (
+    UNAVAILABLE,
+    LastFMError,
+    RequestThrottled,
+    parse_error,
+)
+from yams.scheduler import Scheduler
+from yams.transport import transport_from_config
 
 MAX_TRACKS_PER_SCROBBLE = 50
 SCROBBLE_RETRY_INTERVAL = 10
-SCROBBLE_DISK_SAVE_INTERVAL = 1200
+RECONNECT_TIMEOUT = 10
+# How far past a deadline to wake up, so the checks it's for have definitely passed
+CHECK_MARGIN = 0.05
+# (connect, read) timeouts for requests made without a transport
+FALLBACK_TIMEOUT = (5, 30)
+# How many tracks' tags to keep around, see TrackCache
+TRACK_CACHE_SIZE = 64
+# The idle subsystems the watcher listens to: the player, and those that can make cached tracks stale
+WATCHED_SUBSYSTEMS = ("player", "playlist", "database")
 
 logger = logging.getLogger("yams")
 
@@ -30,41 +62,6 @@ SCROBBLES = str(
 )
 
 
-def save_failed_scrobbles_to_disk(path, scrobbles):
-    logger.info("Writing scrobbles to disk...")
-    if os.path.exists(path):
-        os.remove(path)
-
-    with open(path, "w+") as file_stream:
-        yaml.dump(
-            {"scrobbles": scrobbles},
-            file_stream,
-            default_flow_style=False,
-            Dumper=yaml.Dumper,
-        )
-    logger.info("Failed scrobbles written to: {}".format(path))
-
-
-def read_failed_scrobbles_from_disk(path):
-
-    if os.path.exists(path):
-        try:
-            with open(path) as scrobbles_file_stream:
-                scrobbles_file = yaml.load(
-                    scrobbles_file_stream, Loader=yaml.FullLoader
-                )
-
-                logger.info("Scrobbles found, reading from file at {}...".format(path))
-                if "scrobbles" in scrobbles_file:
-                    for scrobble in scrobbles_file["scrobbles"]:
-                        for key in scrobble.keys():
-                            logger.debug("[{}]: {}".format(key, scrobble[key]))
-                    return scrobbles_file["scrobbles"]
-        except Exception as e:
-            logger.warn("Couldn't read failed scrobbles file!: {}".format(e))
-    return []
-
-
 def sign_signature(parameters, secret=""):
     """
     Create a signature for a signed request
@@ -81,12 +78,14 @@ def sign_signature(parameters, secret=""):
 
     to_hash = ""
 
+    debugging = logger.isEnabledFor(logging.DEBUG)
     hasher = hashlib.md5()
     for key in keys:
         hasher.update(str(key).encode("utf-8"))
         hasher.update(str(parameters[key]).encode("utf-8"))
         # to_hash += str(key)+str(parameters[key])
-        logger.debug("Hashing: {}".format(str(key) + str(parameters[key])))
+        if debugging:
+            logger.debug("Hashing: {}".format(str(key) + str(parameters[key])))
 
     if len(secret) > 0:
         hasher.update(secret.encode("utf-8"))
@@ -97,59 +96,127 @@ def sign_signature(parameters, secret=""):
     return hashed_form
 
 
-def make_request(url, parameters, POST=False):
+def make_request(
+    url, parameters, POST=False, transport=None, response_format=FORMAT_JSON
+):
     """
-    Make a generic GET or POST request to an URL, and parse its resultant XML. Can throw an exception.
+    Make a generic GET or POST request to an URL, and parse its response. Can throw an exception.
+    With a transport, the request only goes out if the endpoint's retry policy allows it (see
+    yams.retry.RetryPolicy), and how it went is reported back to the policy.
+
     :param url: The URL to make the request to
     :param parameters: A dictionary of data to send with your request
     :param POST: (Optional) A POST request will be sent (instead of GET) if this is True
+    :param transport: (Optional) A pooled keep-alive transport to send the request over. Falls back to a one-off connection if None
+    :param response_format: (Optional) "json" or "xml", what to ask for. Services without JSON answer in XML regardless, which is parsed all the same
 
     :type url: str
     :type parameters: dict
     :type POST: bool
+    :type transport: yams.transport.Transport
+    :type response_format: str
 
-    :return: The parsed XML object
-    :rtype: xml.etree.ElementTree
+    :raises yams.retry.RequestThrottled: If the retry policy held the request back
+    :raises yams.retry.LastFMError: If Last.FM turned the request down
+    :raises requests.RequestException: If the request didn't make it there and back
+
+    :return: The parsed response
+    :rtype: yams.responses.JSONResponse or yams.responses.XMLResponse
     """
 
+    if response_format not in FORMATS:
+        raise ValueError("Unknown response_format: {}".format(response_format))
+    if response_format == FORMAT_JSON:
+        # Signatures leave format out, so it can be added after signing
+        parameters = dict(parameters, format=FORMAT_JSON)
+
     logger.debug("Making request to '{}':\n'{}'".format(url, parameters))
 
-    if not POST:
-        response = requests.get(url, parameters)
-    else:
-        response = requests.post(url, data=parameters)
+    host = urlparse(url).netloc
+    policy = transport.policy(url) if transport is not None else None
+    if policy is not None:
+        try:
+            policy.acquire()
+        except RequestThrottled:
+            METRICS.inc("yams_requests_throttled_total", host=host)
+            raise
+
+    started = time.perf_counter()
+    status = "error"
+    try:
+        if transport is not None:
+            response = (
+                transport.post(url, data=parameters)
+                if POST
+                else transport.get(url, parameters)
+            )
+        elif not POST:
+            response = requests.get(url, parameters, timeout=FALLBACK_TIMEOUT)
+        else:
+            response = requests.post(url, data=parameters, timeout=FALLBACK_TIMEOUT)
+        status = str(response.status_code)
+    except requests.RequestException as e:
+        METRICS.inc("yams_http_errors_total", host=host, kind=UNAVAILABLE)
+        if policy is not None:
+            policy.failed(LastFMError(UNAVAILABLE, message=str(e)))
+        raise
+    finally:
+        METRICS.observe(
+            "yams_http_request_duration_seconds",
+            time.perf_counter() - started,
+            method=parameters.get("method", ""),
+            status=status,
+        )
 
-    logger.debug("Response: {}".format(response.text))
+    # Decoding the body to text is only worth it if it's going to be logged
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Response: {}".format(response.text))
 
+    parsed = None
     if response.ok:
         try:
-            xml = ET.fromstring(response.text)
-            return xml
+            parsed = parse_response(response.content)
         except Exception as e:
             logger.error(
-                "Something went wrong parsing the XML. Error: {}. Failing...".format(e)
+                "Something went wrong parsing the response. Error: {}. Failing...".format(
+                    e
+                )
+            )
+
+    # Last.FM sometimes reports errors with a 200, so check what it says too
+    if parsed is None or parsed.failed():
+        error = parse_error(response.status_code, response.content, response.headers)
+        logger.info(
+            "Got a fucked up response! Status: {}, Reason: {}".format(
+                response.status_code, error
             )
-            return None
-    logger.info(
-        "Got a fucked up response! Status: {}, Reason: {}".format(
-            response.status_code, response.reason
         )
-    )
-    logger.info("Response: {}".format(response.text))
-    return None
+        logger.info("Response: {}".format(response.text))
+        METRICS.inc("yams_http_errors_total", host=host, kind=error.kind)
+        if policy is not None:
+            policy.failed(error)
+        raise error
 
+    if policy is not None:
+        policy.succeeded()
+    return parsed
 
-def get_token(url, api_key, api_secret):
+
+def get_token(url, api_key, api_secret, transport=None, response_format=FORMAT_JSON):
     """
     Fetch a Last.FM authentication token from its servers
 
     :param url: The base Last.FM API url
     :param api_key: Your API key
     :param api_secret: Your AP secret (given to you when you got your API key)
+    :param transport: (Optional) The HTTP transport to send the request over
+    :param response_format: (Optional) What to ask the API to answer in, see make_request
 
     :type url: str
     :type api_key: str
     :type api_secret: str
+    :type transport: yams.transport.Transport
+    :type response_format: str
 
     :return: The token received from the server
     :rtype: str
@@ -161,15 +228,19 @@ def get_token(url, api_key, api_secret):
     }
     parameters["api_sig"] = sign_signature(parameters, api_secret)
 
-    xml = make_request(url, parameters)
+    response = make_request(
+        url, parameters, transport=transport, response_format=response_format
+    )
 
-    token = xml.find("token").text
+    token = response.token()
     logger.debug("Token: {}".format(token))
 
     return token
 
 
-def get_session(url, token, api_key, api_secret):
+def get_session(
+    url, token, api_key, api_secret, transport=None, response_format=FORMAT_JSON
+):
     """
     Try to grab a Last.FM session key for a given token. Note that this must be done after a user manually authenticates with Last.FM and confirms your token.
 
@@ -177,29 +248,33 @@ def get_session(url, token, api_key, api_secret):
     :param token: Your token
     :param api_key: Your API key
     :param api_secret: Your AP secret (given to you when you got your API key)
+    :param transport: (Optional) The HTTP transport to send the request over
+    :param response_format: (Optional) What to ask the API to answer in, see make_request
 
     :type url: str
     :type token: str
     :type api_key: str
     :type api_secret: str
+    :type transport: yams.transport.Transport
+    :type response_format: str
 
-    :return: The session key received from the server
-    :rtype: str
+    :return: The user name and session key received from the server
+    :rtype: (str,str)
     """
     parameters = {"token": token, "api_key": api_key, "method": "auth.getsession"}
     parameters["api_sig"] = sign_signature(parameters, api_secret)
 
-    xml = make_request(url, parameters)
+    response = make_request(
+        url, parameters, transport=transport, response_format=response_format
+    )
 
-    session = xml.find("session")
-    username = session.find("name").text
-    session_key = session.find("key").text
+    username, session_key = response.session()
     logger.debug("Key: {},{}".format(username, session_key))
 
     return (username, session_key)
 
 
-def authenticate(token, base_url, api_key, api_secret):
+def authenticate(token, base_url, api_key, api_secret, response_format=FORMAT_JSON):
     """
     Authenticate with Last.FM using a given token. Prompt and wait on the user to sign in to Last.FM. Keep trying to grab the session details afterwards.
 
@@ -207,11 +282,13 @@ def authenticate(token, base_url, api_key, api_secret):
     :param url: The base Last.FM API url
     :param api_key: Your API key
     :param api_secret: Your AP secret (given to you when you got your API key)
+    :param response_format: (Optional) What to ask the API to answer in, see make_request
 
     :type token: str
     :type url: str
     :type api_key: str
     :type api_secret: str
+    :type response_format: str
 
     :return: A tuple of the user's name and validated session key
     :rtype: (str,str)
@@ -222,7 +299,9 @@ def authenticate(token, base_url, api_key, api_secret):
     )
     try:
         logger.info("Grabbing session...")
-        session_info = get_session(base_url, token, api_key, api_secret)
+        session_info = get_session(
+            base_url, token, api_key, api_secret, response_format=response_format
+        )
         logger.info("User: {}".format(session_info[0]))
         logger.info("Session: {}".format(session_info[1]))
 
@@ -231,7 +310,7 @@ def authenticate(token, base_url, api_key, api_secret):
         logger.error("Couldn't grab session, reason: {}".format(e))
 
     # Keep looping forever, the program won't be able to do anything without a session, anyway.
-    return authenticate(token, base_url, api_key, api_secret)
+    return authenticate(token, base_url, api_key, api_secret, response_format)
 
 
 def save_credentials(session_filepath, user_name, session_key):
@@ -282,7 +361,175 @@ def extract_single(container, key):
     return ""
 
 
-def now_playing(track_info, status, url, api_key, api_secret, session_key):
+class TrackRecord(dict):
+    """
+    A track's info as taken from mpd, along with its fields as sent to Last.FM (see track_fields),
+    prepared once when the record's made rather than every time they're needed.
+
+    :param track_info: The track's info from mpd
+    :type track_info: dict
+    """
+
+    def __init__(self, track_info):
+        super().__init__(track_info)
+        self.fields = normalize_track(track_info)
+
+
+def normalize_track(track_info):
+    """
+    :param track_info: The track's info from mpd
+    :type track_info: dict
+
+    :return: The track's artist, track (title), and if present album, trackNumber and albumArtist, as sent to Last.FM
+    :rtype: dict
+    """
+
+    fields = {
+        "artist": extract_single(track_info, "artist"),
+        "track": extract_single(track_info, "title"),
+    }
+
+    if "album" in track_info:
+        fields["album"] = extract_single(track_info, "album")
+    if "track" in track_info:
+        fields["trackNumber"] = extract_single(track_info, "track")
+    if "albumartist" in track_info:
+        fields["albumArtist"] = extract_single(track_info, "albumartist")
+    return fields
+
+
+def track_fields(track_info):
+    """
+    :param track_info: The track's info from mpd, or a TrackRecord
+    :type track_info: dict
+
+    :return: The track's fields as sent to Last.FM, see normalize_track. Don't modify them, they may be shared
+    :rtype: dict
+    """
+
+    if isinstance(track_info, TrackRecord):
+        return track_info.fields
+    return normalize_track(track_info)
+
+
+def status_duration(status):
+    """
+    :param status: A dictionary containing the mpd player status
+    :type status: dict
+
+    :return: The playing track's duration in seconds, from duration or (on older servers, like mopidy) time
+    :rtype: float
+    """
+
+    return float(
+        status["duration"] if "duration" in status else status["time"].split(":")[-1]
+    )
+
+
+class TrackCache:
+    """
+    A small LRU of the tracks in MPD's queue, as TrackRecords keyed by their song id, so the watcher only
+    asks MPD for a track's tags (and works through them) once rather than on every check. Song ids are
+    only unique until the queue changes, and tags can change with the database, so changes to either
+    (the "playlist" and "database" idle subsystems) clear it.
+
+    The track status says is up next is fetched ahead of time, so there's nothing to ask MPD for when
+    the track changes.
+
+    :param size: (Optional) How many tracks to keep
+    :type size: int
+    """
+
+    INVALIDATING = {"playlist", "database"}
+
+    def __init__(self, size=TRACK_CACHE_SIZE):
+        self.size = size
+        self.records = OrderedDict()
+        # Cleared if the client (or server) turns out not to support playlistid
+        self.can_prefetch = True
+        # The last song id we tried to prefetch, so one MPD won't give us isn't asked for again and again
+        self.prefetched = None
+
+    def add(self, song_id, record):
+        self.records[song_id] = record
+        self.records.move_to_end(song_id)
+        while len(self.records) > self.size:
+            self.records.popitem(last=False)
+
+    def current(self, client, status):
+        """
+        :param client: The MPD client object
+        :param status: The info on the track taken from client.status()
+
+        :type client: mpd.MPDClient
+        :type status: dict
+
+        :return: The playing track, as client.currentsong() would return it
+        :rtype: yams.scrobble.TrackRecord
+        """
+
+        song_id = status.get("songid")
+        if song_id is not None and song_id in self.records:
+            self.records.move_to_end(song_id)
+            return self.records[song_id]
+
+        record = TrackRecord(client.currentsong())
+        # The player may have moved on between the two calls, so make sure it's the song we asked about
+        if song_id is not None and record.get("id") == song_id:
+            self.add(song_id, record)
+        return record
+
+    def prefetch(self, client, status):
+        """
+        Fetch the track status says is up next, unless it's already cached
+
+        :param client: The MPD client object
+        :param status: The info on the track taken from client.status()
+
+        :type client: mpd.MPDClient
+        :type status: dict
+        """
+
+        song_id = status.get("nextsongid")
+        if not self.can_prefetch or song_id is None or song_id == self.prefetched:
+            return
+        self.prefetched = song_id
+        if song_id in self.records:
+            return
+
+        try:
+            songs = client.playlistid(song_id)
+        except (AttributeError, CommandError) as e:
+            logger.debug("Can't fetch upcoming tracks ahead of time: {}".format(e))
+            self.can_prefetch = False
+            return
+
+        if len(songs) > 0 and songs[0].get("id") == song_id:
+            self.add(song_id, TrackRecord(songs[0]))
+
+    def changed(self, subsystems):
+        """
+        :param subsystems: The subsystems an idle call reported changes in
+        :type subsystems: list
+        """
+
+        if len(TrackCache.INVALIDATING.intersection(subsystems)) > 0:
+            logger.debug("The queue or database changed, forgetting cached tracks")
+            self.records.clear()
+            self.prefetched = None
+
+
+def now_playing(
+    track_info,
+    status,
+    url,
+    api_key,
+    api_secret,
+    session_key,
+    transport=None,
+    superseded=None,
+    response_format=FORMAT_JSON,
+):
     """
     Send your currently playing track's info to Last.FM
 
@@ -292,12 +539,18 @@ def now_playing(track_info, status, url, api_key, api_secret, session_key):
     :param api_key: Your API key
     :param api_secret: Your API secret (given to you when you got your API key)
     :param session_key: Your Last.FM session key
+    :param transport: (Optional) The HTTP transport to send the request over
+    :param superseded: (Optional) Called just before sending, the update is dropped if it returns True
+    :param response_format: (Optional) What to ask the API to answer in, see make_request
 
     :type track_info: dict
     :type url: str
     :type api_key: str
     :type api_secret: str
     :type session_key: str
+    :type transport: yams.transport.Transport
+    :type superseded: function
+    :type response_format: str
     """
 
     parameters = make_scrobble(
@@ -310,13 +563,15 @@ def now_playing(track_info, status, url, api_key, api_secret, session_key):
         context="mpd",
     )
 
+    if superseded is not None and superseded():
+        logger.debug("A newer track came along, not sending now playing")
+        METRICS.inc("yams_now_playing_dropped_total", reason="superseded")
+        return
+
     # logger.info(parameters)
 
     try:
-        xml = make_request(url, parameters, True)
-        # logger.info(xml.tag)
-        # for child in xml[0]:
-        #    logger.info(child.text)
+        make_request(url, parameters, True, transport, response_format)
         logger.info("Now playing was a success!")
     except Exception as e:
         logger.warn("Could not send now playing Last.FM!")
@@ -340,17 +595,8 @@ def make_scrobble(track_info, status, api_secret=None, **other):
     :type other: dict
     """
 
-    scrobble = {
-        "artist": extract_single(track_info, "artist"),
-        "track": extract_single(track_info, "title"),
-    }
+    scrobble = dict(track_fields(track_info))
 
-    if "album" in track_info:
-        scrobble["album"] = extract_single(track_info, "album")
-    if "track" in track_info:
-        scrobble["trackNumber"] = extract_single(track_info, "track")
-    if "albumartist" in track_info:
-        scrobble["albumArtist"] = extract_single(track_info, "albumartist")
     # Check for duration/time in status rather than track_info as they won't be present for tracks not
     # present in the mpd database (ie. streamed tracks)
     if "duration" in status:
@@ -371,32 +617,32 @@ def make_scrobble(track_info, status, api_secret=None, **other):
     return scrobble
 
 
-def scrobble_tracks(tracks, url, api_key, api_secret, session_key):
+def record_scrobble_counts(url, counts):
+    """Count the scrobbles a track.scrobble response says were accepted and ignored"""
+
+    host = urlparse(url).netloc
+    METRICS.inc("yams_scrobbles_accepted_total", counts.accepted, host=host)
+    METRICS.inc("yams_scrobbles_ignored_total", counts.ignored, host=host)
+
+
+def build_scrobble_parameters(tracks, api_key, api_secret, session_key):
     """
-    Attempts to scrobble multiple tracks at once to Last.FM
+    Build the signed parameters of a track.scrobble request for up to MAX_TRACKS_PER_SCROBBLE tracks
 
-    :param tracks: The list of failed scrobbles, in the form of the scrobbles cache
-    :param url: The base Last.FM API url
+    :param tracks: The list of failed scrobbles, as ScrobbleRecords (or make_scrobble's dictionaries)
     :param api_key: Your API key
     :param api_secret: Your API secret (given to you when you got your API key)
     :param session_key: Your Last.FM session key
 
     :type tracks: list
-    :type url: str
     :type api_key: str
     :type api_secret: str
     :type session_key: str
 
-    :return: Returns a tuple of (accepted count of scrobbles, submitted count of scrobbles). This will not always be the same as the amount of scrobbles you sent in, so you should truncate your cache accordingly.
-    :rtype: (int,int)
+    :return: A tuple of (the request's parameters, the amount of tracks they include)
+    :rtype: (dict,int)
     """
 
-    # Sanity check
-    if len(tracks) < 1:
-        logger.debug("Failed sanity check for scrobble tracks")
-        return
-
-    logger.info("Attempting mass scroble for {} tracks!".format(len(tracks)))
     parameters = {
         "method": "track.scrobble",
         "api_key": api_key,
@@ -409,58 +655,95 @@ def scrobble_tracks(tracks, url, api_key, api_secret, session_key):
         else len(tracks)
     )
 
+    debugging = logger.isEnabledFor(logging.DEBUG)
     for i in range(0, max_scrobbles):
-        logger.debug("Adding {} to mass scrobble request.".format(tracks[i]))
-        # We probably don't need to use the extract_single's, here, but better safe than sorry!
-        parameters["track[{}]".format(i)] = extract_single(tracks[i], "track")
-        parameters["artist[{}]".format(i)] = extract_single(tracks[i], "artist")
-        parameters["timestamp[{}]".format(i)] = extract_single(tracks[i], "timestamp")
-
-        if "album" in tracks[i]:
-            parameters["album[{}]".format(i)] = extract_single(tracks[i], "album")
-        if "trackNumber" in tracks[i]:
-            parameters["trackNumber[{}]".format(i)] = extract_single(
-                tracks[i], "trackNumber"
-            )
-
-        if "albumArtist" in tracks[i]:
-            parameters["albumArtist[{}]".format(i)] = extract_single(
-                tracks[i], "albumArtist"
-            )
-        if "duration" in tracks[i]:
-            parameters["duration[{}]".format(i)] = extract_single(tracks[i], "duration")
+        # Queued scrobbles only become form fields here, right before they're sent
+        track = ScrobbleRecord.of(tracks[i])
+        if debugging:
+            logger.debug("Adding {} to mass scrobble request.".format(track))
+
+        parameters["track[{}]".format(i)] = track.track
+        parameters["artist[{}]".format(i)] = track.artist
+        parameters["timestamp[{}]".format(i)] = track.timestamp
+
+        if track.album is not None:
+            parameters["album[{}]".format(i)] = track.album
+        if track.track_number is not None:
+            parameters["trackNumber[{}]".format(i)] = track.track_number
+        if track.album_artist is not None:
+            parameters["albumArtist[{}]".format(i)] = track.album_artist
+        if track.duration is not None:
+            parameters["duration[{}]".format(i)] = track.duration
 
     parameters["api_sig"] = sign_signature(parameters, api_secret)
 
-    try:
-        xml = make_request(url, parameters, True)
-        if xml:
-            logger.debug("Received response: [{}] - {}".format(xml.tag, xml.attrib))
-            logger.debug(
-                "XML Received for mass scrobble: {}".format(
-                    ET.tostring(xml, encoding="utf-8").decode("utf-8")
-                )
-            )
+    return parameters, max_scrobbles
 
-            accepted = int(xml.find("scrobbles").get("accepted"))
-            if accepted > 0:
-                logger.info("Scrobbles accepted: {}".format(accepted))
-                logger.info("Mass scrobbling was a success!")
 
-                return accepted, max_scrobbles
-            else:
-                logger.warn(
-                    "Failed to scrobble {num_tracks} tracks, queuing for later.".format(
-                        num_tracks=len(tracks)
-                    )
-                )
+def scrobble_tracks(
+    tracks,
+    url,
+    api_key,
+    api_secret,
+    session_key,
+    transport=None,
+    response_format=FORMAT_JSON,
+):
+    """
+    Attempts to scrobble multiple tracks at once to Last.FM
+
+    :param tracks: The list of failed scrobbles, in the form of the scrobbles cache
+    :param url: The base Last.FM API url
+    :param api_key: Your API key
+    :param api_secret: Your API secret (given to you when you got your API key)
+    :param session_key: Your Last.FM session key
+    :param transport: (Optional) The HTTP transport to send the request over
+    :param response_format: (Optional) What to ask the API to answer in, see make_request
+
+    :type tracks: list
+    :type url: str
+    :type api_key: str
+    :type api_secret: str
+    :type session_key: str
+    :type transport: yams.transport.Transport
+    :type response_format: str
+
+    :return: Returns a tuple of (accepted count of scrobbles, submitted count of scrobbles). This will not always be the same as the amount of scrobbles you sent in, so you should truncate your cache accordingly. Submitted is 0 if the scrobbles should be sent again later, scrobbles Last.FM ignored or refused outright count as submitted.
+    :rtype: (int,int)
+    """
+
+    # Sanity check
+    if len(tracks) < 1:
+        logger.debug("Failed sanity check for scrobble tracks")
+        return
+
+    logger.info("Attempting mass scroble for {} tracks!".format(len(tracks)))
+    parameters, max_scrobbles = build_scrobble_parameters(
+        tracks, api_key, api_secret, session_key
+    )
+
+    try:
+        response = make_request(url, parameters, True, transport, response_format)
+        counts = response.scrobble_counts()
+        record_scrobble_counts(url, counts)
+        accepted = counts.accepted
+        if accepted > 0:
+            logger.info("Scrobbles accepted: {}".format(accepted))
+            logger.info("Mass scrobbling was a success!")
         else:
+            # They were all ignored, sending them again won't change Last.FM's mind
             logger.warn(
-                "Failed to scrobble {num_tracks} tracks, queuing for later.".format(
-                    num_tracks=len(tracks)
-                )
+                "Last.FM ignored all {} scrobbles, dropping them.".format(max_scrobbles)
             )
+        return accepted, max_scrobbles
     except Exception as e:
+        if isinstance(e, LastFMError) and e.permanent:
+            logger.error(
+                "Last.FM will never accept these {} scrobbles ({}), dropping them: {}".format(
+                    max_scrobbles, e, tracks[:max_scrobbles]
+                )
+            )
+            return 0, max_scrobbles
         logger.warn(
             "Failed to scrobble {num_tracks} tracks, queuing for later.".format(
                 num_tracks=len(tracks)
@@ -472,7 +755,15 @@ def scrobble_tracks(tracks, url, api_key, api_secret, session_key):
 
 
 def scrobble_track(
-    track_info, status, timestamp, url, api_key, api_secret, session_key
+    track_info,
+    status,
+    timestamp,
+    url,
+    api_key,
+    api_secret,
+    session_key,
+    transport=None,
+    response_format=FORMAT_JSON,
 ):
     """
     Scrobble your track with Last.FM
@@ -484,6 +775,8 @@ def scrobble_track(
     :param api_key: Your API key
     :param api_secret: Your API secret (given to you when you got your API key)
     :param session_key: Your Last.FM session key
+    :param transport: (Optional) The HTTP transport to send the request over
+    :param response_format: (Optional) What to ask the API to answer in, see make_request
 
     :type track_info: dict
     :type status: dict
@@ -492,6 +785,11 @@ def scrobble_track(
     :type api_key: str
     :type api_secret: str
     :type session_key: str
+    :type transport: yams.transport.Transport
+    :type response_format: str
+
+    :return: False if the scrobble should be queued up and sent again later
+    :rtype: bool
     """
 
     logger.info("Scrobbling!")
@@ -506,23 +804,24 @@ def scrobble_track(
     )
 
     try:
-        xml = make_request(url, parameters, True)
+        response = make_request(url, parameters, True, transport, response_format)
+        counts = response.scrobble_counts()
     except Exception as e:
+        if isinstance(e, LastFMError) and e.permanent:
+            logger.error(
+                "Last.FM will never accept the scrobble of {} ({}), dropping it.".format(
+                    track_info.get("title"), e
+                )
+            )
+            return True
         logger.error("Something went wrong with the scrobble request.")
         logger.debug("Error: {}".format(e))
-        xml = False
+        counts = None
 
-    if xml:
-        logger.info(
-            "Scrobbles accepted: {}".format(xml.find("scrobbles").get("accepted"))
-        )
+    if counts is not None:
+        record_scrobble_counts(url, counts)
+        logger.info("Scrobbles accepted: {}".format(counts.accepted))
         logger.info("Scrobbling was a success!")
-
-        logger.debug(
-            "XML Received for scrobble: {}".format(
-                ET.tostring(xml, encoding="utf-8").decode("utf-8")
-            )
-        )
         return True
 
     logger.warn(
@@ -533,68 +832,35 @@ def scrobble_track(
     return False
 
 
-def truncate_pending_scrobbles_list(count, scrobbles, path_to_cache):
-    """
-    Removes 'count' number of scrobbles from the current cached list and then writes to disk if necessary.
-
-    :param count: The number of scrobbles to remove
-    :param scrobbles: The list of cached scrobbles to remove from
-    :param path_to_cache: The path to the cached scrobbles file, if a write to disk is necessary
-
-    :type count: int
-    :type scrobbles: list
-    :type path_to_cache: str
-
-    :return: The truncated list of scrobbles, or an empty list (if the count to remove was larger than the length of the scrobbles list)
-    :rtype: list
-    """
-
-    if count >= len(scrobbles):
-        logger.debug(
-            "Removing all ({}/{}) scrobbles from cache".format(count, len(scrobbles))
-        )
-
-        if os.path.exists(path_to_cache):
-            logger.debug("Removing scrobble cache: {}".format(path_to_cache))
-            os.remove(path_to_cache)
-
-        return []
-    else:
-        scrobbles = scrobbles[count:]
-        logger.debug(
-            "Removed {} scrobbles from cache, {} left to submit.".format(
-                count, len(scrobbles)
-            )
-        )
-        save_failed_scrobbles_to_disk(path_to_cache, scrobbles)
-
-        return scrobbles
-
-
-def print_song_info(client):
+def print_song_info(client, song=None, status=None):
     """
     Print a song's playback information
 
     :param client: The MPD client object
+    :param song: (Optional) The info on the track taken from client.currentsong(), asked for if not given
+    :param status: (Optional) The info on the track taken from client.status(), asked for if not given
+
     :type client: mpd.MPDClient
+    :type song: dict
+    :type status: dict
     """
 
-    song = client.currentsong()
-    status = client.status()
+    if song is None:
+        song = client.currentsong()
+    if status is None:
+        status = client.status()
 
     # Storing duration info in "time" is deprecated, as per the mpd spec,
     # however some servers (namely mopidy) still do this. Bad mopidy, bad.
-    song_duration = float(
-        status["duration"] if "duration" in status else status["time"].split(":")[-1]
-    )
+    duration = status_duration(status)
 
-    title = extract_single(song, "title")
+    fields = track_fields(song)
 
     logger.info(
         "Playing {songname}, by {artist} (from {album})".format(
-            songname=title,
-            artist=extract_single(song, "artist"),
-            album=extract_single(song, "album"),
+            songname=fields["track"],
+            artist=fields["artist"],
+            album=fields.get("album", ""),
         )
     )
 
@@ -603,26 +869,32 @@ def print_song_info(client):
         logger.info(
             "{elapsed}/{duration}s ({percent_elapsed}%)".format(
                 elapsed=format(elapsed, ".0f"),
-                duration=format(song_duration, ".0f"),
-                percent_elapsed=format((elapsed / song_duration * 100), ".1f"),
+                duration=format(duration, ".0f"),
+                percent_elapsed=format((elapsed / duration * 100), ".1f"),
             )
         )
 
 
-def mpd_wait_for_play(client):
+def mpd_wait_for_play(client, tracks=None):
     """
     Block and wait for mpd to switch to the "play" action. Will continue blocking if the play action is not a valid, scrobbleable track.
 
     :param client: The MPD client object
+    :param tracks: (Optional) The cache to look tracks up in, and to tell about changes to the queue and database
+
     :type client: mpd.MPDClient
+    :type tracks: yams.scrobble.TrackCache
 
-    :return: True when client is set to play - blocks otherwise
-    :rtype: bool
+    :return: The status and the current track from client.status() and client.currentsong() when client is set to play - blocks otherwise. None if something went wrong
+    :rtype: tuple
     """
 
+    if tracks is None:
+        tracks = TrackCache(0)
+
     # These need to be out here as there is an external try/catch block checking to see if we hit a connection error, and handle that gracefully
     status = client.status()
-    song = client.currentsong()
+    song = tracks.current(client, status)
 
     try:
         state = status["state"]
@@ -632,7 +904,7 @@ def mpd_wait_for_play(client):
 
         # Prevents us from printing song info if we're not switching tracks
         if in_suitable_state and appropriate_track:
-            return True
+            return status, song
 
         while not in_suitable_state or not appropriate_track:
 
@@ -641,14 +913,15 @@ def mpd_wait_for_play(client):
 
             logger.debug("Waiting for the next mpd event...")
             # We're not 'play'ing, so lets wait until the state changes
-            changes = client.idle("player")
+            changes = client.idle(*WATCHED_SUBSYSTEMS)
             logger.info(
                 "Received event in subsystem: {}".format(changes)
             )  # handle changes
+            tracks.changed(changes)
 
             # The state has now changed
             status = client.status()
-            song = client.currentsong()
+            song = tracks.current(client, status)
             state = status["state"]
 
             in_suitable_state = state == "play"
@@ -656,15 +929,61 @@ def mpd_wait_for_play(client):
 
             logger.info("Received state: {}".format(state))
 
-        print_song_info(client)
-        return True
+        print_song_info(client, song, status)
+        return status, song
 
     except Exception as e:
         logger.exception(
             "Something went wrong waiting on MPD's Idle event: {}".format(e)
         )
 
-    return False
+    return None
+
+
+def can_wait_for_player(client):
+    """
+    :return: Whether wait_for_player() can idle on this client, rather than just sleeping
+    :rtype: bool
+    """
+
+    try:
+        return hasattr(client, "send_idle") and client.fileno() >= 0
+    except Exception:
+        return False
+
+
+def wait_for_player(client, seconds, sleep=time.sleep):
+    """
+    Wait up to seconds for MPD's player (a skip, seek, pause, etc.), queue or database to change, idling
+    on them and watching its socket with select(), then sending noidle if nothing happened in time.
+    Clients without a socket (see can_wait_for_player) are just slept on.
+
+    :param client: The MPD client object
+    :param seconds: The longest to wait, in seconds
+    :param sleep: (Optional) The function used to wait on clients that can't idle, given the seconds to wait
+
+    :type client: yams.scrobble.IdleMPDClient
+    :type seconds: float
+    :type sleep: function
+
+    :return: The subsystems that changed (see WATCHED_SUBSYSTEMS), none if the time ran out
+    :rtype: list
+    """
+
+    if not can_wait_for_player(client):
+        sleep(seconds)
+        return []
+
+    client.send_idle(*WATCHED_SUBSYSTEMS)
+    readable, _, _ = select.select([client.fileno()], [], [], max(seconds, 0))
+    if len(readable) > 0:
+        changes = client.fetch_idle()
+    else:
+        changes = client.noidle()
+
+    if len(changes) > 0:
+        logger.debug("Received event in subsystem: {}".format(changes))
+    return changes
 
 
 def is_track_scrobbleable(song, status):
@@ -695,253 +1014,1049 @@ def is_track_scrobbleable(song, status):
 
     # If all fields present, check that song duration is not zero (would cause div by zero errors)
     if scrobbleable:
-        song_duration = float(
-            status["duration"]
-            if "duration" in status
-            else status["time"].split(":")[-1]
-        )
-        scrobbleable &= song_duration > 0
+        scrobbleable &= status_duration(status) > 0
 
     return scrobbleable
 
 
-def mpd_watch_track(client, session, config):
+class TrackWatcher:
     """
-    The main loop - watches MPD and tracks the currently playing song. Sends Last.FM updates if need be.
+    Keeps track of the song MPD is currently playing, and decides when it's time to send a now playing
+    update or a scrobble for it. Doesn't talk to MPD or Last.FM itself - feed it the results of
+    client.currentsong() and client.status() and act on what update() returns.
 
-    :param client: The MPD client object
-    :param session: The Session key for last.fm
     :param config: The global config file
+    :param clock: (Optional) The function used to tell the time, in seconds since the Epoch
 
-    :type client: mpd.MPDClient
-    :type session: str
     :type config: dict
+    :type clock: function
     """
 
-    base_url = config["base_url"]
-    api_key = config["api_key"]
-    api_secret = config["api_secret"]
+    NOW_PLAYING = "now_playing"
+    WARM = "warm"
+    SCROBBLE = "scrobble"
 
-    use_real_time = config["real_time"]
-    allow_scrobble_same_song_twice_in_a_row = config[
-        "allow_same_track_scrobble_in_a_row"
-    ]
+    def __init__(self, config, clock=time.time):
 
-    default_scrobble_threshold = config["scrobble_threshold"]
-    scrobble_min_time = config["scrobble_min_time"]
-    watch_threshold = config["watch_threshold"]
-    update_interval = config["update_interval"]
+        self.clock = clock
+        self.use_real_time = config["real_time"]
+        self.allow_scrobble_same_song_twice_in_a_row = config[
+            "allow_same_track_scrobble_in_a_row"
+        ]
 
-    current_watched_track = ""
-    reject_track = ""
+        self.default_scrobble_threshold = config["scrobble_threshold"]
+        self.scrobble_min_time = config["scrobble_min_time"]
+        self.watch_threshold = config["watch_threshold"]
+        self.prewarm_time = config["http_prewarm"]
 
-    cache_file_path = config["cache_file"]
+        self.current_watched_track = ""
+        # Whether we've already warmed the HTTP connection for the currently watched track
+        self.connection_warmed = False
+        self.reject_track = ""
 
-    failed_scrobbles = read_failed_scrobbles_from_disk(cache_file_path)
+        # For use with `use_real_time` parameter
+        self.start_time = self.clock()
+        self.reported_start_time = 0
 
-    # For use with `use_real_time` parameter
-    start_time = time.time()
-    reported_start_time = 0
+        self.next_check = self.clock()
 
-    last_rescrobble_attempt_time = time.time()
+    def update(self, song, status):
+        """
+        Update the watcher with the currently playing song. Should only be called while MPD is playing.
+        Afterwards, next_check holds the time at which the watcher next needs to see the song's progress.
 
-    while mpd_wait_for_play(client):
+        :param song: The info on the track taken from client.currentsong()
+        :param status: The info on the track taken from client.status()
 
-        scrobble_threshold = default_scrobble_threshold
+        :type song: dict
+        :type status: dict
 
-        status = client.status()
-        state = status["state"]
+        :return: NOW_PLAYING if we've started watching a new track, WARM if a scrobble is coming up shortly, SCROBBLE if the track should be scrobbled (with start_time as its timestamp), or None
+        :rtype: str
+        """
 
-        # Check to see if we've got any tracks to scrobble (this is on a timer just in case)
-        if time.time() - last_rescrobble_attempt_time > SCROBBLE_RETRY_INTERVAL:
-            if len(failed_scrobbles) > 0:
-                accepted_count, submitted_count = scrobble_tracks(
-                    failed_scrobbles, base_url, api_key, api_secret, session
-                )
-                if accepted_count > 0:
-                    failed_scrobbles = truncate_pending_scrobbles_list(
-                        submitted_count, failed_scrobbles, cache_file_path
-                    )
-            last_rescrobble_attempt_time = time.time()
-
-        if state == "play":
-
-            # The time since the song claims it started, that we've been able to measure in python
-            real_time_elapsed = reported_start_time + (time.time() - start_time)
-            # logger.info(real_time_elapsed)
-
-            song = client.currentsong()
-            # logger.debug("Song info: {}".format(song))
-
-            # Here we check if duration is in the track_info and use it if we can
-            # Storing duration info in "time" is deprecated, as per the mpd spec,
-            # however some servers (namely mopidy) still do this. Bad mopidy, bad.
-            # Use values from the status rather than the song, as duration is
-            # missing when using mpd to play urls or local files
-            song_duration = float(
-                status["duration"]
-                if "duration" in status
-                else status["time"].split(":")[-1]
-            )
+        action = self.check(song, status)
+        self.next_check = self.clock() + self.seconds_until_next_check(song, status)
+        return action
+
+    def seconds_until_next_check(self, song, status):
+        """
+        Work out how long we can go without looking at the song's progress. Nothing can happen before the
+        track becomes watchable, or before it's due to be warmed up for/scrobbled, so there's no point in
+        asking MPD about it any sooner - unless it tells us something changed.
 
-            title = extract_single(song, "title")
-            artist = extract_single(song, "artist")
-            album = extract_single(song, "album")
+        :param song: The info on the track taken from client.currentsong()
+        :param status: The info on the track taken from client.status()
 
-            elapsed = float(status["elapsed"])
+        :type song: dict
+        :type status: dict
+        :rtype: float
+        """
 
-            # The % between 0-100 that has completed so far
-            percent_elapsed = elapsed / song_duration * 100
+        song_duration = status_duration(status)
+        title = track_fields(song)["track"]
+        elapsed = float(status["elapsed"])
+        real_time_elapsed = self.reported_start_time + (self.clock() - self.start_time)
+        scrobble_point = (self.default_scrobble_threshold / 100) * song_duration
 
+        if title != "" and self.current_watched_track == title:
+            seconds = max(scrobble_point - elapsed, self.scrobble_min_time - elapsed)
+            if self.use_real_time:
+                seconds = max(seconds, scrobble_point - real_time_elapsed)
             if (
-                current_watched_track != title
-                and title != ""  # Is this a new track to watch?
-                and title != reject_track  # And this track actually has a title
-                and percent_elapsed  # And it's not a track to be rejected
-                < scrobble_threshold
-                and real_time_elapsed  # And it's below the scrobble threshold
-                > watch_threshold
-                and elapsed > watch_threshold  # And it's REALLY passed 5 seconds?
-            ):  # And it reports to be passed 5 seconds (sanity check)
-
-                current_watched_track = title
-                reject_track = ""
-
-                start_time = time.time()
-                reported_start_time = elapsed - watch_threshold
-
-                if use_real_time:
-                    # So, if we're using real time, and our default_scrobble_threshold is less than 50, we need to do some math:
-                    # Assuming we might have started late, how many real world seconds do I have to listen to to be able to say I've listened to N% (where N = default_scrobble_threshold) of music? Take that amount of seconds and turn it into its own threshold (added to the aforementioned late start time) and baby you've got a stew going
-                    scrobble_threshold = (
-                        (
-                            reported_start_time
-                            + (song_duration - reported_start_time)
-                            * (default_scrobble_threshold / 100)
-                        )
-                        / song_duration
-                    ) * 100
-                    logger.info(
-                        "While the scrobbling threshold would normally be {}%, since we're starting at {}s (out of {}s, a.k.a. {}%), it's now {}%".format(
-                            default_scrobble_threshold,
-                            format(reported_start_time, ".1f"),
-                            format(song_duration, ".1f"),
-                            format(reported_start_time / song_duration * 100, ".1f"),
-                            format(scrobble_threshold, ".1f"),
-                        )
-                    )
-                    logger.debug(
-                        "(start + ( total - start ) * threshold) / total =  ( {0} + ( {1} - {0} ) * {2} ) / {1}".format(
-                            reported_start_time,
-                            song_duration,
-                            default_scrobble_threshold,
-                        )
-                    )
-                else:
-                    scrobble_threshold = default_scrobble_threshold
+                self.prewarm_time > 0
+                and not self.connection_warmed
+                and seconds > self.prewarm_time
+            ):
+                seconds -= self.prewarm_time
+        elif title == "" or title == self.reject_track or elapsed >= scrobble_point:
+            # Nothing more to do for this track, the next one becomes watchable once it's been playing a while
+            seconds = song_duration - elapsed + self.watch_threshold
+        else:
+            seconds = max(
+                self.watch_threshold - elapsed,
+                self.watch_threshold - real_time_elapsed,
+            )
 
-                logger.debug(
-                    "Reported start time: {}, real world time: {}".format(
-                        reported_start_time, start_time
-                    )
-                )
-                logger.info(
-                    "Starting to watch track: {} by {}, currently at: {}/{}s ({}%). Will scrobble in: {}s".format(
-                        title,
-                        artist,
-                        format(elapsed, ".0f"),
-                        format(song_duration, ".0f"),
-                        format(percent_elapsed, ".1f"),
-                        format(
-                            (song_duration * scrobble_threshold / 100) - elapsed, ".0f"
-                        ),
-                    )
-                )
-                now_playing(song, status, base_url, api_key, api_secret, session)
+        # Give the checks (which use strict comparisons) a moment to pass
+        return max(seconds, 0) + CHECK_MARGIN
 
-            elif current_watched_track == title:
+    def check(self, song, status):
 
-                # logger.debug("{}, at: {}%".format(title,format(percent_elapsed, '.2f')))
+        scrobble_threshold = self.default_scrobble_threshold
 
-                # Are we above the scrobble threshold? Have we been listening the required amount of time?
-                if (
-                    percent_elapsed >= scrobble_threshold
-                    and elapsed > scrobble_min_time
-                ):
-                    # If we're using real time, lets ensure we've been listening this long:
-                    if (
-                        not use_real_time
-                        or real_time_elapsed
-                        >= (scrobble_threshold / 100) * song_duration
-                    ):
-                        current_watched_track = ""
-                        if len(failed_scrobbles) < 1:
-                            # If we don't have any pending scrobbles, try to scrobble this
-                            scrobble_succeeded = scrobble_track(
-                                song,
-                                status,
-                                start_time,
-                                base_url,
-                                api_key,
-                                api_secret,
-                                session,
-                            )
-                            # If we've failed, add it to the list for future scrobbles (and write it to the disk)
-                            if not scrobble_succeeded:
-                                failed_scrobble = make_scrobble(
-                                    song, status, timestamp=start_time
-                                )
-                                if failed_scrobble not in failed_scrobbles:
-                                    failed_scrobbles.append(failed_scrobble)
-                                    save_failed_scrobbles_to_disk(
-                                        cache_file_path, failed_scrobbles
-                                    )
-                        else:
-                            # If we have failed and queued up scrobbles, add this one to the list and try to do them all in one go
-                            failed_scrobble = make_scrobble(
-                                song, status, timestamp=start_time
-                            )
-                            if failed_scrobble not in failed_scrobbles:
-                                failed_scrobbles.append(failed_scrobble)
-                                save_failed_scrobbles_to_disk(
-                                    cache_file_path, failed_scrobbles
-                                )
-                            accepted_count, submitted_count = scrobble_tracks(
-                                failed_scrobbles, base_url, api_key, api_secret, session
-                            )
-                            if accepted_count > 0:
-                                failed_scrobbles = truncate_pending_scrobbles_list(
-                                    submitted_count, failed_scrobbles, cache_file_path
-                                )
-
-                        if not allow_scrobble_same_song_twice_in_a_row:
-                            reject_track = title
-                    else:
-                        logger.warn(
-                            "Can't scrobble yet, time elapsed ({}s) < adjusted duration ({}s)".format(
-                                real_time_elapsed,
-                                (scrobble_threshold / 100) * song_duration,
-                            )
-                        )
+        # The time since the song claims it started, that we've been able to measure in python
+        real_time_elapsed = self.reported_start_time + (self.clock() - self.start_time)
+        # logger.info(real_time_elapsed)
 
-            time.sleep(update_interval)
+        # logger.debug("Song info: {}".format(song))
 
+        # Here we check if duration is in the track_info and use it if we can
+        # Storing duration info in "time" is deprecated, as per the mpd spec,
+        # however some servers (namely mopidy) still do this. Bad mopidy, bad.
+        # Use values from the status rather than the song, as duration is
+        # missing when using mpd to play urls or local files
+        song_duration = status_duration(status)
 
-def find_session(session_file_path, base_url, api_key, api_secret, interactive=True):
-    """
-    Try to read a saved last.fm session from disk, or create a new one.
+        fields = track_fields(song)
+        title = fields["track"]
+        artist = fields["artist"]
+        album = fields.get("album", "")
 
-    :param session_file_path: The path to the session file to be read or written to.
-    :param base_url: The base_url of the scrobble 2.0 API
-    :param api_key: This program's last.fm API key
-    :param api_secret: This program's last.fm API secret
+        elapsed = float(status["elapsed"])
+
+        # The % between 0-100 that has completed so far
+        percent_elapsed = elapsed / song_duration * 100
+
+        if (
+            self.current_watched_track != title
+            and title != ""  # Is this a new track to watch?
+            and title != self.reject_track  # And this track actually has a title
+            and percent_elapsed  # And it's not a track to be rejected
+            < scrobble_threshold
+            and real_time_elapsed  # And it's below the scrobble threshold
+            > self.watch_threshold
+            and elapsed > self.watch_threshold  # And it's REALLY passed 5 seconds?
+        ):  # And it reports to be passed 5 seconds (sanity check)
+
+            self.current_watched_track = title
+            self.reject_track = ""
+            self.connection_warmed = False
+
+            self.start_time = self.clock()
+            self.reported_start_time = elapsed - self.watch_threshold
+
+            if self.use_real_time:
+                # So, if we're using real time, and our default_scrobble_threshold is less than 50, we need to do some math:
+                # Assuming we might have started late, how many real world seconds do I have to listen to to be able to say I've listened to N% (where N = default_scrobble_threshold) of music? Take that amount of seconds and turn it into its own threshold (added to the aforementioned late start time) and baby you've got a stew going
+                scrobble_threshold = (
+                    (
+                        self.reported_start_time
+                        + (song_duration - self.reported_start_time)
+                        * (self.default_scrobble_threshold / 100)
+                    )
+                    / song_duration
+                ) * 100
+                logger.info(
+                    "While the scrobbling threshold would normally be {}%, since we're starting at {}s (out of {}s, a.k.a. {}%), it's now {}%".format(
+                        self.default_scrobble_threshold,
+                        format(self.reported_start_time, ".1f"),
+                        format(song_duration, ".1f"),
+                        format(self.reported_start_time / song_duration * 100, ".1f"),
+                        format(scrobble_threshold, ".1f"),
+                    )
+                )
+                logger.debug(
+                    "(start + ( total - start ) * threshold) / total =  ( {0} + ( {1} - {0} ) * {2} ) / {1}".format(
+                        self.reported_start_time,
+                        song_duration,
+                        self.default_scrobble_threshold,
+                    )
+                )
+            else:
+                scrobble_threshold = self.default_scrobble_threshold
+
+            logger.debug(
+                "Reported start time: {}, real world time: {}".format(
+                    self.reported_start_time, self.start_time
+                )
+            )
+            logger.info(
+                "Starting to watch track: {} by {}, currently at: {}/{}s ({}%). Will scrobble in: {}s".format(
+                    title,
+                    artist,
+                    format(elapsed, ".0f"),
+                    format(song_duration, ".0f"),
+                    format(percent_elapsed, ".1f"),
+                    format((song_duration * scrobble_threshold / 100) - elapsed, ".0f"),
+                )
+            )
+            return TrackWatcher.NOW_PLAYING
+
+        elif self.current_watched_track == title:
+
+            # logger.debug("{}, at: {}%".format(title,format(percent_elapsed, '.2f')))
+
+            # Are we above the scrobble threshold? Have we been listening the required amount of time?
+            if (
+                percent_elapsed >= scrobble_threshold
+                and elapsed > self.scrobble_min_time
+            ):
+                # If we're using real time, lets ensure we've been listening this long:
+                if (
+                    not self.use_real_time
+                    or real_time_elapsed >= (scrobble_threshold / 100) * song_duration
+                ):
+                    self.current_watched_track = ""
+                    if not self.allow_scrobble_same_song_twice_in_a_row:
+                        self.reject_track = title
+                    return TrackWatcher.SCROBBLE
+                else:
+                    logger.warn(
+                        "Can't scrobble yet, time elapsed ({}s) < adjusted duration ({}s)".format(
+                            real_time_elapsed,
+                            (scrobble_threshold / 100) * song_duration,
+                        )
+                    )
+
+            # Open a connection to the API shortly before we're due to scrobble, so the scrobble itself
+            # doesn't have to wait on a TCP/TLS handshake
+            elif self.prewarm_time > 0 and not self.connection_warmed:
+                scrobble_point = (scrobble_threshold / 100) * song_duration
+                time_to_scrobble = max(
+                    scrobble_point - elapsed, self.scrobble_min_time - elapsed
+                )
+                if self.use_real_time:
+                    time_to_scrobble = max(
+                        time_to_scrobble, scrobble_point - real_time_elapsed
+                    )
+                if time_to_scrobble <= self.prewarm_time:
+                    self.connection_warmed = True
+                    return TrackWatcher.WARM
+
+        return None
+
+
+def retry_failed_scrobbles(
+    failed_scrobbles, session, config, transport=None, sessions=None
+):
+    """
+    Try to submit the previously failed scrobbles, removing them from the cache as they're accepted.
+
+    :param failed_scrobbles: The failed scrobbles cache
+    :param session: The Session key for last.fm
+    :param config: The global config file
+    :param transport: (Optional) The HTTP transport to send requests over
+    :param sessions: (Optional) The session key of every known user, see drain_failed_scrobbles
+
+    :type failed_scrobbles: yams.cache.SegmentedLogStore
+    :type session: str
+    :type config: dict
+    :type transport: yams.transport.Transport
+    :type sessions: dict
+    """
+
+    if len(failed_scrobbles) < 1:
+        return
+
+    # Don't bother while the endpoint's still backing off, retry_delay says when it'll be worth it
+    if (
+        transport is not None
+        and transport.policy(config["base_url"]).retry_delay(0) > 0
+    ):
+        logger.debug(
+            "Holding on to {} failed scrobbles, {} is backing off.".format(
+                len(failed_scrobbles), config["base_url"]
+            )
+        )
+        return
+
+    drain_failed_scrobbles(
+        failed_scrobbles,
+        session,
+        config,
+        transport,
+        concurrency=config["drain_concurrency"],
+        sessions=sessions,
+    )
+
+
+def retry_delay(config, transport=None):
+    """
+    :param config: The endpoint's config
+    :param transport: (Optional) The HTTP transport requests are sent over
+
+    :return: Seconds until it's next worth re-sending failed scrobbles: SCROBBLE_RETRY_INTERVAL, or longer while the endpoint's retry policy is backing off
+    :rtype: float
+    """
+
+    if transport is None:
+        return SCROBBLE_RETRY_INTERVAL
+    return transport.policy(config["base_url"]).retry_delay(SCROBBLE_RETRY_INTERVAL)
+
+
+def batch_scrobbles(scrobbles):
+    """
+    Split scrobbles up into batches that can each be sent in one request: at most MAX_TRACKS_PER_SCROBBLE
+    long, and all belonging to the same user. Keeps the scrobbles in order.
+
+    :param scrobbles: Scrobbles as returned by the scrobbles cache's peek
+    :type scrobbles: list
+
+    :return: A list of (user name, batch) tuples. The user name is None for scrobbles that weren't tagged with one
+    :rtype: list
+    """
+
+    batches = []
+    for scrobble in scrobbles:
+        user_name = scrobble.user
+        if (
+            len(batches) < 1
+            or batches[-1][0] != user_name
+            or len(batches[-1][1]) >= MAX_TRACKS_PER_SCROBBLE
+        ):
+            batches.append((user_name, []))
+        batches[-1][1].append(scrobble)
+
+    return batches
+
+
+def send_cached_batch(batch, accepted, config, session_key, transport=None):
+    """
+    Send a batch of cached scrobbles with scrobble_tracks, leaving out the ones that already left the cache
+    for good (they were sent, but we never got around to removing them), and remembering the rest once they've
+    been submitted so they won't be sent again either.
+
+    :param batch: The scrobbles to send, no more than MAX_TRACKS_PER_SCROBBLE of them
+    :param accepted: The cache's filter of scrobbles that recently left it
+    :param config: The global config file
+    :param session_key: The Session key for last.fm
+    :param transport: (Optional) The HTTP transport to send requests over
+
+    :type batch: list
+    :type accepted: yams.cache.AcceptedFilter
+    :type config: dict
+    :type session_key: str
+    :type transport: yams.transport.Transport
+
+    :return: As scrobble_tracks, counting the scrobbles left out as submitted
+    :rtype: (int,int)
+    """
+
+    unsent = [scrobble for scrobble in batch if scrobble not in accepted]
+    if len(unsent) < len(batch):
+        logger.info(
+            "Not re-sending {} cached scrobbles that were already accepted.".format(
+                len(batch) - len(unsent)
+            )
+        )
+    if len(unsent) == 0:
+        return 0, len(batch)
+
+    accepted_count, submitted_count = scrobble_tracks(
+        unsent,
+        config["base_url"],
+        config["api_key"],
+        config["api_secret"],
+        session_key,
+        transport,
+        config["response_format"],
+    )
+    if submitted_count < 1:
+        return accepted_count, submitted_count
+
+    # Remembered before the batch leaves the cache, so a crash in between can't send it twice
+    accepted.add(unsent)
+    # The batch fits in one request, so it's been submitted in full
+    return accepted_count, len(batch)
+
+
+def drain_failed_scrobbles(
+    failed_scrobbles,
+    session,
+    config,
+    transport=None,
+    concurrency=1,
+    progress=None,
+    sessions=None,
+):
+    """
+    Send the failed scrobbles cache to Last.FM, MAX_TRACKS_PER_SCROBBLE at a time, with up to 'concurrency'
+    batches in flight at once. Batches are taken from the cache oldest first and each one is removed from
+    the cache as soon as it (and every batch before it) has been accepted, so the cache stays in order.
+    Stops at the first batch that has to be sent again, leaving it and everything after it for later. Batches
+    Last.FM ignored or refused for good are removed too, as sending them again wouldn't change its mind.
+    Scrobbles the cache's accepted filter remembers are removed without being sent, see send_cached_batch.
+    Scrobbles cached for a user in sessions are sent with that user's session key, the rest with session.
+
+    :param failed_scrobbles: The failed scrobbles cache
+    :param session: The Session key for last.fm
+    :param config: The global config file
+    :param transport: (Optional) The HTTP transport to send requests over
+    :param concurrency: (Optional) The maximum amount of batches to send at the same time
+    :param progress: (Optional) Called with (submitted so far, total) after every batch that's left the cache
+    :param sessions: (Optional) A dictionary of user name to session key, for scrobbles cached by more than one account
+
+    :type failed_scrobbles: yams.cache.SegmentedLogStore
+    :type session: str
+    :type config: dict
+    :type transport: yams.transport.Transport
+    :type concurrency: int
+    :type progress: function
+    :type sessions: dict
+
+    :return: A tuple of (accepted count of scrobbles, submitted count of scrobbles)
+    :rtype: (int,int)
+    """
+
+    if sessions is None:
+        sessions = {}
+
+    total = len(failed_scrobbles)
+    accepted_total = 0
+    submitted_total = 0
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while len(failed_scrobbles) > 0:
+            window = failed_scrobbles.peek(concurrency * MAX_TRACKS_PER_SCROBBLE)
+            futures = [
+                executor.submit(
+                    send_cached_batch,
+                    batch,
+                    failed_scrobbles.accepted,
+                    config,
+                    sessions.get(user_name, session),
+                    transport,
+                )
+                for user_name, batch in batch_scrobbles(window)[:concurrency]
+            ]
+
+            # Acknowledge in order, a batch can only leave the cache once the ones before it have
+            for index, future in enumerate(futures):
+                accepted_count, submitted_count = future.result()
+                if submitted_count < 1:
+                    for remaining in futures[index + 1 :]:
+                        remaining.cancel()
+                    logger.warn(
+                        "Stopped sending failed scrobbles, {} left in the cache.".format(
+                            len(failed_scrobbles)
+                        )
+                    )
+                    return accepted_total, submitted_total
+
+                failed_scrobbles.ack(submitted_count)
+                accepted_total += accepted_count
+                submitted_total += submitted_count
+                if progress is not None:
+                    progress(submitted_total, total)
+
+    return accepted_total, submitted_total
+
+
+def flush_failed_scrobbles(session, config, transport=None, sessions=None):
+    """
+    Send every failed scrobble in the cache to Last.FM, printing progress as we go. Used by --flush.
+
+    :param session: The Session key for last.fm
+    :param config: The global config file
+    :param transport: (Optional) The HTTP transport to send requests over
+    :param sessions: (Optional) The session key of every known user, see drain_failed_scrobbles
+
+    :type session: str
+    :type config: dict
+    :type transport: yams.transport.Transport
+    :type sessions: dict
+
+    :return: True if the cache was emptied
+    :rtype: bool
+    """
+
+    failed_scrobbles = open_scrobble_store(config)
+    try:
+        if len(failed_scrobbles) < 1:
+            logger.info("No failed scrobbles to flush.")
+            return True
+
+        logger.info("Flushing {} failed scrobbles...".format(len(failed_scrobbles)))
+
+        def progress(submitted, total):
+            logger.info("Flushed {}/{} scrobbles".format(submitted, total))
+
+        drain_failed_scrobbles(
+            failed_scrobbles,
+            session,
+            config,
+            transport,
+            concurrency=config["drain_concurrency"],
+            progress=progress,
+            sessions=sessions,
+        )
+        return len(failed_scrobbles) < 1
+    finally:
+        failed_scrobbles.close()
+
+
+def submit_scrobble(
+    song,
+    status,
+    timestamp,
+    failed_scrobbles,
+    session,
+    config,
+    transport=None,
+    user_name=None,
+    sessions=None,
+):
+    """
+    Scrobble a track, or queue it up with the rest of the failed scrobbles if that's not possible right now.
+
+    :param song: The info on the track taken from client.currentsong()
+    :param status: The info on the track taken from client.status()
+    :param timestamp: The starting time of the track, as a UTC Unix Timestamp (seconds since the Epoch)
+    :param failed_scrobbles: The failed scrobbles cache
+    :param session: The Session key for last.fm
+    :param config: The global config file
+    :param transport: (Optional) The HTTP transport to send requests over
+    :param user_name: (Optional) The Last.FM user session belongs to
+    :param sessions: (Optional) The session key of every known user, for re-sending cached scrobbles
+
+    :type song: dict
+    :type status: dict
+    :type timestamp: float
+    :type failed_scrobbles: yams.cache.SegmentedLogStore
+    :type session: str
+    :type config: dict
+    :type transport: yams.transport.Transport
+    :type user_name: str
+    :type sessions: dict
+    """
+
+    if len(failed_scrobbles) < 1:
+        # If we don't have any pending scrobbles, try to scrobble this
+        scrobble_succeeded = scrobble_track(
+            song,
+            status,
+            timestamp,
+            config["base_url"],
+            config["api_key"],
+            config["api_secret"],
+            session,
+            transport,
+            config["response_format"],
+        )
+        # If we've failed, add it to the list for future scrobbles (and write it to the disk)
+        if not scrobble_succeeded:
+            queue_failed_scrobble(song, status, timestamp, failed_scrobbles, user_name)
+        return
+
+    # If we have failed and queued up scrobbles, add this one to the list and try to do them all in one go
+    queue_failed_scrobble(song, status, timestamp, failed_scrobbles, user_name)
+    retry_failed_scrobbles(failed_scrobbles, session, config, transport, sessions)
+
+
+def queue_failed_scrobble(song, status, timestamp, failed_scrobbles, user_name=None):
+    """
+    Add a scrobble to the failed scrobbles cache, unless it's already in there.
+
+    :param song: The info on the track taken from client.currentsong()
+    :param status: The info on the track taken from client.status()
+    :param timestamp: The starting time of the track, as a UTC Unix Timestamp (seconds since the Epoch)
+    :param failed_scrobbles: The failed scrobbles cache
+    :param user_name: (Optional) The Last.FM user the scrobble belongs to, so it can be re-sent with their session later
+
+    :type song: dict
+    :type status: dict
+    :type timestamp: float
+    :type failed_scrobbles: yams.cache.SegmentedLogStore
+    :type user_name: str
+    """
+
+    if user_name is None:
+        failed_scrobble = make_scrobble(song, status, timestamp=timestamp)
+    else:
+        failed_scrobble = make_scrobble(
+            song, status, timestamp=timestamp, user=user_name
+        )
+    failed_scrobble = ScrobbleRecord.from_dict(failed_scrobble)
+    if failed_scrobble not in failed_scrobbles:
+        failed_scrobbles.enqueue(failed_scrobble)
+
+
+class NowPlayingSlot:
+    """
+    Coalesces now playing updates: only the most recent one of each account is held, so that when tracks
+    are skipped through faster than updates can be sent, the ones superseded by a newer track are dropped
+    instead of being sent one after the other. Accounts are kept apart, as every account (e.g. every room
+    scrobbling to the endpoint with an account of its own) has a now playing of its own. The generation
+    taken along with an update tells whether it's been superseded since (e.g. while it waited on the
+    network), so it can be dropped as late as possible.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Account to the update waiting to be sent for it
+        self.latest = {}
+        # Account to how many updates have been offered for it
+        self.generations = Counter()
+
+    def offer(self, update, account=None):
+        """
+        :param update: The now playing update to send, replacing any still waiting for its account
+        :param account: (Optional) The (user name, session key) the update's sent with, None for the endpoint's own session
+
+        :type update: tuple
+        :type account: tuple
+
+        :return: True if no update was waiting for the account, i.e. one needs to be queued up to send this one
+        :rtype: bool
+        """
+
+        with self.lock:
+            waiting = account in self.latest
+            self.latest[account] = update
+            self.generations[account] += 1
+
+        if waiting:
+            METRICS.inc("yams_now_playing_dropped_total", reason="superseded")
+        return not waiting
+
+    def take(self, account=None):
+        """
+        :return: The account's latest update (None if it's already been taken) and its generation
+        :rtype: tuple
+        """
+
+        with self.lock:
+            return (self.latest.pop(account, None), self.generations[account])
+
+    def discard(self, account=None):
+        """Drop the account's waiting update, for when it couldn't be queued up to be sent after all"""
+
+        with self.lock:
+            self.latest.pop(account, None)
+
+    def superseded(self, account, generation):
+        return self.generations[account] != generation
+
+
+class SubmissionWorker(threading.Thread):
+    """
+    Sends now playing updates and scrobbles to Last.FM from a thread of its own, so the watcher never has
+    to wait on the network. The watcher hands over what it wants sent through a bounded queue and moves on.
+    The worker also re-sends failed scrobbles every SCROBBLE_RETRY_INTERVAL seconds, or less often while
+    Last.FM is down or asking us to slow down (see yams.retry.RetryPolicy).
+
+    If the queue is full the network can't keep up: now playing updates are dropped, and scrobbles are
+    written straight into the failed scrobbles cache, to go out in a later batch. Since the watcher
+    timestamps every scrobble itself, a slow network never affects when a track counts as played.
+
+    Now playing updates are coalesced (see NowPlayingSlot), only each account's latest track's is ever
+    sent, and not even that while scrobbles are waiting to go out behind it.
+
+    One worker serves one endpoint (see yams.configure.endpoint_configs), for as many watchers as scrobble
+    to it, each possibly with its own account: requests may name an account (a tuple of user name and
+    session key) to be sent with, otherwise they're sent with session.
+
+    :param session: The Session key for last.fm
+    :param config: The endpoint's config
+    :param transport: The long-lived HTTP transport to send requests over
+    :param failed_scrobbles: The failed scrobbles cache
+
+    :type session: str
+    :type config: dict
+    :type transport: yams.transport.Transport
+    :type failed_scrobbles: yams.cache.SegmentedLogStore
+    """
+
+    STOP = "stop"
+
+    def __init__(self, session, config, transport, failed_scrobbles):
+        super().__init__(
+            name="yams-submission-{}".format(config.get("name", "default")),
+            daemon=True,
+        )
+
+        self.session = session
+        self.config = config
+        self.transport = transport
+        self.failed_scrobbles = failed_scrobbles
+
+        self.intents = queue.Queue(maxsize=config["submission_queue_size"])
+        # The session key of every account we've been told about, to send their cached scrobbles with
+        self.sessions = {}
+        self.now_playing_slot = NowPlayingSlot()
+        # Scrobbles queued up and not handled yet, that now playing updates are held back for
+        self.scrobbles_waiting = 0
+        self.waiting_lock = threading.Lock()
+
+    def add_account(self, account):
+        """
+        :param account: A tuple of (user name, session key)
+        :type account: tuple
+        """
+        user_name, session = account
+        self.sessions[user_name] = session
+
+    def put(self, intent):
+        try:
+            self.intents.put_nowait(intent)
+            return True
+        except queue.Full:
+            logger.warn(
+                "Submission queue for {} is full ({} waiting), it can't keep up!".format(
+                    self.name, self.intents.qsize()
+                )
+            )
+            return False
+
+    def congested(self):
+        """
+        :return: True if the queue is full, and new requests are being dropped or cached
+        :rtype: bool
+        """
+        return self.intents.full()
+
+    def now_playing(self, song, status, account=None):
+        if self.congested():
+            METRICS.inc("yams_now_playing_dropped_total", reason="congested")
+            return False
+        if not self.now_playing_slot.offer((song, status, account), account):
+            # There's already one queued up, which will send this instead
+            return True
+        if self.put((TrackWatcher.NOW_PLAYING, None, None, None, account)):
+            return True
+        # Nothing's queued up to send it, so it mustn't keep later updates from being queued
+        self.now_playing_slot.discard(account)
+        METRICS.inc("yams_now_playing_dropped_total", reason="congested")
+        return False
+
+    def warm(self):
+        return self.put((TrackWatcher.WARM, None, None, None, None))
+
+    def scrobble(self, song, status, timestamp, account=None):
+        self.count_waiting(1)
+        if self.put((TrackWatcher.SCROBBLE, song, status, timestamp, account)):
+            return True
+        self.count_waiting(-1)
+
+        # No room, cache it so the worker can send it along with the rest of the backlog
+        queue_failed_scrobble(
+            song, status, timestamp, self.failed_scrobbles, self.user_name(account)
+        )
+        return False
+
+    def count_waiting(self, change):
+        with self.waiting_lock:
+            self.scrobbles_waiting += change
+
+    def user_name(self, account):
+        return account[0] if account is not None else None
+
+    def session_key(self, account):
+        return account[1] if account is not None else self.session
+
+    def stop(self, timeout=None):
+        """Ask the worker to finish up, and wait for it to do so"""
+
+        try:
+            self.intents.put(SubmissionWorker.STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self.join(timeout)
+
+    def run(self):
+
+        scheduler = Scheduler()
+
+        while True:
+            # With nothing cached there's nothing to retry, so we can sleep until there's something to send
+            if len(self.failed_scrobbles) > 0:
+                if not scheduler.is_scheduled("retry"):
+                    scheduler.schedule_in(
+                        "retry", retry_delay(self.config, self.transport)
+                    )
+            else:
+                scheduler.cancel("retry")
+
+            try:
+                intent = self.intents.get(timeout=scheduler.time_until_next())
+            except queue.Empty:
+                intent = None
+
+            if intent == SubmissionWorker.STOP:
+                break
+
+            try:
+                if intent is not None:
+                    self.handle(*intent)
+
+                # Check to see if we've got any tracks to scrobble (this is on a timer just in case)
+                if "retry" in scheduler.pop_due():
+                    retry_failed_scrobbles(
+                        self.failed_scrobbles,
+                        self.session,
+                        self.config,
+                        self.transport,
+                        self.sessions,
+                    )
+            except Exception:
+                logger.exception("Something went wrong sending requests to Last.FM!")
+
+        # Anything we didn't get around to sending is kept for the next run
+        while True:
+            try:
+                intent = self.intents.get_nowait()
+            except queue.Empty:
+                break
+            if intent == SubmissionWorker.STOP:
+                # stop() may have been called more than once
+                continue
+            action, song, status, timestamp, account = intent
+            if action == TrackWatcher.SCROBBLE:
+                queue_failed_scrobble(
+                    song,
+                    status,
+                    timestamp,
+                    self.failed_scrobbles,
+                    self.user_name(account),
+                )
+
+    def handle(self, action, song, status, timestamp, account):
+
+        if account is not None:
+            self.add_account(account)
+
+        if action == TrackWatcher.NOW_PLAYING:
+            self.send_now_playing(account)
+        elif action == TrackWatcher.WARM and self.transport is not None:
+            self.transport.warm(self.config["base_url"])
+        elif action == TrackWatcher.SCROBBLE:
+            self.count_waiting(-1)
+            if not self.intents.empty():
+                # More requests are waiting behind this one - cache it, so it goes out with the others in one batch
+                queue_failed_scrobble(
+                    song,
+                    status,
+                    timestamp,
+                    self.failed_scrobbles,
+                    self.user_name(account),
+                )
+            else:
+                submit_scrobble(
+                    song,
+                    status,
+                    timestamp,
+                    self.failed_scrobbles,
+                    self.session_key(account),
+                    self.config,
+                    self.transport,
+                    self.user_name(account),
+                    self.sessions,
+                )
+
+    def send_now_playing(self, account=None):
+        update, generation = self.now_playing_slot.take(account)
+        if update is None:
+            return
+        if self.scrobbles_waiting > 0:
+            # Scrobbles are waiting, and the track's likely changed again by the time they're through
+            logger.debug("Requests are waiting, not sending now playing")
+            METRICS.inc("yams_now_playing_dropped_total", reason="congested")
+            return
+
+        song, status, account = update
+        if account is not None:
+            self.add_account(account)
+        now_playing(
+            song,
+            status,
+            self.config["base_url"],
+            self.config["api_key"],
+            self.config["api_secret"],
+            self.session_key(account),
+            self.transport,
+            functools.partial(self.now_playing_slot.superseded, account, generation),
+            self.config["response_format"],
+        )
+
+
+class EndpointFanout:
+    """
+    Hands a player's requests over to the submission worker of every endpoint it scrobbles to. Every
+    worker has a queue (and a failed scrobbles cache, and retries) of its own, so handing a request over
+    never waits on the network, and a slow or failing endpoint can't hold up any of the others.
+
+    :param targets: A list of (worker, account) tuples, account being the (user name, session key) to use with that worker's endpoint
+    :type targets: list
+    """
+
+    def __init__(self, targets):
+        self.targets = targets
+
+    def now_playing(self, song, status):
+        for worker, account in self.targets:
+            worker.now_playing(song, status, account)
+
+    def warm(self):
+        for worker, account in self.targets:
+            worker.warm()
+
+    def scrobble(self, song, status, timestamp):
+        for worker, account in self.targets:
+            worker.scrobble(song, status, timestamp, account)
+
+
+def mpd_watch_track(
+    client,
+    session,
+    config,
+    transport=None,
+    submitter=None,
+    clock=time.time,
+    sleep=time.sleep,
+):
+    """
+    The main loop - watches MPD and tracks the currently playing song. Sends Last.FM updates if need be.
+
+    :param client: The MPD client object
+    :param session: The Session key for last.fm, only used if no submitter is given
+    :param config: The global (or this player's) config file
+    :param transport: (Optional) The long-lived HTTP transport to send requests over
+    :param submitter: (Optional) Where to hand requests to. A submission worker is started (and stopped on exit) if None
+    :param clock: (Optional) The function used to tell the time, in seconds since the Epoch
+    :param sleep: (Optional) The function used to wait between checks, given the seconds to wait
+
+    :type client: mpd.MPDClient
+    :type session: str
+    :type config: dict
+    :type transport: yams.transport.Transport
+    :type submitter: yams.scrobble.EndpointFanout
+    :type clock: function
+    :type sleep: function
+    """
+
+    update_interval = config["update_interval"]
+    max_update_interval = config["max_update_interval"]
+    player = config.get("name", "{}:{}".format(config["mpd_host"], config["mpd_port"]))
+
+    watcher = TrackWatcher(config, clock)
+    scheduler = Scheduler(clock)
+    tracks = TrackCache()
+
+    recording = None
+    if config.get("mpd_record_file", ""):
+        recording = RecordingMPDClient(
+            client, open_recording(config["mpd_record_file"], "a"), player, clock
+        )
+        client = recording
+    client = CountingMPDClient(client)
+    idling = can_wait_for_player(client)
+    round_trips = 0
+
+    own_worker = submitter is None
+    if own_worker:
+        worker = SubmissionWorker(
+            session, config, transport, open_scrobble_store(config)
+        )
+        worker.start()
+        submitter = EndpointFanout([(worker, None)])
+
+    try:
+        while True:
+
+            # Waiting for play has just fetched the status and looked the track up, no need to ask MPD again
+            playing = mpd_wait_for_play(client, tracks)
+            if playing is None:
+                break
+            status, song = playing
+            state = status["state"]
+
+            if state == "play":
+
+                action = watcher.update(song, status)
+
+                if action == TrackWatcher.NOW_PLAYING:
+                    submitter.now_playing(song, status)
+                elif action == TrackWatcher.WARM:
+                    submitter.warm()
+                elif action == TrackWatcher.SCROBBLE:
+                    submitter.scrobble(song, status, watcher.start_time)
+
+                tracks.prefetch(client, status)
+
+                # Idle until the watcher next needs to see the track, or MPD tells us about a skip, seek
+                # or pause. Clients that can't idle sleep instead, so max_update_interval bounds how late
+                # they'll notice those
+                scheduler.schedule("track", watcher.next_check)
+                if not idling:
+                    scheduler.schedule_in("poll", max_update_interval)
+                tracks.changed(
+                    wait_for_player(
+                        client,
+                        scheduler.time_until_next(minimum=update_interval),
+                        sleep,
+                    )
+                )
+                scheduler.pop_due()
+
+            METRICS.observe(
+                "yams_mpd_roundtrips_per_iteration",
+                client.round_trips - round_trips,
+                player=player,
+            )
+            round_trips = client.round_trips
+    finally:
+        if own_worker:
+            worker.stop()
+            worker.failed_scrobbles.close()
+        if recording is not None:
+            recording.close()
+
+
+def find_session(
+    session_file_path,
+    base_url,
+    api_key,
+    api_secret,
+    interactive=True,
+    response_format=FORMAT_JSON,
+):
+    """
+    Try to read a saved last.fm session from disk, or create a new one.
+
+    :param session_file_path: The path to the session file to be read or written to.
+    :param base_url: The base_url of the scrobble 2.0 API
+    :param api_key: This program's last.fm API key
+    :param api_secret: This program's last.fm API secret
     :param interactive: Are we in an interactive shell where we can prompt the user for info?
+    :param response_format: (Optional) What to ask the API to answer in, see make_request
 
     :type session_file_path: str
     :type base_url: str
     :type api_key: str
     :type api_secret: str
     :type interactive: bool
+    :type response_format: str
     """
 
     # Try to read a saved session...
@@ -965,13 +2080,17 @@ def find_session(session_file_path, base_url, api_key, api_secret, interactive=T
             exit(1)
 
         logger.info("Attempting new authentication...")
-        token = get_token(base_url, api_key, api_secret)
+        token = get_token(
+            base_url, api_key, api_secret, response_format=response_format
+        )
         logger.info(
             "Token received, navigate to http://www.last.fm/api/auth/?api_key={}&token={} to authenticate...".format(
                 api_key, token
             )
         )
-        session_info = authenticate(token, base_url, api_key, api_secret)
+        session_info = authenticate(
+            token, base_url, api_key, api_secret, response_format
+        )
 
         print(session_info)
         user_name, session = session_info
@@ -1003,6 +2122,11 @@ def save_pid(file_path, pid=None):
     atexit.register(rm_pid_atexit, Path(file_path))
 
 
+def stop_on_sigterm(signum, frame):
+    "SIGTERM handler: stop the way Ctrl+C would, so the caches get written out on the way (see FlushPolicy)"
+    raise KeyboardInterrupt()
+
+
 def rm_pid_atexit(pid_file_path):
     "Delete pid file atexit handler"
     pid_file_path.unlink()
@@ -1047,71 +2171,114 @@ def fork(config):
         exit(1)
 
 
+class IdleMPDClient(MPDClient):
+    """
+    python-mpd2's MPDClient, plus the send_idle, fetch_idle and noidle it dropped in 3.0. These split idle
+    in two, so that the wait in between can be multiplexed with select() on fileno(), and cut short by noidle
+    """
+
+    def send_idle(self, *subsystems):
+        self._write_command("idle", subsystems)
+
+    def fetch_idle(self):
+        return list(self._parse_list(self._read_lines()))
+
+    def noidle(self):
+        # MPD answers what it was idling on, which is nothing unless a change crossed our noidle. If the
+        # idle had already returned, the noidle's ignored and fetch_idle() reads that answer instead
+        self._write_command("noidle")
+        return self.fetch_idle()
+
+
 def connect_to_mpd(host, port):
     """Connect to MPD, throws an exception if failed"""
 
-    client = MPDClient()
+    client = IdleMPDClient()
     client.connect(host, port)
     logger.info("Connected to mpd, version: {}".format(client.mpd_version))
     return client
 
 
-def cli_run():
-    """Command line entrypoint"""
+def resolve_endpoints(players, interactive=True):
+    """
+    Work out which endpoints every player scrobbles to, and with which account, reading (or creating) a
+    session for every session file along the way. Endpoints are told apart by name: players naming the
+    same endpoint share it, configured as the first of them to name it.
 
-    session = ""
-    config = configure()
-    logger.info(
-        "Starting up YAMS v{}".format(importlib.metadata.version("YAMScrobbler"))
-    )
+    :param players: The config of each player, see yams.configure.player_configs
+    :param interactive: Are we in an interactive shell where we can prompt the user for info?
 
-    session_file = config["session_file"]
-    base_url = config["base_url"]
-    api_key = config["api_key"]
-    api_secret = config["api_secret"]
+    :type players: list
+    :type interactive: bool
 
-    mpd_host = config["mpd_host"]
-    mpd_port = config["mpd_port"]
+    :return: A tuple of (a dictionary of endpoint name to endpoint config, and for each player a list of (endpoint name, account) tuples)
+    :rtype: (dict,list)
+    """
 
-    interactive_shell_available = (
-        not config["non_interactive"] if "non_interactive" in config else True
-    )
-    user_name, session = find_session(
-        session_file, base_url, api_key, api_secret, interactive_shell_available
-    )
+    endpoints = {}
+    routes = []
+    # Endpoints sharing a session file share an account, only read (or authenticate) each one once
+    accounts = {}
+
+    for player in players:
+        route = []
+        for endpoint in endpoint_configs(player):
+            session_file = endpoint["session_file"]
+            if session_file not in accounts:
+                accounts[session_file] = find_session(
+                    session_file,
+                    endpoint["base_url"],
+                    endpoint["api_key"],
+                    endpoint["api_secret"],
+                    interactive,
+                    endpoint["response_format"],
+                )
+            endpoints.setdefault(endpoint["name"], endpoint)
+            route.append((endpoint["name"], accounts[session_file]))
+        routes.append(route)
 
-    keep_alive = config["keep_alive"] if "keep_alive" in config else False
+    return endpoints, routes
 
-    client = None
 
-    try:
-        client = connect_to_mpd(mpd_host, mpd_port)
-    except Exception as e:
-        logger.error(
-            "Could not connect to MPD! Check that your config is correct and that MPD is running. Error: {}".format(
-                e
-            )
-        )
-        if not keep_alive:
-            exit(1)
-        else:
-            logger.warn("Not dying, will keep alive and wait for MPD.")
+def endpoint_accounts(routes):
+    """
+    :param routes: For each player, a list of (endpoint name, account) tuples
+    :type routes: list
 
-    # If we're allowed to daemonize, do so
-    if "no_daemon" in config:
-        if not config["no_daemon"]:
-            fork(config)
-            remove_log_stream_of_type(logging.StreamHandler)
-        # NOTE: Comment these 2 lines out if you don't want YAMS to save a pid file in no-daemon mode
-        elif config["no_daemon"] and "pid_file" in config:
-            save_pid(config["pid_file"])
+    :return: A dictionary of endpoint name to the accounts used with it, in order of first use
+    :rtype: dict
+    """
+
+    accounts = {}
+    for route in routes:
+        for name, account in route:
+            if account not in accounts.setdefault(name, []):
+                accounts[name].append(account)
+    return accounts
+
+
+def watch_player(client, player, transport, submitter):
+    """
+    Watch one MPD server for as long as we're running, reconnecting to it whenever the connection's lost.
+
+    :param client: The MPD client object, or None if we're not connected yet
+    :param player: The player's config, see yams.configure.player_configs
+    :param transport: The long-lived HTTP transport to send requests over
+    :param submitter: Where to hand the player's requests to
+
+    :type client: mpd.MPDClient
+    :type player: dict
+    :type transport: yams.transport.Transport
+    :type submitter: yams.scrobble.EndpointFanout
+    """
 
-    RECONNECT_TIMEOUT = 10
+    mpd_host = player["mpd_host"]
+    mpd_port = player["mpd_port"]
 
     while True:
         if client:
             try:
-                mpd_watch_track(client, session, config)
+                mpd_watch_track(client, None, player, transport, submitter)
             # User is in no-daemon mode and wants to exit
             except KeyboardInterrupt:
                 print("")
@@ -1119,7 +2286,11 @@ def cli_run():
                 break
             # A connection error implies we lost connection with MPD - lets retry unless the user kills us
             except ConnectionError as e:
-                logger.error("Received an MPD Connection error!: {}".format(e))
+                logger.error(
+                    "Received an MPD Connection error from {}!: {}".format(
+                        player["name"], e
+                    )
+                )
                 logger.info(
                     "YAMS will keep trying to reconnect to MPD, every {} seconds.".format(
                         RECONNECT_TIMEOUT
@@ -1135,6 +2306,7 @@ def cli_run():
             try:
                 time.sleep(RECONNECT_TIMEOUT)
                 client = connect_to_mpd(mpd_host, mpd_port)
+                METRICS.inc("yams_mpd_reconnects_total", player=player["name"])
             except KeyboardInterrupt:
                 logger.info("Keyboard Interrupt detected - Exiting!")
                 break
@@ -1148,6 +2320,218 @@ def cli_run():
     except:
         logger.warn("Could not gracefully disconnect from Mpd...")
 
+
+def watch_players(clients, players, submitters, transport):
+    """
+    Watch every player at once, one thread each, until any one of them stops (or we're interrupted).
+    A single player is simply watched from the calling thread.
+
+    :param clients: The MPD client object of each player, None for those we're not connected to yet
+    :param players: The config of each player
+    :param submitters: Where to hand each player's requests to
+    :param transport: The long-lived HTTP transport to send requests over
+
+    :type clients: list
+    :type players: list
+    :type submitters: list
+    :type transport: yams.transport.Transport
+    """
+
+    if len(players) == 1:
+        watch_player(clients[0], players[0], transport, submitters[0])
+        return
+
+    stopped = threading.Event()
+
+    def watch(client, player, submitter):
+        try:
+            watch_player(client, player, transport, submitter)
+        finally:
+            stopped.set()
+
+    for client, player, submitter in zip(clients, players, submitters):
+        threading.Thread(
+            target=watch,
+            args=(client, player, submitter),
+            name="yams-{}".format(player["name"]),
+            daemon=True,
+        ).start()
+
+    try:
+        # Waiting in slices keeps us responsive to a KeyboardInterrupt
+        while not stopped.wait(1):
+            pass
+    except KeyboardInterrupt:
+        print("")
+        logger.info("Keyboard Interrupt detected - Exiting!")
+
+
+def run_asyncio_runtime(clients, players, routes, endpoints, stores, transport):
+    """
+    Hand over to the asyncio runtime, which manages its own MPD connections. Exits once it's done.
+
+    :param clients: The (blocking) MPD client objects we've connected with so far, None for those we haven't
+    :param players: The config of each player
+    :param routes: For each player, a list of (endpoint name, account) tuples
+    :param endpoints: A dictionary of endpoint name to endpoint config
+    :param stores: A dictionary of endpoint name to its failed scrobbles cache
+    :param transport: The long-lived HTTP transport to send requests over
+
+    :type clients: list
+    :type players: list
+    :type routes: list
+    :type endpoints: dict
+    :type stores: dict
+    :type transport: yams.transport.Transport
+    """
+
+    # Imported here to avoid a circular import, yams.aio builds on this module
+    from yams.aio import run_async
+
+    for client in clients:
+        if client:
+            client.disconnect()
+
+    logger.info("Using the asyncio runtime")
+    try:
+        asyncio.run(run_async(players, routes, endpoints, stores, transport))
+    # User is in no-daemon mode and wants to exit
+    except KeyboardInterrupt:
+        print("")
+        logger.info("Keyboard Interrupt detected - Exiting!")
+    # If we receive an unknown exception lets exit, as this is undefined behaviour
+    except Exception:
+        logger.exception("Something went very wrong!")
+
+    transport.close()
+    for failed_scrobbles in stores.values():
+        failed_scrobbles.close()
+
+    logger.info("Shutting down...")
+    exit(0)
+
+
+def cli_run():
+    """Command line entrypoint"""
+
+    config = configure()
+    logger.info(
+        "Starting up YAMS v{}".format(importlib.metadata.version("YAMScrobbler"))
+    )
+
+    players = player_configs(config)
+
+    interactive_shell_available = (
+        not config["non_interactive"] if "non_interactive" in config else True
+    )
+    endpoints, routes = resolve_endpoints(players, interactive_shell_available)
+    # Scrobbles not tagged with an account (e.g. cached by an older YAMS) go to the endpoint's first one
+    accounts = endpoint_accounts(routes)
+
+    keep_alive = config["keep_alive"] if "keep_alive" in config else False
+
+    # One transport for the lifetime of the daemon, so its connections can be kept alive between requests
+    transport = transport_from_config(config)
+
+    # Flush mode: send the cache and leave, no MPD (or daemon) needed
+    if "flush" in config and config["flush"]:
+        flushed = True
+        for name, endpoint in endpoints.items():
+            logger.info("Flushing failed scrobbles for {}".format(name))
+            flushed = (
+                flush_failed_scrobbles(
+                    accounts[name][0][1], endpoint, transport, dict(accounts[name])
+                )
+                and flushed
+            )
+        transport.close()
+        exit(0 if flushed else 1)
+
+    # Import mode: add listens from log files to the cache (or send them) and leave
+    if "import" in config and config["import"]:
+        from yams.importer import import_files
+
+        imported = import_files(
+            config["import"],
+            players[0],
+            endpoints,
+            accounts,
+            transport,
+            send=config["import_send"],
+        )
+        transport.close()
+        exit(0 if imported else 1)
+
+    clients = []
+    for player in players:
+        client = None
+        try:
+            client = connect_to_mpd(player["mpd_host"], player["mpd_port"])
+        except Exception as e:
+            logger.error(
+                "Could not connect to MPD ({})! Check that your config is correct and that MPD is running. Error: {}".format(
+                    player["name"], e
+                )
+            )
+            if not keep_alive:
+                exit(1)
+            else:
+                logger.warn("Not dying, will keep alive and wait for MPD.")
+        clients.append(client)
+
+    # If we're allowed to daemonize, do so
+    if "no_daemon" in config:
+        if not config["no_daemon"]:
+            fork(config)
+            remove_log_stream_of_type(logging.StreamHandler)
+        # NOTE: Comment these 2 lines out if you don't want YAMS to save a pid file in no-daemon mode
+        elif config["no_daemon"] and "pid_file" in config:
+            save_pid(config["pid_file"])
+
+    # --kill-daemon sends SIGTERM, which should shut us down as cleanly as an interrupt
+    signal.signal(signal.SIGTERM, stop_on_sigterm)
+
+    # Every endpoint has a cache of its own, shared by the players scrobbling to it. Scrobbles are tagged with the account they belong to
+    stores = {
+        name: open_scrobble_store(endpoint) for name, endpoint in endpoints.items()
+    }
+
+    # Started after forking, as threads don't survive a fork
+    exporter = MetricsExporter(config)
+    exporter.start()
+    atexit.register(exporter.close)
+
+    if config["runtime"] == "asyncio":
+        if any(player.get("mpd_record_file", "") for player in players):
+            logger.warn(
+                "Recording MPD's responses is only supported by the blocking runtime, not recording."
+            )
+        run_asyncio_runtime(clients, players, routes, endpoints, stores, transport)
+
+    # The workers outlive any one MPD connection
+    workers = {}
+    for name, endpoint in endpoints.items():
+        workers[name] = SubmissionWorker(
+            accounts[name][0][1], endpoint, transport, stores[name]
+        )
+        for account in accounts[name]:
+            workers[name].add_account(account)
+        workers[name].start()
+        store_gauges(name, stores[name], workers[name].intents.qsize)
+
+    submitters = [
+        EndpointFanout([(workers[name], account) for name, account in route])
+        for route in routes
+    ]
+
+    watch_players(clients, players, submitters, transport)
+
+    for worker in workers.values():
+        worker.stop(RECONNECT_TIMEOUT)
+    transport.close()
+    for failed_scrobbles in stores.values():
+        failed_scrobbles.close()
+
     logger.info("Shutting down...")
     exit(0)
 
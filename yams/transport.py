@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+import logging
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from yams.retry import RetryPolicy
+
+logger = logging.getLogger("yams")
+
+# Bounds a single response read by chunk, see Transport.request
+CHUNK_SIZE = 8192
+# A connection used within this many seconds is most likely still open, so there's no need to warm it
+WARM_AFTER_IDLE = 15
+
+
+class BufferedResponse:
+    """
+    A response whose body was read in full by Transport.request, with the parts of requests.Response that
+    YAMS uses.
+
+    :param response: The streamed response the body was read from
+    :param content: The response's body
+
+    :type response: requests.Response
+    :type content: bytes
+    """
+
+    def __init__(self, response, content):
+        self.status_code = response.status_code
+        self.reason = response.reason
+        self.headers = response.headers
+        self.url = response.url
+        self.encoding = response.encoding
+        self.content = content
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return str(self.content, self.encoding or "utf-8", errors="replace")
+
+
+class Transport:
+    """
+    A long-lived HTTP transport for talking to the scrobbling API. Wraps a requests.Session with a keep-alive
+    connection pool, so consecutive requests to the same host re-use one TCP (and TLS) connection instead of
+    paying for a fresh handshake every time. Exposes the same get/post call signature as the requests module.
+
+    Also keeps a retry policy (see yams.retry.RetryPolicy) for every host it talks to, and gives up on any
+    request that takes longer than 'deadline' seconds in total, however slowly the server trickles it in.
+
+    :param connect_timeout: Seconds to wait for a connection to be established
+    :param read_timeout: Seconds to wait for the server to send a response
+    :param pool_size: The amount of connections to keep alive per host
+    :param deadline: (Optional) The most seconds a request may take, from start to finish
+    :param policy_factory: (Optional) Makes the retry policy for a host, called without arguments
+    :param clock: (Optional) The function used to tell the time, in seconds
+
+    :type connect_timeout: float
+    :type read_timeout: float
+    :type pool_size: int
+    :type deadline: float
+    :type policy_factory: function
+    :type clock: function
+    """
+
+    def __init__(
+        self,
+        connect_timeout=5,
+        read_timeout=30,
+        pool_size=4,
+        deadline=None,
+        policy_factory=RetryPolicy,
+        clock=time.time,
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+        self.deadline = deadline
+        self.clock = clock
+        # Host to when a request last went out to it
+        self.last_used = {}
+
+        self.policy_factory = policy_factory
+        self.policies = {}
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def policy(self, url):
+        """
+        :param url: Any URL on the host in question
+        :type url: str
+
+        :return: The retry policy for url's host
+        :rtype: yams.retry.RetryPolicy
+        """
+
+        host = urlparse(url).netloc
+        # Setting a key is atomic, at worst two threads make a policy and one of them is thrown away
+        if host not in self.policies:
+            self.policies.setdefault(host, self.policy_factory())
+        return self.policies[host]
+
+    def request(self, method, url, **kwargs):
+        self.last_used[urlparse(url).netloc] = self.clock()
+        if self.deadline is None:
+            return self.session.request(method, url, timeout=self.timeout, **kwargs)
+
+        started = time.monotonic()
+        response = self.session.request(
+            method, url, timeout=self.timeout, stream=True, **kwargs
+        )
+        try:
+            body = []
+            for chunk in response.iter_content(CHUNK_SIZE):
+                body.append(chunk)
+                if time.monotonic() - started > self.deadline:
+                    raise requests.Timeout(
+                        "No complete response from {} within {}s".format(
+                            url, self.deadline
+                        )
+                    )
+        finally:
+            response.close()
+        return BufferedResponse(response, b"".join(body))
+
+    def get(self, url, params=None):
+        return self.request("GET", url, params=params)
+
+    def post(self, url, data=None):
+        return self.request("POST", url, data=data)
+
+    def warm(self, url):
+        """
+        Open (or refresh) a pooled connection to url ahead of time, so the next real request doesn't have to
+        wait on a handshake. Skipped if a request went out in the last WARM_AFTER_IDLE seconds, its connection
+        is still there to be re-used. Failures are ignored, the real request will simply connect on its own.
+
+        :param url: The URL whose host we want a connection to
+        :type url: str
+        """
+
+        host = urlparse(url).netloc
+        if self.clock() - self.last_used.get(host, float("-inf")) < WARM_AFTER_IDLE:
+            logger.debug(
+                "Connection to {} was used recently, not warming it".format(url)
+            )
+            return
+
+        logger.debug("Warming connection to {}".format(url))
+        try:
+            self.last_used[host] = self.clock()
+            self.session.head(url, timeout=self.timeout, allow_redirects=False)
+        except Exception as e:
+            logger.debug("Could not warm connection: {}".format(e))
+
+    def close(self):
+        self.session.close()
+
+
+def transport_from_config(config, clock=time.time):
+    """
+    Create a Transport from the http_* values in the YAMS config
+
+    :param config: The YAMS config
+    :param clock: (Optional) The function used to tell the time, in seconds
+
+    :type config: dict
+    :type clock: function
+
+    :rtype: yams.transport.Transport
+    """
+
+    def policy_factory():
+        return RetryPolicy(
+            rate=config["http_rate_limit"],
+            burst=config["http_rate_burst"],
+            backoff_base=config["http_backoff_base"],
+            backoff_max=config["http_backoff_max"],
+            failure_threshold=config["http_circuit_threshold"],
+            clock=clock,
+        )
+
+    return Transport(
+        connect_timeout=config["http_connect_timeout"],
+        read_timeout=config["http_read_timeout"],
+        pool_size=config["http_pool_size"],
+        deadline=config["http_deadline"],
+        policy_factory=policy_factory,
+        clock=clock,
+    )